@@ -0,0 +1,573 @@
+"""In-process stand-in for a vCenter server.
+
+FakeVsphere is a pyVmomi stub: managed objects created with it (vim.X(moref,
+stub)) send their method calls and property reads to it instead of over
+SOAP. It synthesizes an inventory of any number of VMs, each with disks
+and a tree of snapshots, from the object IDs alone, so a 100k VM inventory
+takes no memory until its objects are asked for. It implements the calls
+vmwarelib makes for listing and looking up VMs, reading their properties,
+snapshots and changed disk areas, and waiting for tasks:
+
+    fake = FakeVsphere(num_vms=10000)
+    server = core.Server("fake", "user", "pass", service_instance=fake.service_instance)
+
+With latency set, every round trip sleeps that many seconds.
+"""
+
+import collections
+import datetime
+import itertools
+import random
+import threading
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+_FetchInfo = collections.namedtuple("_FetchInfo", ["name", "wsdlName"])
+
+class _View:
+    def __init__(self, types=None, objs=None):
+        self.types = types
+        self.objs = objs
+
+class _Collector:
+    def __init__(self):
+        self.filters = {}
+        self.known = {}
+        self.version = 0
+        self.cancelled = False
+
+class FakeVsphere:
+    """pyVmomi stub synthesizing an inventory of num_vms VMs spread over
+    num_folders folders of one datacenter, num_hosts hosts and
+    num_datastores datastores. Every VM has disks_per_vm disks of
+    disk_capacity bytes and snapshots_per_vm snapshots (snapshot j is a
+    child of snapshot (j - 1) // 2).
+
+    QueryChangedDiskAreas answers change_span bytes per call with
+    changes_per_gb changed 64 KB blocks per GB (four times as many for
+    change ID "*").
+    """
+
+    def __init__(self, num_vms=1000, num_folders=10, num_hosts=16, num_datastores=8, disks_per_vm=2,
+                 snapshots_per_vm=4, disk_capacity=100 * 1024 ** 3, change_span=4 * 1024 ** 3, changes_per_gb=64,
+                 latency=0.0):
+        self.num_vms = num_vms
+        self.num_folders = max(1, num_folders)
+        self.num_hosts = num_hosts
+        self.num_datastores = num_datastores
+        self.disks_per_vm = disks_per_vm
+        self.snapshots_per_vm = snapshots_per_vm
+        self.disk_capacity = disk_capacity
+        self.change_span = change_span
+        self.changes_per_gb = changes_per_gb
+        self.latency = latency
+
+        # Attributes pyVmomi code may look for on a stub.
+        self.version = "vim.version.version13"
+        self.cookie = 'vmware_soap_session="fake"'
+
+        self.lock = threading.Condition()
+        self._ids = itertools.count(1)
+        self._views = {}
+        self._collectors = {}
+        self._filters = {}
+        self._results = {}
+        self._tasks = {}
+
+        self.service_instance = vim.ServiceInstance("ServiceInstance", self)
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=vim.Folder("group-d1", self),
+            propertyCollector=vmodl.query.PropertyCollector("propertyCollector", self),
+            viewManager=vim.view.ViewManager("ViewManager", self),
+            searchIndex=vim.SearchIndex("SearchIndex", self),
+            sessionManager=vim.SessionManager("SessionManager", self),
+            about=vim.AboutInfo(name="Fake vCenter", apiVersion="7.0", version="7.0.3", build="0",
+                                apiType="VirtualCenter", fullName="Fake vCenter Server"))
+
+    # Object naming. Everything about an object is derived from its moref.
+
+    def vm(self, i):
+        return vim.VirtualMachine("vm-{}".format(i), self)
+
+    def vm_name(self, i):
+        return "bench-vm-{:06d}".format(i)
+
+    def vm_ip(self, i):
+        return "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255)
+
+    def vm_uuid(self, i):
+        return "42000000-0000-0000-0000-{:012x}".format(i)
+
+    def vm_folder_index(self, i):
+        return i % self.num_folders
+
+    def vm_inventory_path(self, i):
+        return "DC1/vm/folder-{}/{}".format(self.vm_folder_index(i), self.vm_name(i))
+
+    def folder(self, f):
+        # group-v1 is the VM folder of the datacenter, group-v2 and up its
+        # subfolders.
+        return vim.Folder("group-v{}".format(f + 2), self)
+
+    def snapshot(self, i, j):
+        return vim.vm.Snapshot("snapshot-{}-{}".format(i, j), self)
+
+    def _parse(self, moref):
+        """Returns (kind, indices) of an inventory moref. """
+        kind, _, rest = moref.partition("-")
+        if kind == "group":
+            return ("root", ()) if rest == "d1" else ("vmfolder", (int(rest[1:]) - 2,))
+
+        return kind, tuple(int(x) for x in rest.split("-") if x.isdigit())
+
+    def objects_of_type(self, obj_type):
+        objs = []
+        if issubclass(vim.VirtualMachine, obj_type):
+            objs.extend(self.vm(i) for i in range(self.num_vms))
+        if issubclass(vim.Folder, obj_type):
+            objs.append(vim.Folder("group-v1", self))
+            objs.extend(self.folder(f) for f in range(self.num_folders))
+        if issubclass(vim.Datacenter, obj_type):
+            objs.append(vim.Datacenter("datacenter-1", self))
+        if issubclass(vim.HostSystem, obj_type):
+            objs.extend(vim.HostSystem("host-{}".format(h), self) for h in range(self.num_hosts))
+        if issubclass(vim.Datastore, obj_type):
+            objs.extend(vim.Datastore("datastore-{}".format(d), self) for d in range(self.num_datastores))
+
+        return objs
+
+    # Property values.
+
+    def _disk_backing(self, i, k, j=None):
+        datastore = "ds-{}".format(i % self.num_datastores)
+        base = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName="[{}] {}/{}_{}.vmdk".format(datastore, self.vm_name(i), self.vm_name(i), k),
+            diskMode="persistent", thinProvisioned=True,
+            uuid="6000C290-0000-0000-{:04x}-{:012x}".format(k, i),
+            changeId="52 00 00 00 00 00 {:02x} {:02x}/{}".format(k, i & 255, 0))
+        if j is None and not self.snapshots_per_vm:
+            return base
+
+        level = self.snapshots_per_vm if j is None else j + 1
+        return vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName="[{}] {}/{}_{}-{:06d}.vmdk".format(datastore, self.vm_name(i), self.vm_name(i), k, level),
+            diskMode="persistent", thinProvisioned=True, uuid=base.uuid, parent=base,
+            changeId="52 00 00 00 00 00 {:02x} {:02x}/{}".format(k, i & 255, level))
+
+    def _devices(self, i, j=None):
+        devices = [vim.vm.device.ParaVirtualSCSIController(
+            key=1000, busNumber=0, sharedBus="noSharing",
+            deviceInfo=vim.Description(label="SCSI controller 0", summary="VMware paravirtual SCSI"))]
+
+        for k in range(self.disks_per_vm):
+            devices.append(vim.vm.device.VirtualDisk(
+                key=2000 + k, controllerKey=1000, unitNumber=k, backing=self._disk_backing(i, k, j),
+                capacityInKB=self.disk_capacity // 1024, capacityInBytes=self.disk_capacity,
+                deviceInfo=vim.Description(label="Hard disk {}".format(k + 1),
+                                           summary="{:,} KB".format(self.disk_capacity // 1024))))
+
+        # Typed, as pyVmomi needs for the value of a DynamicProperty.
+        return vim.vm.device.VirtualDevice.Array(devices)
+
+    def _vm_config(self, i, j=None):
+        return vim.vm.ConfigInfo(
+            name=self.vm_name(i), guestFullName="Ubuntu Linux (64-bit)", guestId="ubuntu64Guest",
+            uuid=self.vm_uuid(i), instanceUuid="50000000-0000-0000-0000-{:012x}".format(i),
+            changeTrackingEnabled=True, changeVersion=EPOCH.isoformat(), template=False,
+            files=vim.vm.FileInfo(vmPathName=self._vmx_path(i)),
+            hardware=vim.vm.VirtualHardware(numCPU=2, memoryMB=4096, device=self._devices(i, j)))
+
+    def _vmx_path(self, i):
+        return "[ds-{}] {}/{}.vmx".format(i % self.num_datastores, self.vm_name(i), self.vm_name(i))
+
+    def _snapshot_info(self, i):
+        if not self.snapshots_per_vm:
+            return None
+
+        vmobj = self.vm(i)
+        nodes = [vim.vm.SnapshotTree(
+            snapshot=self.snapshot(i, j), vm=vmobj, name="snap-{}".format(j), description="", id=j + 1,
+            createTime=EPOCH + datetime.timedelta(hours=j), state="poweredOff", quiesced=True,
+            childSnapshotList=[]) for j in range(self.snapshots_per_vm)]
+        for j in range(1, self.snapshots_per_vm):
+            nodes[(j - 1) // 2].childSnapshotList.append(nodes[j])
+
+        return vim.vm.SnapshotInfo(currentSnapshot=nodes[-1].snapshot, rootSnapshotList=[nodes[0]])
+
+    def _vm_property(self, i, name):
+        power_state = "poweredOn" if i % 4 else "poweredOff"
+        host = vim.HostSystem("host-{}".format(i % self.num_hosts), self)
+
+        if name == "name":
+            return self.vm_name(i)
+        if name == "parent":
+            return self.folder(self.vm_folder_index(i))
+        if name == "config":
+            return self._vm_config(i)
+        if name == "runtime":
+            return vim.vm.RuntimeInfo(powerState=power_state, host=host, connectionState="connected")
+        if name == "summary":
+            return vim.vm.Summary(
+                config=vim.vm.Summary.ConfigSummary(
+                    name=self.vm_name(i), vmPathName=self._vmx_path(i), memorySizeMB=4096, numCpu=2,
+                    numVirtualDisks=self.disks_per_vm, uuid=self.vm_uuid(i), guestFullName="Ubuntu Linux (64-bit)"),
+                guest=vim.vm.Summary.GuestSummary(ipAddress=self.vm_ip(i), hostName=self.vm_name(i),
+                                                  toolsVersionStatus2="guestToolsCurrent"),
+                runtime=vim.vm.RuntimeInfo(powerState=power_state, host=host, connectionState="connected"))
+        if name == "guest":
+            return vim.vm.GuestInfo(ipAddress=self.vm_ip(i), hostName=self.vm_name(i))
+        if name == "snapshot":
+            return self._snapshot_info(i)
+        if name == "resourcePool":
+            return vim.ResourcePool("resgroup-{}".format(i % self.num_hosts), self)
+        if name == "datastore":
+            return vim.Datastore.Array([vim.Datastore("datastore-{}".format(i % self.num_datastores), self)])
+
+        return None
+
+    def get_property(self, mo, name):
+        """Returns the value of top level property name of mo. """
+        moref = mo._moId
+        if moref in self._tasks:
+            return self._task_info(moref) if name == "info" else None
+
+        kind, indices = self._parse(moref)
+        if kind == "vm":
+            return self._vm_property(indices[0], name)
+        if kind == "snapshot":
+            i, j = indices
+            if name == "config":
+                return self._vm_config(i, j)
+            return self.vm(i) if name == "vm" else None
+
+        if kind == "root":
+            return {"name": "Datacenters"}.get(name)
+        if kind == "datacenter":
+            return {"name": "DC1", "parent": self.content.rootFolder,
+                    "vmFolder": vim.Folder("group-v1", self)}.get(name)
+        if kind == "vmfolder":
+            if indices[0] == -1:
+                return {"name": "vm", "parent": vim.Datacenter("datacenter-1", self)}.get(name)
+            return {"name": "folder-{}".format(indices[0]), "parent": vim.Folder("group-v1", self)}.get(name)
+        if kind == "host":
+            return {"name": "esx-{:03d}.example.com".format(indices[0])}.get(name)
+        if kind == "datastore":
+            return {"name": "ds-{}".format(indices[0])}.get(name)
+        if kind == "resgroup":
+            return {"name": "Resources"}.get(name)
+
+        return None
+
+    def get_path(self, mo, path):
+        top, _, rest = path.partition(".")
+        value = self.get_property(mo, top)
+        for comp in rest.split(".") if rest else []:
+            if value is None:
+                break
+            value = getattr(value, comp, None)
+
+        return value
+
+    # Tasks.
+
+    def create_task(self, duration=0.0, entity=None, result=None):
+        """Returns a task that succeeds duration seconds from now. """
+        with self.lock:
+            moref = "task-{}".format(next(self._ids))
+            self._tasks[moref] = (time.time(), time.time() + duration, entity, result)
+            self.lock.notify_all()
+
+        return vim.Task(moref, self)
+
+    def _task_info(self, moref):
+        created, done_at, entity, result = self._tasks[moref]
+        done = time.time() >= done_at
+        return vim.TaskInfo(
+            key=moref, task=vim.Task(moref, self), descriptionId="fake.task", entity=entity, cancelable=False,
+            cancelled=False, state="success" if done else "running", result=result if done else None,
+            queueTime=datetime.datetime.fromtimestamp(created, datetime.timezone.utc),
+            completeTime=datetime.datetime.fromtimestamp(done_at, datetime.timezone.utc) if done else None)
+
+    def _task_state(self, moref):
+        return time.time() >= self._tasks[moref][1]
+
+    # Property collector.
+
+    def _filter_objects(self, spec):
+        """Returns the objects selected by the object specs of a filter. """
+        objs = []
+        for obj_spec in spec.objectSet:
+            if not obj_spec.skip:
+                objs.append(obj_spec.obj)
+
+            view = self._views.get(obj_spec.obj._moId)
+            if view is not None and any(s.path == "view" for s in obj_spec.selectSet or []):
+                if view.objs is not None:
+                    objs.extend(view.objs)
+                else:
+                    for obj_type in view.types:
+                        objs.extend(self.objects_of_type(obj_type))
+
+        return objs
+
+    def _object_content(self, spec, obj):
+        prop_specs = [p for p in spec.propSet if isinstance(obj, p.type)]
+        if not prop_specs:
+            return None
+
+        prop_set = []
+        for prop_spec in prop_specs:
+            for path in prop_spec.pathSet or []:
+                value = self.get_path(obj, path)
+                if value is not None:
+                    prop_set.append(vmodl.DynamicProperty(name=path, val=value))
+
+        return prop_set
+
+    def _page(self, token):
+        pending = self._results[token]
+        page, rest = pending[1][:pending[0]], pending[1][pending[0]:]
+
+        objects = []
+        for spec, obj in page:
+            prop_set = self._object_content(spec, obj)
+            if prop_set is not None:
+                objects.append(vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=prop_set))
+
+        next_token = None
+        if rest:
+            next_token = "token-{}".format(next(self._ids))
+            self._results[next_token] = (pending[0], rest)
+        del self._results[token]
+
+        return vmodl.query.PropertyCollector.RetrieveResult(token=next_token, objects=objects)
+
+    def _retrieve(self, specs, options):
+        pairs = [(spec, obj) for spec in specs for obj in self._filter_objects(spec)]
+        token = "token-{}".format(next(self._ids))
+        self._results[token] = (options.maxObjects or len(pairs) or 1, pairs)
+
+        return self._page(token)
+
+    def _updates(self, collector, max_updates):
+        """Returns the object updates of a collector since the last call
+        (at most max_updates) and whether more are pending.
+        """
+        current = {}
+        for filter_moref, spec in collector.filters.items():
+            for obj in self._filter_objects(spec):
+                current[obj._moId] = (filter_moref, spec, obj)
+
+        pending = []
+        for moref, (filter_moref, spec, obj) in current.items():
+            state = self._task_state(moref) if moref in self._tasks else None
+            if moref not in collector.known:
+                pending.append(("enter", filter_moref, spec, obj, state))
+            elif collector.known[moref][1] != state:
+                pending.append(("modify", filter_moref, spec, obj, state))
+
+        for moref, (filter_moref, _, obj) in collector.known.items():
+            if moref not in current:
+                pending.append(("leave", filter_moref, None, obj, None))
+
+        truncated = bool(max_updates) and len(pending) > max_updates
+        if truncated:
+            # The rest is found again by the next call.
+            pending = pending[:max_updates]
+
+        updates = []
+        for kind, filter_moref, spec, obj, state in pending:
+            changes = []
+            if kind == "leave":
+                del collector.known[obj._moId]
+            else:
+                collector.known[obj._moId] = (filter_moref, state, obj)
+                changes = [vmodl.query.PropertyCollector.Change(name=p.name, op="assign", val=p.val)
+                           for p in self._object_content(spec, obj) or []]
+
+            updates.append((filter_moref, vmodl.query.PropertyCollector.ObjectUpdate(kind=kind, obj=obj,
+                                                                                     changeSet=changes)))
+
+        return updates, truncated
+
+    def _wait_for_updates(self, collector, version, options):
+        max_wait = options.maxWaitSeconds if options else None
+        deadline = None if max_wait is None else time.time() + max_wait
+
+        with self.lock:
+            if version is None:
+                collector.known = {}
+
+            while True:
+                if collector.cancelled:
+                    collector.cancelled = False
+                    raise vmodl.fault.RequestCanceled()
+
+                updates, truncated = self._updates(collector, options.maxObjectUpdates if options else None)
+                if updates:
+                    collector.version += 1
+                    by_filter = collections.OrderedDict()
+                    for filter_moref, update in updates:
+                        by_filter.setdefault(filter_moref, []).append(update)
+
+                    filter_sets = [vmodl.query.PropertyCollector.FilterUpdate(
+                        filter=vmodl.query.PropertyCollector.Filter(filter_moref, self), objectSet=object_updates)
+                        for filter_moref, object_updates in by_filter.items()]
+                    return vmodl.query.PropertyCollector.UpdateSet(version=str(collector.version),
+                                                                   truncated=truncated, filterSet=filter_sets)
+
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    return None
+
+                # Wake up when the next task finishes.
+                wakeups = [done_at for _, done_at, _, _ in self._tasks.values() if done_at > now]
+                if deadline is not None:
+                    wakeups.append(deadline)
+
+                self.lock.wait(min(wakeups) - now if wakeups else None)
+
+    # Stub interface.
+
+    def InvokeAccessor(self, mo, info):
+        # Same as SoapStubAdapter: reading a property is a Fetch call.
+        return self.InvokeMethod(mo, _FetchInfo(info.name, "Fetch"), (info.name,))
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, "_do_" + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotSupported(msg="{} is not supported by the fake server".format(info.wsdlName))
+
+        return handler(mo, *args)
+
+    def _do_Fetch(self, mo, name):
+        if mo._moId == "ServiceInstance" and name == "content":
+            return self.content
+
+        return self.get_property(mo, name)
+
+    def _do_RetrieveServiceContent(self, mo):
+        return self.content
+
+    def _do_Logout(self, mo):
+        pass
+
+    def _do_FindByIp(self, mo, datacenter, ip, vm_search):
+        octets = [int(x) for x in ip.split(".")]
+        i = octets[1] << 16 | octets[2] << 8 | octets[3]
+        return self.vm(i) if octets[0] == 10 and i < self.num_vms else None
+
+    def _do_FindByUuid(self, mo, datacenter, uuid, vm_search, instance_uuid=None):
+        i = int(uuid.rsplit("-", 1)[1], 16)
+        return self.vm(i) if uuid == self.vm_uuid(i) and i < self.num_vms else None
+
+    def _do_FindByInventoryPath(self, mo, path):
+        name = path.rsplit("/", 1)[-1]
+        if not name.startswith("bench-vm-"):
+            return None
+
+        i = int(name[len("bench-vm-"):])
+        return self.vm(i) if i < self.num_vms and path == self.vm_inventory_path(i) else None
+
+    def _new_view(self, cls, view):
+        with self.lock:
+            moref = "session[fake]view-{}".format(next(self._ids))
+            self._views[moref] = view
+
+        return cls(moref, self)
+
+    def _do_CreateContainerView(self, mo, container, types, recursive):
+        return self._new_view(vim.view.ContainerView, _View(types=list(types)))
+
+    def _do_CreateListView(self, mo, objs=None):
+        return self._new_view(vim.view.ListView, _View(objs=list(objs or [])))
+
+    def _do_ModifyListView(self, mo, add=None, remove=None):
+        with self.lock:
+            view = self._views[mo._moId]
+            removed = set(obj._moId for obj in remove or [])
+            view.objs = [obj for obj in view.objs if obj._moId not in removed] + list(add or [])
+            self.lock.notify_all()
+
+        return []
+
+    def _do_DestroyView(self, mo):
+        with self.lock:
+            self._views.pop(mo._moId, None)
+
+    def _do_CreatePropertyCollector(self, mo):
+        with self.lock:
+            moref = "session[fake]pc-{}".format(next(self._ids))
+            self._collectors[moref] = _Collector()
+
+        return vmodl.query.PropertyCollector(moref, self)
+
+    def _do_DestroyPropertyCollector(self, mo):
+        with self.lock:
+            collector = self._collectors.pop(mo._moId, None)
+            for filter_moref in collector.filters if collector else []:
+                self._filters.pop(filter_moref, None)
+
+    def _do_CreateFilter(self, mo, spec, partial_updates):
+        with self.lock:
+            collector = self._collectors.setdefault(mo._moId, _Collector())
+            moref = "session[fake]filter-{}".format(next(self._ids))
+            collector.filters[moref] = spec
+            self._filters[moref] = mo._moId
+            self.lock.notify_all()
+
+        return vmodl.query.PropertyCollector.Filter(moref, self)
+
+    def _do_DestroyPropertyFilter(self, mo):
+        with self.lock:
+            collector_moref = self._filters.pop(mo._moId, None)
+            if collector_moref in self._collectors:
+                self._collectors[collector_moref].filters.pop(mo._moId, None)
+
+    def _do_RetrievePropertiesEx(self, mo, specs, options):
+        return self._retrieve(specs, options)
+
+    def _do_ContinuePropertiesEx(self, mo, token):
+        if token not in self._results:
+            raise vmodl.fault.InvalidArgument(invalidProperty="token")
+
+        return self._page(token)
+
+    def _do_CancelRetrievePropertiesEx(self, mo, token):
+        self._results.pop(token, None)
+
+    def _do_WaitForUpdatesEx(self, mo, version=None, options=None):
+        with self.lock:
+            collector = self._collectors.setdefault(mo._moId, _Collector())
+
+        return self._wait_for_updates(collector, version, options)
+
+    def _do_CancelWaitForUpdates(self, mo):
+        with self.lock:
+            collector = self._collectors.get(mo._moId)
+            if collector is not None:
+                collector.cancelled = True
+            self.lock.notify_all()
+
+    def _do_QueryChangedDiskAreas(self, mo, snapshot, device_key, start_offset, change_id):
+        i = self._parse(mo._moId)[1][0]
+        block = 64 * 1024
+        span = min(self.change_span, self.disk_capacity - start_offset)
+
+        count = span * self.changes_per_gb // 1024 ** 3
+        if change_id == "*":
+            count *= 4
+
+        rng = random.Random((i * 1000003 + device_key) * 1000003 + start_offset // self.change_span)
+        blocks = sorted(set(rng.randrange(span // block) for _ in range(count))) if span >= block else []
+        extent = vim.VirtualMachine.DiskChangeInfo.DiskChangeExtent
+        areas = [extent(start=start_offset + b * block, length=block) for b in blocks]
+
+        return vim.VirtualMachine.DiskChangeInfo(startOffset=start_offset, length=span, changedArea=areas)
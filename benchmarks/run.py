@@ -0,0 +1,186 @@
+"""Benchmarks of vmwarelib against FakeVsphere.
+
+Every benchmark reports wall time, number of round trips to the server and
+peak memory allocated by Python (tracemalloc) for inventories of the given
+sizes:
+
+    $ python -m benchmarks.run --vms 100,1000,10000
+    $ python -m benchmarks.run --vms 100000 --only list_vms --json after.json --baseline before.json
+
+With --baseline, results are compared with an earlier --json file and the
+exit status is 1 if any benchmark makes more round trips or is slower or
+uses more memory by more than --tolerance.
+"""
+
+import collections
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+import click
+from tabulate import tabulate
+
+from vmwarelib.sdk import core
+from vmwarelib.sdk import profiling
+
+from benchmarks import fakevim
+
+def _sample(fake, count):
+    """Indices of count VMs spread over the inventory. """
+    count = min(count, fake.num_vms)
+    return [i * fake.num_vms // count for i in range(count)]
+
+def bench_list_vms(fake, server, options):
+    return sum(1 for _ in server.list_vms(None, properties=['runtime.powerState']))
+
+def bench_vm_init(fake, server, options):
+    vms = [core.VirtualMachine(server, identity={"ip": fake.vm_ip(i)}) for i in _sample(fake, options["sample"])]
+    return len(vms)
+
+def bench_vm_info(fake, server, options):
+    for i in _sample(fake, options["sample"]):
+        core.VirtualMachine(server, identity={"ip": fake.vm_ip(i)}).info()
+
+    return min(options["sample"], fake.num_vms)
+
+def bench_get_snapshots(fake, server, options):
+    count = 0
+    for i in _sample(fake, options["sample"]):
+        vm = core.VirtualMachine(server, vmobj=fake.vm(i))
+        for snapshot in vm.get_snapshots():
+            snapshot.get_disks()
+            snapshot.info()
+            count += 1
+
+    return count
+
+def bench_changed_areas(fake, server, options):
+    if not fake.snapshots_per_vm:
+        return 0
+
+    vm = core.VirtualMachine(server, vmobj=fake.vm(0))
+    snapshot = vm.get_snapshots()[-1]
+    changed = snapshot.get_all_changed_areas()
+
+    return sum(len(extent_map) for extent_map in changed.values())
+
+def bench_wait_for_tasks(fake, server, options):
+    # Tasks finish at different times within max_duration seconds.
+    count, max_duration = options["tasks"], options["task_duration"]
+    tasks = [fake.create_task(duration=max_duration * i / count) for i in range(count)]
+
+    return len(server.wait_for_tasks(tasks))
+
+BENCHMARKS = collections.OrderedDict([
+    ("list_vms", bench_list_vms),
+    ("vm_init", bench_vm_init),
+    ("vm_info", bench_vm_info),
+    ("get_snapshots", bench_get_snapshots),
+    ("changed_areas", bench_changed_areas),
+    ("wait_for_tasks", bench_wait_for_tasks),
+])
+
+def run_benchmark(func, fake, options, memory=True):
+    """Runs func with a new Server and returns a result dictionary. """
+    server = core.Server("fake", "benchmark", "", service_instance=fake.service_instance)
+    try:
+        gc.collect()
+        if memory:
+            tracemalloc.start()
+
+        with profiling.profile(server) as profiler:
+            start = time.perf_counter()
+            items = func(fake, server, options)
+            wall = time.perf_counter() - start
+
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        server.cleanup()
+
+    return {"items": items, "wall": wall, "round_trips": profiler.round_trips, "peak_memory": peak}
+
+def compare(results, baseline, tolerance):
+    """Returns descriptions of results that are worse than baseline. """
+    previous = {(r["benchmark"], r["vms"]): r for r in baseline}
+
+    regressions = []
+    for result in results:
+        old = previous.get((result["benchmark"], result["vms"]))
+        if old is None:
+            continue
+
+        name = "{} ({} VMs)".format(result["benchmark"], result["vms"])
+        if result["round_trips"] > old["round_trips"]:
+            regressions.append("{}: {} round trips, was {}".format(name, result["round_trips"], old["round_trips"]))
+
+        if result["wall"] > old["wall"] * (1 + tolerance):
+            regressions.append("{}: {:.3f}s, was {:.3f}s".format(name, result["wall"], old["wall"]))
+
+        if result["peak_memory"] and old["peak_memory"] and \
+           result["peak_memory"] > old["peak_memory"] * (1 + tolerance):
+            regressions.append("{}: {} bytes peak memory, was {}".format(name, result["peak_memory"],
+                                                                       old["peak_memory"]))
+
+    return regressions
+
+@click.command()
+@click.option('--vms', default="100,1000,10000", help='Comma separated inventory sizes. ')
+@click.option('--only', help='Comma separated benchmarks to run (default all): ' + ", ".join(BENCHMARKS))
+@click.option('--sample', default=20, type=click.INT, help='Number of VMs looked up by per VM benchmarks. ')
+@click.option('--snapshots', default=4, type=click.INT, help='Snapshots per VM. ')
+@click.option('--disks', default=2, type=click.INT, help='Disks per VM. ')
+@click.option('--tasks', default=200, type=click.INT, help='Number of tasks to wait for. ')
+@click.option('--task-duration', default=0.5, type=click.FLOAT, help='Longest task duration in seconds. ')
+@click.option('--latency-ms', default=0.0, type=click.FLOAT, help='Simulated latency of every round trip. ')
+@click.option('--memory/--no-memory', default=True, help='Measure peak memory (slows down the benchmarks). ')
+@click.option('--json', 'json_file', help='Save results to this file. ')
+@click.option('--baseline', help='Results file (from --json) to compare with. ')
+@click.option('--tolerance', default=0.25, type=click.FLOAT,
+              help='Allowed increase of wall time and memory over the baseline. ')
+def main(vms, only, sample, snapshots, disks, tasks, task_duration, latency_ms, memory, json_file, baseline,
+         tolerance):
+    names = only.split(",") if only else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise click.BadParameter("Unknown benchmark ({})".format(name), param_hint="--only")
+
+    options = {"sample": sample, "tasks": tasks, "task_duration": task_duration}
+
+    results = []
+    for num_vms in [int(x) for x in vms.split(",")]:
+        fake = fakevim.FakeVsphere(num_vms=num_vms, snapshots_per_vm=snapshots, disks_per_vm=disks,
+                                   latency=latency_ms / 1000.0)
+        for name in names:
+            result = run_benchmark(BENCHMARKS[name], fake, options, memory)
+            result.update(benchmark=name, vms=num_vms)
+            results.append(result)
+
+            click.echo("{:>15} {:>8} VMs: {:.3f}s, {} round trips".format(name, num_vms, result["wall"],
+                                                                       result["round_trips"]), err=True)
+
+    rows = [[r["benchmark"], r["vms"], r["items"], "{:.3f}".format(r["wall"]), r["round_trips"],
+             "{:.1f}".format(r["peak_memory"] / 1024 ** 2) if r["peak_memory"] is not None else "-"]
+            for r in results]
+    click.echo(tabulate(rows, headers=["Benchmark", "VMs", "Items", "Wall (s)", "Round trips", "Peak MB"]))
+
+    if json_file:
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+
+        if regressions:
+            click.echo("\nRegressions:", err=True)
+            for regression in regressions:
+                click.echo("  " + regression, err=True)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -60,7 +60,7 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks']),
 
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
@@ -79,6 +79,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'tracing': ['opentelemetry-api', 'opentelemetry-sdk', 'opentelemetry-exporter-otlp-proto-http'],
     },
 
     # To provide executable scripts, use entry points in preference to the
@@ -87,6 +88,8 @@ setup(
     entry_points={
         'console_scripts': [
             'vmwarecli=vmwarelib.cli.vmwarecli:main',
+            'vmwarecli-agent=vmwarelib.cli.agent:main',
+            'vmwarecli-client=vmwarelib.cli.agent:client_main',
         ],
     },
 )
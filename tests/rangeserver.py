@@ -0,0 +1,101 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.split("?", 1)[0].lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        range_header = self.headers.get("Range")
+        with self.server.lock:
+            self.server.ranges.append(range_header)
+
+        headers = {}
+        if self.server.etags:
+            headers["ETag"] = etag(data)
+
+        # Range applies only if the file is still the one If-Range names.
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != headers.get("ETag"):
+            range_header = None
+
+        if range_header is None or not self.server.ranges_supported:
+            self._send(200, data, headers)
+            return
+
+        start, end = re.match(r"bytes=(\d+)-(\d*)$", range_header).groups()
+        start = int(start)
+        end = min(int(end), len(data) - 1) if end else len(data) - 1
+        if start >= len(data):
+            headers["Content-Range"] = "bytes */{}".format(len(data))
+            self._send(416, b"", headers)
+            return
+
+        headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, len(data))
+        self._send(206, data[start:end + 1], headers)
+
+    def do_PUT(self):
+        # Like the datastore endpoint, a file is taken only with its length.
+        if "Content-Length" not in self.headers:
+            self.send_error(411)
+            return
+
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        with open(os.path.join(self.server.root, self.path.split("?", 1)[0].lstrip("/")), "wb") as f:
+            f.write(data)
+
+        self._send(201, b"", {})
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def etag(data):
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+class RangeServer:
+    """Local HTTP server for the files in root, answering Range requests
+    (with If-Range on ETags unless etags is False) and taking uploads like
+    the datastore /folder endpoint. The Range header of every GET is
+    recorded in ranges.
+    """
+
+    def __init__(self, root, ranges_supported=True, etags=True):
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.root = root
+        self.httpd.ranges_supported = ranges_supported
+        self.httpd.etags = etags
+        self.httpd.ranges = []
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def ranges(self):
+        return self.httpd.ranges
+
+    def url(self, name):
+        return "http://127.0.0.1:{}/{}".format(self.httpd.server_address[1], name)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
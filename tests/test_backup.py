@@ -0,0 +1,127 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from vmwarelib.sdk import backup
+from vmwarelib.sdk.extents import ExtentMap
+
+from tests.rangeserver import RangeServer
+
+CAPACITY = 1024 * 1024
+
+class _Disk:
+    def __init__(self, change_id):
+        self.key = 2000
+        self.uuid = "6000C290-0000-0000-0000-000000000001"
+        self.capacityInBytes = CAPACITY
+        self.changeId = change_id
+
+class _Snapshot:
+    """Stands in for a VirtualMachineSnapshot with one disk. """
+
+    def __init__(self, change_id, changed):
+        self.disk = _Disk(change_id)
+        self.changed = changed
+
+    def get_disks(self):
+        return [self.disk]
+
+    def get_all_changed_areas(self, changeids, max_workers=None):
+        return {self.disk.key: self.changed}
+
+def _read_delta(path):
+    with open(path, "rb") as f:
+        magic, capacity = backup.DELTA_HEADER.unpack(f.read(backup.DELTA_HEADER.size))
+        records = []
+        while True:
+            header = f.read(backup.DELTA_RECORD.size)
+            if not header:
+                break
+
+            offset, length = backup.DELTA_RECORD.unpack(header)
+            records.append((offset, f.read(length)))
+
+    return magic, capacity, records
+
+class HttpRangeBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.disk_data = random.Random(1).randbytes(CAPACITY)
+        with open(os.path.join(self.dir, "disk-flat.vmdk"), "wb") as f:
+            f.write(self.disk_data)
+
+        self.server = RangeServer(self.dir).__enter__()
+        self.changed = ExtentMap.from_extents([(0, 4096), (65536, 200000), (CAPACITY - 512, 512)])
+
+    def tearDown(self):
+        self.server.__exit__()
+        shutil.rmtree(self.dir)
+
+    def _source(self, disk=None):
+        return backup.HttpRangeSource(self.server.url("disk-flat.vmdk"))
+
+    def _expected_image(self, changed):
+        expected = bytearray(CAPACITY)
+        for start, length in changed:
+            expected[start:start + length] = self.disk_data[start:start + length]
+
+        return bytes(expected)
+
+    def test_sparse_image(self):
+        path = os.path.join(self.dir, "out.img")
+        writer = backup.SparseImageWriter(path, CAPACITY)
+        try:
+            copied = backup.copy_extents(self.changed, self._source(), writer, chunk_size=65536)
+        finally:
+            writer.close()
+
+        self.assertEqual(copied, self.changed.total_bytes())
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self._expected_image(self.changed))
+
+        # Every request is a range of at most chunk_size bytes.
+        self.assertTrue(all(r.startswith("bytes=") for r in self.server.ranges))
+        self.assertEqual(len(self.server.ranges), 1 + 4 + 1)
+
+    def test_delta_file(self):
+        path = os.path.join(self.dir, "out.delta")
+        writer = backup.DeltaFileWriter(path, CAPACITY)
+        try:
+            backup.copy_extents(self.changed, self._source(), writer, chunk_size=65536)
+        finally:
+            writer.close()
+
+        magic, capacity, records = _read_delta(path)
+        self.assertEqual((magic, capacity), (backup.DELTA_MAGIC, CAPACITY))
+        self.assertEqual(ExtentMap.from_extents((offset, len(data)) for offset, data in records), self.changed)
+        for offset, data in records:
+            self.assertEqual(data, self.disk_data[offset:offset + len(data)])
+
+    def test_full_backup_replaces_image(self):
+        target = os.path.join(self.dir, "backup")
+
+        # Incremental run on top of an image with data everywhere.
+        os.makedirs(target)
+        image = os.path.join(target, "{}.img".format(_Disk(None).uuid))
+        with open(image, "wb") as f:
+            f.write(b"\xff" * CAPACITY)
+
+        snapshot = _Snapshot("52 00/1", self.changed)
+        backup.SnapshotBackup(None, snapshot, target, source_factory=self._source).run()
+        with open(image, "rb") as f:
+            data = f.read()
+        self.assertEqual(data[:4096], self.disk_data[:4096])
+        self.assertEqual(data[4096:65536], b"\xff" * (65536 - 4096))
+
+        # Full run leaves nothing of the old image.
+        changed = ExtentMap.from_extents([(8192, 8192)])
+        copied = backup.SnapshotBackup(None, _Snapshot("52 00/2", changed), target,
+                                       source_factory=self._source).run(full=True)
+        self.assertEqual(copied, {snapshot.disk.uuid: 8192})
+        with open(image, "rb") as f:
+            self.assertEqual(f.read(), self._expected_image(changed))
+
+if __name__ == '__main__':
+    unittest.main()
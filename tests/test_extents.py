@@ -0,0 +1,24 @@
+import unittest
+
+from vmwarelib.sdk.extents import ExtentMap
+
+class AlignedTest(unittest.TestCase):
+    def test_widens_to_blocks(self):
+        extents = ExtentMap.from_extents([(100, 10), (5000, 100)])
+
+        self.assertEqual(list(extents.aligned(4096)), [(0, 8192)])
+
+    def test_clips_to_limit(self):
+        extents = ExtentMap.from_extents([(0, 100), (10000, 100)])
+
+        self.assertEqual(list(extents.aligned(4096, limit=10050)), [(0, 4096), (8192, 10050 - 8192)])
+
+    def test_skips_extents_past_limit(self):
+        # E.g. changed areas of a disk that has since been shrunk.
+        extents = ExtentMap.from_extents([(0, 4096), (8192, 4096), (16384, 100)])
+
+        self.assertEqual(list(extents.aligned(4096, limit=8192)), [(0, 4096)])
+        self.assertEqual(list(extents.aligned(4096, limit=8000)), [(0, 4096)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from vmwarelib.sdk import transfer
+
+from tests import rangeserver
+from tests.rangeserver import RangeServer
+
+SIZE = 300000
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = random.Random(2).randbytes(SIZE)
+        with open(os.path.join(self.dir, "file.bin"), "wb") as f:
+            f.write(self.data)
+
+        self.local_path = os.path.join(self.dir, "download.bin")
+        self.session = transfer.create_session()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def _download(self, ranges_supported=True, etags=True, **kwargs):
+        with RangeServer(self.dir, ranges_supported, etags) as server:
+            size = transfer.download(self.session, server.url("file.bin"), self.local_path, chunk_size=8192,
+                                     **kwargs)
+
+        self.assertEqual(size, len(self.data))
+        self.assertFalse(os.path.exists(self.local_path + ".part"))
+        self.assertFalse(os.path.exists(self.local_path + ".part.json"))
+        with open(self.local_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        return server.ranges
+
+    def _write_part(self, length, info=True, validator=True):
+        """Writes what an interrupted download leaves behind. """
+        with open(self.local_path + ".part", "wb") as f:
+            f.write(self.data[:length])
+
+        if info:
+            with open(self.local_path + ".part.json", "w") as f:
+                json.dump({"validator": rangeserver.etag(self.data) if validator else None, "size": SIZE}, f)
+
+    def _change_file(self, size):
+        self.data = random.Random(4).randbytes(size)
+        with open(os.path.join(self.dir, "file.bin"), "wb") as f:
+            f.write(self.data)
+
+    def test_download(self):
+        self.assertEqual(self._download(), [None])
+
+    def test_resume(self):
+        self._write_part(100000)
+
+        self.assertEqual(self._download(), ["bytes=100000-"])
+
+    def test_resume_complete_part(self):
+        self._write_part(SIZE)
+
+        self.assertEqual(self._download(), ["bytes={}-".format(SIZE)])
+
+    def test_resume_without_ranges(self):
+        # Server sends the whole file, which replaces the part file.
+        self._write_part(100000)
+
+        self.assertEqual(self._download(ranges_supported=False), ["bytes=100000-"])
+
+    def test_resume_changed_file(self):
+        # If-Range fails, so the server sends the new file in full.
+        self._write_part(100000)
+        self._change_file(SIZE)
+
+        self.assertEqual(self._download(), ["bytes=100000-"])
+
+    def test_resume_changed_size_without_etag(self):
+        self._write_part(100000, validator=False)
+        self._change_file(SIZE + 1000)
+
+        self.assertEqual(self._download(etags=False), ["bytes=100000-", None])
+
+    def test_resume_shrunk_file(self):
+        self._write_part(SIZE, validator=False)
+        self._change_file(1000)
+
+        self.assertEqual(self._download(etags=False), ["bytes={}-".format(SIZE), None])
+
+    def test_part_without_info(self):
+        # Nothing is known about the file the part came from.
+        self._write_part(100000, info=False)
+
+        self.assertEqual(self._download(), [None])
+
+    def test_no_resume(self):
+        self._write_part(100000)
+
+        self.assertEqual(self._download(resume=False), [None])
+
+    def test_segments(self):
+        ranges = self._download(segments=4, segment_size=65536)
+
+        segment = -(-SIZE // 4)
+        expected = ["bytes={}-{}".format(start, min(start + segment, SIZE) - 1) for start in range(0, SIZE, segment)]
+        self.assertEqual(ranges[0], "bytes=0-0")
+        self.assertEqual(sorted(ranges[1:]), sorted(expected))
+
+    def test_segments_small_file(self):
+        # Files up to segment_size are streamed in one request.
+        self.assertEqual(self._download(segments=4, segment_size=SIZE), ["bytes=0-0", None])
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = random.Random(3).randbytes(SIZE)
+        self.local_path = os.path.join(self.dir, "upload.bin")
+        with open(self.local_path, "wb") as f:
+            f.write(self.data)
+
+        self.session = transfer.create_session()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def test_upload(self):
+        chunks = []
+        with RangeServer(self.dir) as server:
+            size = transfer.upload(self.session, server.url("uploaded.bin"), self.local_path, chunk_size=65536,
+                                   progress=chunks.append)
+
+        self.assertEqual(size, SIZE)
+        self.assertEqual(chunks, [65536] * 4 + [SIZE - 4 * 65536])
+        with open(os.path.join(self.dir, "uploaded.bin"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+"""Agent mode for vmwarecli.
+
+The agent is a long running process that keeps logged in Server objects
+(and their caches, mirrors and task watchers) and runs vmwarecli commands
+sent to it over a Unix domain socket. The client side only uses the
+standard library so that forwarding a command does not pay for importing
+click and pyVmomi.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import traceback
+
+ENV_PREFIX = "VMWARECLI_"
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "vmwarelib")
+    return os.path.join(runtime_dir, "vmwarecli-agent.sock")
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+def _receive(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+
+        data += chunk
+
+    if not data:
+        return None
+
+    return json.loads(data.decode("utf-8"))
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+def forward(argv, socket_path=None):
+    """Runs vmwarecli command line argv in the agent. Returns (stdout,
+    stderr, status) or None if no agent is running.
+    """
+    sock = _connect(socket_path or default_socket_path())
+    if sock is None:
+        return None
+
+    with sock:
+        env = {k: v for k, v in os.environ.items() if k.startswith(ENV_PREFIX)}
+        _send(sock, {"command": "run", "argv": argv, "env": env})
+        response = _receive(sock)
+
+    if response is None:
+        raise Exception("Agent closed the connection without a response. ")
+
+    return response["stdout"], response["stderr"], response["status"]
+
+def client_main():
+    """Entry point of the thin client. Falls back to running the command
+    in process when no agent is running.
+    """
+    argv = sys.argv[1:]
+
+    result = forward(argv, os.environ.get(ENV_PREFIX + "AGENT_SOCKET"))
+    if result is None:
+        from vmwarelib.cli import vmwarecli
+
+        sys.argv[0] = "vmwarecli"
+        vmwarecli.main()
+        return
+
+    stdout, stderr, status = result
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
+
+class Agent:
+    # A server that has not been used for this many seconds has its session
+    # checked before it is used again, as vCenter expires idle sessions.
+    session_check_interval = 60
+
+    def __init__(self, socket_path=None, mirror_staleness=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.mirror_staleness = mirror_staleness
+        self.servers = {}
+        self._last_used = {}
+        self._stopped = False
+
+    def get_server(self, host, username, password, ignore_cert_warnings):
+        from vmwarelib.sdk import core
+
+        key = (host, username, password, ignore_cert_warnings)
+        server = self.servers.get(key)
+        if server is not None and time.time() - self._last_used.get(key, 0) > self.session_check_interval:
+            if core.get_current_session(server.service_instance) is None:
+                logging.info("Session on {} has expired, logging in again".format(host))
+                del self.servers[key]
+                try:
+                    server.cleanup()
+                except Exception:
+                    logging.debug("Could not clean up expired server", exc_info=True)
+
+                server = None
+
+        if server is None:
+            if not host or not username or not password:
+                raise Exception("server, user name, and password are required. ")
+
+            server = core.Server(host, username, password, ignore_cert_warnings=ignore_cert_warnings)
+            if self.mirror_staleness:
+                server.start_mirror(self.mirror_staleness)
+
+            self.servers[key] = server
+
+        self._last_used[key] = time.time()
+
+        return server
+
+    def run_command(self, argv, env):
+        import click
+
+        from vmwarelib.cli import util
+        from vmwarelib.cli import vmwarecli
+
+        agent = self
+
+        class AgentContext(util.Context):
+            def __init__(self):
+                super().__init__()
+                self.in_agent = True
+
+            def _connect(self):
+                return agent.get_server(self.server_host, self.username, self.password, self.ignore_cert_warnings)
+
+        # Options are read from the client's environment, not the agent's.
+        saved_env = {k: v for k, v in os.environ.items() if k.startswith(ENV_PREFIX)}
+        for k in saved_env:
+            del os.environ[k]
+        os.environ.update(env)
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        # Nothing can be typed in, a prompt fails instead of blocking the
+        # agent.
+        saved_stdin, sys.stdin = sys.stdin, io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    result = vmwarecli.cli.main(args=argv, prog_name="vmwarecli", standalone_mode=False,
+                                                obj=AgentContext())
+                    if isinstance(result, int):
+                        status = result
+                except click.ClickException as e:
+                    e.show()
+                    status = e.exit_code
+                except click.exceptions.Abort:
+                    status = 1
+                except Exception:
+                    logging.error(traceback.format_exc())
+
+                    exctype, value = sys.exc_info()[:2]
+                    click.secho(traceback.format_exception_only(exctype, value)[0], fg='red')
+                    status = 1
+        finally:
+            sys.stdin = saved_stdin
+            for k in env:
+                os.environ.pop(k, None)
+            os.environ.update(saved_env)
+
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "status": status}
+
+    def _handle(self, conn):
+        request = _receive(conn)
+        if request is None:
+            return
+
+        if request.get("command") == "stop":
+            self._stopped = True
+            _send(conn, {"stdout": "", "stderr": "", "status": 0})
+        elif request.get("command") == "run":
+            _send(conn, self.run_command(request["argv"], request.get("env", {})))
+        else:
+            _send(conn, {"stdout": "", "stderr": "Unknown request ({})\n".format(request.get("command")),
+                         "status": 1})
+
+    def serve(self):
+        sock = _connect(self.socket_path)
+        if sock is not None:
+            sock.close()
+            raise Exception("Agent is already running on ({})".format(self.socket_path))
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the owner may talk to the agent.
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+        listener.listen(16)
+        logging.info("vmwarecli agent listening on {}".format(self.socket_path))
+
+        try:
+            # Commands print to sys.stdout, so they are run one at a time.
+            while not self._stopped:
+                conn, _ = listener.accept()
+                with conn:
+                    try:
+                        self._handle(conn)
+                    except Exception:
+                        logging.error(traceback.format_exc())
+        finally:
+            listener.close()
+            os.unlink(self.socket_path)
+            self.cleanup()
+
+    def cleanup(self):
+        for server in self.servers.values():
+            try:
+                server.cleanup()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+        self.servers = {}
+
+def _detach():
+    if os.fork() > 0:
+        os._exit(0)
+
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+def main():
+    import click
+
+    from vmwarelib.cli import vmwarecli
+
+    @click.group()
+    def cli():
+        """Runs vmwarecli commands in a long lived process. Use
+        vmwarecli-client instead of vmwarecli to send commands to it.
+        """
+
+        pass
+
+    @cli.command()
+    @click.option('--socket', 'socket_path', envvar=ENV_PREFIX + "AGENT_SOCKET", help='Socket path. ')
+    @click.option('--mirror', type=click.INT,
+                  help='Keep an inventory mirror with this many seconds of staleness for every server. ')
+    @click.option('--detach', is_flag=True, default=False, help='Run in the background. ')
+    def serve(socket_path, mirror, detach):
+        vmwarecli.init_logging()
+
+        agent = Agent(socket_path, mirror_staleness=mirror)
+        if detach:
+            _detach()
+
+        agent.serve()
+
+    @cli.command()
+    @click.option('--socket', 'socket_path', envvar=ENV_PREFIX + "AGENT_SOCKET", help='Socket path. ')
+    def stop(socket_path):
+        sock = _connect(socket_path or default_socket_path())
+        if sock is None:
+            raise click.ClickException("Agent is not running. ")
+
+        with sock:
+            _send(sock, {"command": "stop"})
+            _receive(sock)
+
+    cli()
@@ -1,12 +1,14 @@
 
 import os
 import tempfile
+import time
 
 import click
 from tabulate import tabulate
 
 from vmwarelib.cli import util
 from vmwarelib.sdk import core
+from vmwarelib.sdk import util as sdk_util
 
 @click.group()
 @util.pass_context
@@ -68,5 +70,91 @@ def list_logs(ctx):
     for log in ctx.host.list_logs():
         print(log.fileName)
 
+@cli.command()
+@util.pass_context
+@click.argument('dsname')
+@click.argument('path')
+@click.argument('local_path')
+@click.option('--segments', type=click.INT, default=1, help='Number of parallel connections for large files. ')
+@click.option('--no_resume', is_flag=True, default=False, help='Start over instead of resuming a partial download. ')
+def download(ctx, dsname, path, local_path, segments, no_resume):
+    """Download a file from a datastore. PATH is relative to the datastore.
+    """
+
+    datastore = ctx.host.get_datastore(dsname)
+    size = datastore.download(path, local_path, segments=segments, resume=not no_resume)
+    print("Downloaded {} to {}".format(sdk_util.bytes_to_readable_units(size), local_path))
+
+@cli.command()
+@util.pass_context
+@click.argument('dsname')
+@click.argument('path')
+@click.argument('local_paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--connections', type=click.INT, default=4, help='Number of files uploaded at once. ')
+@click.option('--chunk_mb', type=click.INT, default=1, help='Size of chunks read from the files in MB. ')
+def upload(ctx, dsname, path, local_paths, connections, chunk_mb):
+    """Upload files to a datastore. PATH is relative to the datastore and
+    is a folder when it ends with "/" or multiple files are given.
+    """
+
+    if len(local_paths) > 1 or path.endswith('/'):
+        files = [(x, '/'.join([path.rstrip('/'), os.path.basename(x)])) for x in local_paths]
+    else:
+        files = [(local_paths[0], path)]
+
+    datastore = ctx.host.get_datastore(dsname)
+
+    start = time.time()
+    size = datastore.upload_many(files, connections, chunk_mb * sdk_util.unit_m)
+    elapsed = max(time.time() - start, 0.001)
+
+    print("Uploaded {} in {:.1f} seconds ({}/s)".format(sdk_util.bytes_to_readable_units(size), elapsed,
+                                                        sdk_util.bytes_to_readable_units(size / elapsed)))
+
+@cli.command()
+@util.pass_context
+@click.argument('dsname')
+@click.argument('path', default='')
+@click.option('--pattern', help='Only list files matching this pattern (e.g. "*.vmdk"). ')
+@click.option('--recursive', '-r', is_flag=True, default=False, help='List sub folders too. ')
+def browse(ctx, dsname, path, pattern, recursive):
+    """List files on a datastore.
+    """
+
+    datastore = ctx.host.get_datastore(dsname)
+    print()
+    for f in datastore.browse(path, pattern, recursive):
+        size = sdk_util.bytes_to_readable_units(f.size) if f.size is not None else ""
+        print("{:>16} {:<22} {:<}".format(size, f.type, f.path))
+
+DEFAULT_COUNTERS = ['cpu.usage.average', 'mem.usage.average', 'disk.usage.average', 'net.usage.average']
+
+@cli.command()
+@util.pass_context
+@click.option('--counter', '-c', multiple=True, help='Counter name, e.g. cpu.usage.average (can be repeated). '
+                                                     'Default is CPU, memory, disk, and network usage. ')
+@click.option('--interval', type=click.INT, default=20, help='Sampling interval in seconds (20 is real-time). ')
+@click.option('--window', type=click.INT, default=300, help='Show samples of the last these many seconds. ')
+@click.option('--list_counters', is_flag=True, default=False, help='List names of all available counters. ')
+def stats(ctx, counter, interval, window, list_counters):
+    """Show performance statistics of the host.
+    """
 
+    if list_counters:
+        for name in ctx.server.perf_counters.names():
+            print(name)
+        return
 
+    counters = list(counter) or DEFAULT_COUNTERS
+    samples = ctx.host.get_perf_stats(counters, interval, window)
+    if not len(samples):
+        print("No samples found...")
+        return
+
+    headers = ["time"] + ["{} ({})".format(name, ctx.server.perf_counters.get_unit(name))
+                          for name, _ in samples.values]
+    rows = [[time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))] + values
+            for timestamp, values in samples.rows()]
+
+    print()
+    print(tabulate(rows, headers=headers))
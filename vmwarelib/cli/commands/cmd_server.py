@@ -1,8 +1,12 @@
 
+import time
+
 import click
 from tabulate import tabulate
 
 from vmwarelib.cli import util
+from vmwarelib.sdk import perf
+from vmwarelib.sdk import util as sdk_util
 
 @click.group()
 @util.pass_context
@@ -22,7 +26,15 @@ def info(ctx):
 @click.option('--pat', help='Only VMs containing this pattern in their name will be listed.')
 def list_vms(ctx, pat):
     print()
-    for vm in ctx.server.list_vms(pat):
+
+    inventory_cache = ctx.get_cache()
+    if inventory_cache:
+        for vm in inventory_cache.list_vms(pat):
+            print("{:>40}: {:<}".format(vm.name, vm.inventory_path))
+
+        return
+
+    for vm in ctx.server.list_vms(pat, properties=['parent']):
         print("{:>40}: {:<}".format(vm.name, vm.inventory_path))
 
 @cli.command()
@@ -58,12 +70,115 @@ def create_vm_from_template(ctx, vmname, template, datastore, datacenter, hostna
     ctx.server.create_vm_from_template(vmname, template, datastore, datacenter, hostname)
     print("VM create successfully form template!")
 
+def select_vms(ctx, pat, file):
+    if not pat and not file:
+        raise Exception('Either pattern or file with VM names is required. ')
 
+    names = None
+    if file:
+        with open(file) as f:
+            names = set(line.strip() for line in f if line.strip())
 
+    vms = [vm for vm in ctx.server.list_vms(pat) if names is None or vm.name in names]
+    if not vms:
+        raise Exception('No matching VMs found. ')
 
+    return vms
 
+def print_results(results):
+    failed = 0
+    for vm, error in results:
+        if error:
+            failed += 1
+            print("{:>40}: FAILED ({})".format(vm.name, error))
+        else:
+            print("{:>40}: OK".format(vm.name))
 
+    if failed:
+        raise Exception('{} VM(s) failed. '.format(failed))
 
+@cli.command()
+@util.pass_context
+@click.option('--pat', help='VMs containing this pattern in their name. ')
+@click.option('--file', type=click.Path(exists=True), help='File with names of VMs, one per line. ')
+@click.option('--parallel', type=click.INT, default=16, help='Maximum number of VMs powered on at once. ')
+@click.option('--per_host', type=click.INT, default=4, help='Maximum number of VMs powered on at once per host. ')
+@click.option('--per_datastore', type=click.INT, default=8,
+              help='Maximum number of VMs powered on at once per datastore. ')
+@click.option('--retries', type=click.INT, default=2, help='Number of retries on transient errors. ')
+@click.option('--answer', type=click.Choice(sorted(sdk_util.answer_policies)), default='default',
+              help='How to answer questions asked by VMs while powering on. ')
+def poweron(ctx, pat, file, parallel, per_host, per_datastore, retries, answer):
+    if ctx.in_agent and answer == 'interactive':
+        raise click.UsageError("--answer interactive can't be used with the agent. ")
+
+    vms = select_vms(ctx, pat, file)
+    print()
+    print_results(ctx.server.power_on_many(vms, answer=sdk_util.answer_policies[answer], max_workers=parallel,
+                                           per_host=per_host, per_datastore=per_datastore, retries=retries))
 
+@cli.command()
+@util.pass_context
+@click.option('--pat', help='VMs containing this pattern in their name. ')
+@click.option('--file', type=click.Path(exists=True), help='File with names of VMs, one per line. ')
+@click.option('--parallel', type=click.INT, default=16, help='Maximum number of VMs powered off at once. ')
+@click.option('--per_host', type=click.INT, default=4, help='Maximum number of VMs powered off at once per host. ')
+@click.option('--per_datastore', type=click.INT, default=8,
+              help='Maximum number of VMs powered off at once per datastore. ')
+@click.option('--retries', type=click.INT, default=2, help='Number of retries on transient errors. ')
+def poweroff(ctx, pat, file, parallel, per_host, per_datastore, retries):
+    vms = select_vms(ctx, pat, file)
+    print()
+    print_results(ctx.server.power_off_many(vms, max_workers=parallel, per_host=per_host,
+                                            per_datastore=per_datastore, retries=retries))
 
+@cli.command()
+@util.pass_context
+@click.argument('name')
+@click.option('--pat', help='VMs containing this pattern in their name. ')
+@click.option('--file', type=click.Path(exists=True), help='File with names of VMs, one per line. ')
+@click.option('--parallel', type=click.INT, default=16, help='Maximum number of snapshots taken at once. ')
+@click.option('--quiesce/--no-quiesce', default=True, help='Quiesce guest file systems. ')
+@click.option('--memory', is_flag=True, default=False, help='Include memory of the VMs. ')
+def snapshot_group(ctx, name, pat, file, parallel, quiesce, memory):
+    """Snapshot a group of VMs. Either all VMs get the snapshot or none.
+    """
+
+    vms = select_vms(ctx, pat, file)
+    names = {vm.vmobj._moId: vm.name for vm in vms}
+    print()
+    for snap in ctx.server.snapshot_group(vms, name, memory=memory, quiesce=quiesce, parallelism=parallel):
+        print("{:>40}: {}".format(names[snap.vmobj._moId], snap.moref))
+
+@cli.command()
+@util.pass_context
+@click.option('--pat', help='VMs containing this pattern in their name. ')
+@click.option('--file', type=click.Path(exists=True), help='File with names of VMs, one per line. ')
+@click.option('--counter', '-c', multiple=True, help='Counter name, e.g. cpu.usage.average (can be repeated). '
+                                                     'Default is CPU and memory usage. ')
+@click.option('--parallel', type=click.INT, default=8, help='Maximum number of queries run at once. ')
+@click.option('--polls', type=click.INT, help='Stop after these many polls (every 20 seconds). Default is to '
+                                              'run until interrupted (required with the agent). ')
+def vm_stats(ctx, pat, file, counter, parallel, polls):
+    """Stream real-time statistics of VMs as CSV lines.
+    """
 
+    # The agent returns the output when the command ends and runs nothing
+    # else meanwhile.
+    if ctx.in_agent and polls is None:
+        raise click.UsageError("--polls is required with the agent. ")
+
+    counters = list(counter) or ['cpu.usage.average', 'mem.usage.average']
+    vms = select_vms(ctx, pat, file)
+    names = {vm.vmobj._moId: vm.name for vm in vms}
+
+    collector = perf.RealtimeCollector(ctx.server, vms, counters, max_workers=parallel)
+    print(",".join(["time", "vm"] + counters))
+    try:
+        for moref, timestamps, columns in collector.stream(max_polls=polls):
+            for i, timestamp in enumerate(timestamps):
+                values = [str(columns[name][i]) for name in counters]
+                print(",".join([time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)), names[moref]] + values),
+                      flush=True)
+    except KeyboardInterrupt:
+        collector.stop()
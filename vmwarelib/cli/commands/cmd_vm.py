@@ -6,7 +6,9 @@ import click
 from tabulate import tabulate
 
 from vmwarelib.cli import util
+from vmwarelib.sdk import backup as sdk_backup
 from vmwarelib.sdk import core
+from vmwarelib.sdk import util as sdk_util
 
 @click.group()
 @util.pass_context
@@ -23,7 +25,14 @@ def cli(ctx, ip, ipath, uuid, **kwargs):
     ctx.ip = ip
     ctx.ipath = ipath
     ctx.uuid = uuid
-    ctx.vm = core.VirtualMachine(ctx.server, {"ip": ctx.ip, "ipath": ipath, "uuid": uuid})
+    identity = {"ip": ctx.ip, "ipath": ipath, "uuid": uuid}
+
+    inventory_cache = ctx.get_cache()
+    moref = inventory_cache.find_vm(identity) if inventory_cache else None
+    if moref:
+        ctx.vm = ctx.server.get_vm(moref)
+    else:
+        ctx.vm = core.VirtualMachine(ctx.server, identity)
 
 @cli.command()
 @util.pass_context
@@ -91,7 +100,7 @@ def delete_all_snapshots(ctx):
 def list_snapshots(ctx):
     print()
 
-    snapshot_names = [x.name for x in ctx.vm.get_snapshots()]
+    snapshot_names = [x.name for x in ctx.vm.get_snapshots(prefetch=False)]
 
     if not snapshot_names:
         print("No snapshots found...")
@@ -126,7 +135,11 @@ def download_vmx(ctx, output_file):
 @click.option('--snapname', help='Name of snapshot where disk needs to be looked up. Default is live VM. ')
 @click.option('--from_changeid', help='Change ID from which incremental needs to be computed. ')
 @click.option('--ca', is_flag=True, default=False, help='Shows changed areas when set. ')
-def diskinfo(ctx, key, snapname, from_changeid, ca):
+@click.option('--ca_file', help='Saves changed areas to this file (in binary form) instead of showing them. ')
+def diskinfo(ctx, key, snapname, from_changeid, ca, ca_file):
+    if ca_file:
+        ca = True
+
     if ca and not from_changeid:
         from_changeid = "*"
 
@@ -144,11 +157,35 @@ def diskinfo(ctx, key, snapname, from_changeid, ca):
         print("{:>20}: {:<}".format(k, v))
 
     if ca:
-        print('\n  Changed Areas (from "{}"): \n'.format(from_changeid))
+        changed = disk.get_changed_extents(from_changeid)
+        print('\n  Changed Areas (from "{}"): {} extents, {}\n'.format(
+            from_changeid, len(changed), sdk_util.bytes_to_readable_units(changed.total_bytes())))
 
-        for change_list in disk.get_changed_areas(from_changeid):
-            for start, length in change_list:
-                print("{:>20}: {:<}".format(start, length))
+        if ca_file:
+            changed.save(ca_file)
+            return
+
+        for start, length in changed:
+            print("{:>20}: {:<}".format(start, length))
+
+@cli.command()
+@util.pass_context
+@click.argument('snapname')
+@click.argument('target_dir')
+@click.option('--full', is_flag=True, default=False, help='Copy all allocated areas instead of changes. ')
+@click.option('--delta', is_flag=True, default=False,
+              help='Write changes to new delta files instead of updating disk images. ')
+def backup(ctx, snapname, target_dir, full, delta):
+    """Back up disks of a snapshot, copying only areas changed since the
+    previous backup into the same directory.
+    """
+
+    snap = ctx.vm.get_snapshot_with_name(snapname)
+    copied = sdk_backup.SnapshotBackup(ctx.server, snap, target_dir, delta=delta).run(full=full)
+
+    print()
+    for uuid, num_bytes in copied.items():
+        print("{:>40}: {:<}".format(uuid, sdk_util.bytes_to_readable_units(num_bytes)))
 
 @cli.command()
 @util.pass_context
@@ -170,8 +207,17 @@ def unregister(ctx):
 
 @cli.command()
 @util.pass_context
-def poweron(ctx):
-    ctx.vm.poweron()
+@click.option('--answer', type=click.Choice(sorted(sdk_util.answer_policies)),
+              help='How to answer questions asked by the VM while powering on. Default is to ask (or to pick the '
+                   'default answer when run by the agent). ')
+@click.option('--timeout', type=click.INT, help='Seconds to wait for the VM to power on. ')
+def poweron(ctx, answer, timeout):
+    if ctx.in_agent:
+        if answer == 'interactive':
+            raise click.UsageError("--answer interactive can't be used with the agent. ")
+        answer = answer or 'default'
+
+    ctx.vm.poweron(sdk_util.answer_policies[answer or 'interactive'], timeout, show_progress=True)
 
 @cli.command()
 @util.pass_context
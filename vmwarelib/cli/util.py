@@ -1,10 +1,83 @@
+import atexit
 
 import click
 
+from vmwarelib.sdk import cache
+from vmwarelib.sdk import core
+from vmwarelib.sdk import tracing
+
 class Context(object):
     def __init__(self):
         self.host = ""
+        self.server_host = ""
         self.username = ""
+        self.password = ""
+        self.ignore_cert_warnings = False
+        self.max_age = None
+        self.session_cache = False
+        self.profiler = None
+        # Set when run by the agent, which has no terminal and runs one
+        # command at a time.
+        self.in_agent = False
+        self._server = None
+        self._cache = None
 
-pass_context = click.make_pass_decorator(Context, ensure=True)
+    def _connect(self):
+        if not self.server_host or not self.username or not self.password:
+            raise Exception("server, user name, and password are required. ")
+
+        session_file = None
+        if self.session_cache:
+            session_file = core.default_session_file(self.server_host, self.username)
+
+        server = core.Server(self.server_host, self.username, self.password,
+                             ignore_cert_warnings=self.ignore_cert_warnings, session_file=session_file)
+        atexit.register(server.cleanup)
+
+        return server
+
+    @property
+    def server(self):
+        """Logs in on first use, so that commands answered from the
+        inventory cache don't pay for it.
+        """
+        if self._server is None:
+            self._server = self._connect()
+            if self.profiler:
+                self.profiler.attach(self._server.service_instance._stub)
+
+            # Servers kept by the agent may predate --trace.
+            tracing.instrument(self._server.service_instance._stub)
+
+        return self._server
 
+    @server.setter
+    def server(self, server):
+        self._server = server
+
+    def get_cache(self):
+        """Returns the inventory cache refreshed to be no older than
+        max_age, or None if caching is not enabled.
+        """
+        if self.max_age is None:
+            return None
+
+        # One connection per command, closed with it (the agent runs many
+        # commands in the same process).
+        if self._cache is None:
+            self._cache = cache.InventoryCache(self.server_host)
+            click.get_current_context().call_on_close(self._close_cache)
+
+        inventory_cache = self._cache
+        age = inventory_cache.age()
+        if age is None or age > self.max_age:
+            inventory_cache.refresh(self.server)
+
+        return inventory_cache
+
+    def _close_cache(self):
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+pass_context = click.make_pass_decorator(Context, ensure=True)
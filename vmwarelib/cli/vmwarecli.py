@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 #-*- mode: Python;-*-
 
-import atexit
 import json
 import logging
 import os
@@ -12,7 +11,8 @@ import traceback
 import click
 
 from vmwarelib.cli import util
-from vmwarelib.sdk import core
+from vmwarelib.sdk import profiling
+from vmwarelib.sdk import tracing
 
 cmd_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), 'commands'))
 
@@ -43,18 +43,45 @@ class MyCLI(click.MultiCommand):
 @click.option('--username', envvar="VMWARECLI_USERNAME", help='User name.')
 @click.option('--password', envvar="VMWARECLI_PASSWORD", help='Password.')
 @click.option('-k', is_flag=True, help='When set, certificate warnings are ignored. ')
+@click.option('--max-age', type=click.INT, envvar="VMWARECLI_MAX_AGE",
+              help='Answer read-only queries from the local inventory cache if it is not older than '
+                   'these many seconds. ')
+@click.option('--session-cache', is_flag=True, envvar="VMWARECLI_SESSION_CACHE",
+              help='Reuse the login session across invocations instead of logging in and out every time. ')
+@click.option('--profile', is_flag=True, envvar="VMWARECLI_PROFILE",
+              help='Print the number, latency, and size of SOAP calls made by the command to stderr. ')
+@click.option('--trace', type=click.Path(dir_okay=False), envvar="VMWARECLI_TRACE",
+              help='Append tracing spans of SDK operations and vSphere calls to this file as JSON lines '
+                   '(spans go to OpenTelemetry instead if a collector is configured). ')
 @util.pass_context
-def cli(ctx, server, username, password, k=False):
+def cli(ctx, server, username, password, k=False, max_age=None, session_cache=False, profile=False, trace=None):
     """vmwarecli is a command line tool for vSphere.
     """
 
     if not server or not username or not password:
         raise Exception("server, user name, and password are required. ")
 
-    # Login and store session instance.
-    ctx.server = core.Server(server, username, password, ignore_cert_warnings=k)
-
-    atexit.register(ctx.server.cleanup)
+    # Login happens when a command first uses ctx.server.
+    ctx.server_host = server
+    ctx.username = username
+    ctx.password = password
+    ctx.ignore_cert_warnings = k
+    ctx.max_age = max_age
+    ctx.session_cache = session_cache
+
+    if trace:
+        tracing.configure(path=trace)
+        # Tracing is per command, which matters in the agent where the
+        # process outlives the command.
+        click.get_current_context().call_on_close(tracing.shutdown)
+
+    if profile:
+        ctx.profiler = profiling.Profiler()
+        click.get_current_context().call_on_close(lambda: print_profile(ctx.profiler))
+
+def print_profile(profiler):
+    profiler.detach()
+    click.echo(profiler.report(), err=True)
 
 def init_logging():
     fd, logfile = tempfile.mkstemp(suffix='.txt', prefix='vmwarecli')
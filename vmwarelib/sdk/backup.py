@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import struct
+
+import requests
+
+from vmwarelib.sdk import bitmap
+from vmwarelib.sdk import util
+
+class BlockSource:
+    """Reads byte ranges of a disk. """
+
+    def read(self, offset, length):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FileBlockSource(BlockSource):
+    """Reads from a local raw disk image. """
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self):
+        self.f.close()
+
+class HttpRangeSource(BlockSource):
+    """Reads a file with HTTP Range requests, such as a flat disk file
+    served by the datastore /folder endpoint.
+    """
+
+    def __init__(self, url, params=None, auth=None, verify=False, session=None):
+        self.url = url
+        self.params = params
+        self.auth = auth
+        self.verify = verify
+        self.session = session or requests.Session()
+
+    @classmethod
+    def for_disk(cls, server, disk, datacenter_name):
+        """Returns a source reading the flat file of disk's backing through
+        vCenter. Delta (snapshot) backings are in a sparse format that can't
+        be read this way, so only disks without a parent backing qualify.
+        """
+        if getattr(disk.backing, 'parent', None):
+            raise Exception("Disk ({}) has a delta backing, only flat backings can be read over HTTP".format(
+                disk.backing.fileName))
+
+        dsname, filepath = util.parse_datastore_path(disk.backing.fileName)
+        if filepath.endswith(".vmdk") and not filepath.endswith("-flat.vmdk"):
+            filepath = filepath[:-len(".vmdk")] + "-flat.vmdk"
+
+        url, params = server.datastore_url(datacenter_name, dsname, filepath)
+
+        return cls(url, params=params, session=server.http_session)
+
+    def read(self, offset, length):
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + length - 1)}
+        resp = self.session.get(self.url, params=self.params, headers=headers, auth=self.auth, verify=self.verify)
+        if resp.status_code != 206:
+            raise Exception("Range request for ({}) failed with status {}".format(self.url, resp.status_code))
+
+        data = resp.content
+        if len(data) != length:
+            raise Exception("Expected {} bytes at offset {} of ({}), got {}".format(length, offset, self.url,
+                                                                                 len(data)))
+
+        return data
+
+    def close(self):
+        # Session may be shared (e.g. Server.http_session).
+        pass
+
+class SparseImageWriter:
+    """Writes changed areas into a raw image of the full disk. Unchanged
+    areas are never written, so the file stays sparse and an incremental
+    run on top of an earlier image brings it up to date. With full=True, an
+    existing image is emptied first so that no stale data is left in areas
+    the new backup doesn't write.
+    """
+
+    def __init__(self, path, capacity, full=False):
+        mode = "r+b" if os.path.exists(path) and not full else "w+b"
+        self.f = open(path, mode)
+        self.f.truncate(capacity)
+
+    def write(self, offset, data):
+        self.f.seek(offset)
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+DELTA_MAGIC = b"VMWLDLT1"
+DELTA_HEADER = struct.Struct("<8sQ")
+DELTA_RECORD = struct.Struct("<QQ")
+
+class DeltaFileWriter:
+    """Writes changed areas as a sequence of (offset, length, data) records
+    after a header holding the disk capacity.
+    """
+
+    def __init__(self, path, capacity):
+        self.f = open(path, "wb")
+        self.f.write(DELTA_HEADER.pack(DELTA_MAGIC, capacity))
+
+    def write(self, offset, data):
+        self.f.write(DELTA_RECORD.pack(offset, len(data)))
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+def copy_extents(changed, source, writer, chunk_size=4 * util.unit_m):
+    """Copies the areas in ExtentMap changed from source to writer, at most
+    chunk_size bytes at a time. Returns number of bytes copied.
+    """
+    copied = 0
+    for start, length in changed:
+        offset, end = start, start + length
+        while offset < end:
+            size = min(chunk_size, end - offset)
+            writer.write(offset, source.read(offset, size))
+            offset += size
+            copied += size
+
+    return copied
+
+class SnapshotBackup:
+    """Incremental backup of the disks of a VirtualMachineSnapshot into a
+    directory.
+
+    Each disk goes to <target_dir>/<disk uuid>.img (a sparse image updated
+    in place) or, with delta=True, to a new <disk uuid>-<n>.delta file. The
+    change ID of every disk is stored in changeids.json so that the next run
+    only copies what has changed since. source_factory(disk) returns the
+    BlockSource of a disk; by default disks are read through the datastore
+    HTTP endpoint. If bitmap_dir is given, the copied areas of every run
+    are also recorded in a ChangedBlockBitmap per disk there.
+    """
+
+    STATE_FILE = "changeids.json"
+
+    def __init__(self, server, snapshot, target_dir, source_factory=None, delta=False, chunk_size=4 * util.unit_m,
+                 max_workers=8, bitmap_dir=None):
+        self.server = server
+        self.snapshot = snapshot
+        self.target_dir = target_dir
+        self.source_factory = source_factory or self._http_source
+        self.delta = delta
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.bitmap_dir = bitmap_dir
+
+    def _http_source(self, disk):
+        from vmwarelib.sdk import core
+
+        vm = core.VirtualMachine(self.server, vmobj=self.snapshot.vmobj)
+        return HttpRangeSource.for_disk(self.server, disk, self.server.inventory.get_name(vm.datacenter))
+
+    def _load_state(self):
+        path = os.path.join(self.target_dir, self.STATE_FILE)
+        if not os.path.exists(path):
+            return {}
+
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        path = os.path.join(self.target_dir, self.STATE_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=2)
+
+        os.replace(path + ".tmp", path)
+
+    def _create_writer(self, disk, full):
+        if not self.delta:
+            return SparseImageWriter(os.path.join(self.target_dir, "{}.img".format(disk.uuid)),
+                                     disk.capacityInBytes, full)
+
+        n = 0
+        while os.path.exists(os.path.join(self.target_dir, "{}-{}.delta".format(disk.uuid, n))):
+            n += 1
+
+        return DeltaFileWriter(os.path.join(self.target_dir, "{}-{}.delta".format(disk.uuid, n)),
+                               disk.capacityInBytes)
+
+    def run(self, full=False):
+        """Backs up all disks and returns a dictionary of disk uuid to number
+        of bytes copied. With full=True, all allocated areas are copied.
+        """
+        os.makedirs(self.target_dir, exist_ok=True)
+        state = {} if full else self._load_state()
+
+        disks = self.snapshot.get_disks()
+        changeids = {disk.key: state.get(disk.uuid, "*") for disk in disks}
+        changed_areas = self.snapshot.get_all_changed_areas(changeids, max_workers=self.max_workers)
+
+        copied = {}
+        for disk in disks:
+            logging.info("Backing up disk ({}) from change ID ({}): {} bytes".format(
+                disk.uuid, changeids[disk.key], changed_areas[disk.key].total_bytes()))
+
+            source = self.source_factory(disk)
+            writer = self._create_writer(disk, full)
+            try:
+                copied[disk.uuid] = copy_extents(changed_areas[disk.key], source, writer, self.chunk_size)
+            finally:
+                writer.close()
+                source.close()
+
+            if self.bitmap_dir:
+                with bitmap.ChangedBlockBitmap.for_disk(self.bitmap_dir, disk) as disk_bitmap:
+                    disk_bitmap.record(disk.changeId, changed_areas[disk.key])
+
+            # Stored only after the disk is completely copied, so that a failed
+            # run is repeated from the same point.
+            state[disk.uuid] = disk.changeId
+            self._save_state(state)
+
+        return copied
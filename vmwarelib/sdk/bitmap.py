@@ -0,0 +1,182 @@
+import mmap
+import os
+import re
+import struct
+
+from vmwarelib.sdk import extents
+
+MAGIC = b"VMWLCBM1"
+HEADER = struct.Struct("<8sQQQQ")
+CHANGE_ID_SIZE = 128
+
+def _set_bits(mm, base, first, last):
+    """Sets bits first to last (inclusive) of the bitmap at offset base. """
+    first_byte, last_byte = first // 8, last // 8
+    first_mask = (0xff << (first % 8)) & 0xff
+    last_mask = 0xff >> (7 - last % 8)
+
+    if first_byte == last_byte:
+        mm[base + first_byte] |= first_mask & last_mask
+        return
+
+    mm[base + first_byte] |= first_mask
+    if last_byte - first_byte > 1:
+        mm[base + first_byte + 1:base + last_byte] = b"\xff" * (last_byte - first_byte - 1)
+    mm[base + last_byte] |= last_mask
+
+def _bit_runs(data):
+    """Yields (first, end) bit positions of runs of set bits. """
+    for m in re.finditer(b"[^\x00]+", data):
+        run_start = None
+        for i in range(m.start(), m.end()):
+            byte = data[i]
+            if byte == 0xff:
+                if run_start is None:
+                    run_start = i * 8
+                continue
+
+            for bit in range(8):
+                if byte >> bit & 1:
+                    if run_start is None:
+                        run_start = i * 8 + bit
+                elif run_start is not None:
+                    yield run_start, i * 8 + bit
+                    run_start = None
+
+        if run_start is not None:
+            yield run_start, m.end() * 8
+
+class ChangedBlockBitmap:
+    """Persistent, memory mapped record of changed blocks of one disk.
+
+    Every backup run adds a generation: a bitmap with one bit per
+    block_size bytes of the disk, tagged with the disk's change ID at the
+    time. Changes of many runs can then be combined (e.g. everything since
+    the last full backup) without keeping extent lists in memory; a 10 TB
+    disk takes 1.25 MB per generation at 1 MB granularity.
+    """
+
+    def __init__(self, path, capacity=None, block_size=1024 * 1024):
+        self.path = path
+
+        if os.path.exists(path):
+            self.f = open(path, "r+b")
+            magic, self.block_size, self.capacity, self.nbytes, self.generations = HEADER.unpack(
+                self.f.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception("Not a changed block bitmap file: ({})".format(path))
+
+            if capacity is not None and capacity != self.capacity:
+                raise Exception("Capacity of ({}) is {}, not {}".format(path, self.capacity, capacity))
+        else:
+            if capacity is None:
+                raise Exception("Capacity is required to create ({})".format(path))
+
+            self.block_size = block_size
+            self.capacity = capacity
+            self.nbytes = (-(-capacity // block_size) + 7) // 8
+            self.generations = 0
+
+            self.f = open(path, "w+b")
+            self._write_header()
+
+        self.mm = None
+        self._map()
+
+    @classmethod
+    def for_disk(cls, directory, disk, block_size=1024 * 1024):
+        """Returns the bitmap of a VirtualDisk, kept in directory by disk uuid. """
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, "{}.cbm".format(disk.uuid)), disk.capacityInBytes, block_size)
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, self.block_size, self.capacity, self.nbytes, self.generations))
+        self.f.flush()
+
+    def _map(self):
+        if self.mm is not None:
+            self.mm.close()
+
+        self.f.truncate(self._offset(self.generations))
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+
+    def _offset(self, generation):
+        return HEADER.size + generation * (CHANGE_ID_SIZE + self.nbytes)
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_change_id(self, generation):
+        offset = self._offset(generation)
+        return self.mm[offset:offset + CHANGE_ID_SIZE].rstrip(b"\x00").decode("utf-8")
+
+    def find_generation(self, change_id):
+        """Returns the latest generation recorded with change_id or None. """
+        for generation in reversed(range(self.generations)):
+            if self.get_change_id(generation) == change_id:
+                return generation
+
+        return None
+
+    def record(self, change_id, changed):
+        """ORs the extents of ExtentMap changed into the generation of
+        change_id, adding the generation if it is new. Returns generation.
+        """
+        generation = self.find_generation(change_id)
+        if generation is None:
+            encoded = change_id.encode("utf-8")
+            if len(encoded) > CHANGE_ID_SIZE:
+                raise Exception("Change ID is too long: ({})".format(change_id))
+
+            generation = self.generations
+            self.generations += 1
+            self._map()
+            self._write_header()
+
+            offset = self._offset(generation)
+            self.mm[offset:offset + CHANGE_ID_SIZE] = encoded.ljust(CHANGE_ID_SIZE, b"\x00")
+
+        base = self._offset(generation) + CHANGE_ID_SIZE
+        for start, length in changed:
+            end = min(start + length, self.capacity)
+            if start < end:
+                _set_bits(self.mm, base, start // self.block_size, (end - 1) // self.block_size)
+
+        return generation
+
+    def _get_bitmap(self, generation):
+        base = self._offset(generation) + CHANGE_ID_SIZE
+        return self.mm[base:base + self.nbytes]
+
+    def _combined(self, since):
+        combined = 0
+        for generation in range(since + 1, self.generations):
+            combined |= int.from_bytes(self._get_bitmap(generation), "little")
+
+        return combined
+
+    def dirty_since(self, generation=-1):
+        """Returns an ExtentMap of the blocks changed in the generations
+        after generation (all generations by default), clipped to capacity.
+        """
+        data = self._combined(generation).to_bytes(self.nbytes, "little")
+
+        result = extents.ExtentMap()
+        for first, end in _bit_runs(data):
+            start = first * self.block_size
+            result.append(start, min(end * self.block_size, self.capacity) - start)
+
+        return result
+
+    def count_since(self, generation=-1):
+        """Number of blocks changed in the generations after generation. """
+        return bin(self._combined(generation)).count("1")
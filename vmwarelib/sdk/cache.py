@@ -0,0 +1,205 @@
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from vmwarelib.sdk import inventory
+
+# Column name and the property path it is collected from.
+COLUMNS = [
+    ("name", "name"),
+    ("parent", "parent"),
+    ("uuid", "config.uuid"),
+    ("instance_uuid", "config.instanceUuid"),
+    ("ip", "summary.guest.ipAddress"),
+    ("power_state", "runtime.powerState"),
+    ("host", "runtime.host"),
+]
+
+CachedVM = collections.namedtuple("CachedVM", ["moref", "name", "uuid", "instance_uuid", "ip", "inventory_path",
+                                               "power_state", "host"])
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "vmwarelib")
+
+class _CacheCollector(inventory.ViewCollector):
+    TYPE_PATHS = {
+        vim.Folder: ['name', 'parent'],
+        vim.Datacenter: ['name', 'parent'],
+        vim.HostSystem: ['name', 'parent'],
+        vim.VirtualMachine: [path for _, path in COLUMNS],
+    }
+
+    def __init__(self, service_instance):
+        super().__init__(service_instance, self.TYPE_PATHS)
+
+        self.types = {}
+        self.dirty = set()
+
+    def resume(self, collector_moref, view_moref, version, rows):
+        """Continues from a collector created by an earlier process in the
+        same (reused) session.
+        """
+        stub = self.service_instance._stub
+        self._collector = vmodl.query.PropertyCollector(collector_moref, stub)
+        self._view = vim.view.ContainerView(view_moref, stub)
+        self.version = version
+
+        for row in rows:
+            moref = row["moref"]
+            self.types[moref] = row["type"]
+            self.props[moref] = {path: row[column] for column, path in COLUMNS if row[column] is not None}
+
+    def changed(self, kind, obj, names):
+        moref = obj._moId
+        self.types[moref] = obj._wsdlName
+        self.dirty.add(moref)
+
+class InventoryCache:
+    """On-disk (SQLite) cache of VM identity, placement and power state for
+    one vCenter. Read-only commands can be answered from it without logging
+    in. refresh() only transfers the changes since the previous refresh when
+    the PropertyCollector that produced the stored version is still alive,
+    which is the case when the login session is reused.
+    """
+
+    def __init__(self, server_host, path=None):
+        self.server_host = server_host
+        self.path = path or os.path.join(default_cache_dir(), "{}.sqlite".format(server_host))
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entities (moref TEXT PRIMARY KEY, type TEXT, {})".format(
+                ", ".join("{} TEXT".format(column) for column, _ in COLUMNS)))
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entities_ip ON entities (ip)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entities_uuid ON entities (uuid)")
+
+    def close(self):
+        self.conn.close()
+
+    def _get_meta(self):
+        return {row["key"]: row["value"] for row in self.conn.execute("SELECT key, value FROM meta")}
+
+    def age(self):
+        """Seconds since the last refresh or None if never refreshed. """
+        refreshed_at = self._get_meta().get("refreshed_at")
+        if refreshed_at is None:
+            return None
+
+        return time.time() - float(refreshed_at)
+
+    def refresh(self, server):
+        meta = self._get_meta()
+
+        collector = None
+        if meta.get("collector") and meta.get("version") is not None:
+            collector = _CacheCollector(server.service_instance)
+            collector.resume(meta["collector"], meta["view"], meta["version"],
+                             self.conn.execute("SELECT * FROM entities").fetchall())
+            try:
+                collector.sync()
+            except Exception:
+                # Collector went away with the old session or the version is
+                # no longer valid. Start over.
+                logging.info("Could not resume inventory cache collector, doing full refresh", exc_info=True)
+                try:
+                    collector.destroy()
+                except Exception:
+                    pass
+
+                collector = None
+
+        full = collector is None
+        if full:
+            collector = _CacheCollector(server.service_instance)
+            collector.sync()
+
+        self._store(collector, full)
+
+    def _store(self, collector, full):
+        with self.conn:
+            if full:
+                self.conn.execute("DELETE FROM entities")
+
+            for moref in collector.dirty:
+                props = collector.props.get(moref)
+                if props is None:
+                    self.conn.execute("DELETE FROM entities WHERE moref = ?", (moref,))
+                    continue
+
+                values = []
+                for _, path in COLUMNS:
+                    value = props.get(path)
+                    if hasattr(value, "_moId"):
+                        value = value._moId
+                    values.append(value)
+
+                self.conn.execute("INSERT OR REPLACE INTO entities VALUES ({})".format(
+                    ", ".join("?" * (len(COLUMNS) + 2))), [moref, collector.types[moref]] + values)
+
+            # Collector is left alive on the server so that next refresh
+            # in the same session only fetches the changes.
+            meta = {"collector": collector._collector._moId, "view": collector._view._moId,
+                    "version": collector.version, "refreshed_at": str(time.time())}
+            self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+
+    def _get_folders(self):
+        rows = self.conn.execute("SELECT moref, name, parent FROM entities WHERE type IN ('Folder', 'Datacenter')")
+        return {row["moref"]: (row["name"], row["parent"]) for row in rows}
+
+    def _get_inventory_path(self, name, parent, folders):
+        comps = [name]
+        while parent in folders:
+            folder_name, parent = folders[parent]
+            # Root folder is not part of the inventory path.
+            if parent is None:
+                break
+
+            comps.append(folder_name)
+
+        return '/'.join(reversed(comps))
+
+    def list_vms(self, pat=None):
+        folders = self._get_folders()
+        hosts = {row["moref"]: row["name"]
+                 for row in self.conn.execute("SELECT moref, name FROM entities WHERE type = 'HostSystem'")}
+
+        query = "SELECT * FROM entities WHERE type = 'VirtualMachine'"
+        params = []
+        if pat:
+            # Plain substring match like Server.list_vms (LIKE would take _
+            # and % as wildcards).
+            query += " AND instr(lower(name), ?) > 0"
+            params.append(pat.lower())
+
+        for row in self.conn.execute(query + " ORDER BY name", params):
+            yield CachedVM(row["moref"], row["name"], row["uuid"], row["instance_uuid"], row["ip"],
+                           self._get_inventory_path(row["name"], row["parent"], folders), row["power_state"],
+                           hosts.get(row["host"]))
+
+    def find_vm(self, identity):
+        """Returns moref of the VM matching identity or None. """
+        if identity.get("ip", None):
+            row = self.conn.execute("SELECT moref FROM entities WHERE type = 'VirtualMachine' AND ip = ?",
+                                    (identity["ip"],)).fetchone()
+            return row["moref"] if row else None
+
+        if identity.get("uuid", None):
+            row = self.conn.execute("SELECT moref FROM entities WHERE type = 'VirtualMachine' AND uuid = ?",
+                                    (identity["uuid"],)).fetchone()
+            return row["moref"] if row else None
+
+        if identity.get("ipath", None):
+            for vm in self.list_vms():
+                if vm.inventory_path == identity["ipath"]:
+                    return vm.moref
+
+        return None
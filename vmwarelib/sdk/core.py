@@ -1,51 +1,489 @@
 
 import collections
+import concurrent.futures
+import fnmatch
+import json
 import logging
-import re
+import os
+import ssl
 #from typing import Dict, Tuple, List
 import urllib3
 import datetime
 
 from pyVim import connect as vim_connect
+from pyVmomi import SoapStubAdapter
 from pyVmomi import vim
+from pyVmomi import vmodl
 
-import requests
+import threading
 import time
 
+from vmwarelib.sdk import extents
+from vmwarelib.sdk import inventory
+from vmwarelib.sdk import parallel
+from vmwarelib.sdk import perf
+from vmwarelib.sdk import tasks
+from vmwarelib.sdk import tracing
+from vmwarelib.sdk import transfer
 from vmwarelib.sdk import util
 
 urllib3.disable_warnings()
 
+def default_session_file(host, username):
+    return os.path.join(os.path.expanduser("~"), ".cache", "vmwarelib", "sessions", "{}@{}".format(username, host))
+
+@tracing.trace_methods
+def get_current_session(service_instance):
+    """Returns the UserSession of service_instance's connection or None if
+    it is not logged in (any more).
+    """
+    # Session manager moref differs between vCenter and ESXi, so it is
+    # read from the service content.
+    try:
+        return service_instance.content.sessionManager.currentSession
+    except vmodl.MethodFault:
+        # NotAuthenticated mostly, but the session may not be usable for
+        # other reasons either.
+        logging.debug("Could not read current session", exc_info=True)
+        return None
+
 class Server:
-    def __init__(self, host, username, password, ignore_cert_warnings=False):
+    def __init__(self, host, username, password, ignore_cert_warnings=False, session_file=None,
+                 service_instance=None):
+        """If session_file is given, the login session is saved there and
+        reused by later Server objects (in this or other processes) until
+        it expires. The session is then not logged out by cleanup().
+
+        service_instance can be an existing connection (or a stand-in for
+        one, see benchmarks/fakevim.py) to use instead of logging in. It is
+        not logged out by cleanup() either.
+        """
         self.host = host
         self.username = username
         self.password = password
+        self.ignore_cert_warnings = ignore_cert_warnings
+        self.session_file = session_file
+        self._logout = session_file is None and service_instance is None
+
+        self.service_instance = service_instance
+        if self.service_instance is None and session_file:
+            self.service_instance = self._resume_session()
+
+        if self.service_instance is None:
+            conn_func = vim_connect.SmartConnect
+            if ignore_cert_warnings:
+                conn_func = vim_connect.SmartConnectNoSSL
+
+            logging.info("Connecting to vSphere server {}, user: {}".format(host, username))
+            self.service_instance = conn_func(host=host, user=username, pwd=password)
+
+            if session_file:
+                self._save_session()
+
+        tracing.instrument(self.service_instance._stub)
+
+        # Inventory index is synced with the server when it is older than
+        # this many seconds.
+        self.inventory_max_age = 5
+        self._inventory = None
+        self.mirror = None
+        self._task_watcher = None
+        self._http_session = None
+        self._lock = threading.Lock()
+
+        # Datastore listings by (datastore moref, path, pattern, recursive).
+        self.browse_cache = util.TTLCache(ttl=60)
+
+        # Device lists of VMs by moref, as (config.changeVersion, devices).
+        self._devices = {}
+
+        self._perf_counters = None
+
+    @property
+    def http_session(self):
+        """Pooled requests.Session authenticated with the vSphere session
+        cookie, for the datastore HTTP endpoints.
+        """
+        with self._lock:
+            if self._http_session is None:
+                self._http_session = transfer.create_session(self.service_instance._stub.cookie)
+
+            return self._http_session
+
+    def datastore_url(self, datacenter_name, dsname, path):
+        """Returns URL and query parameters of a datastore file. """
+        url = "https://{}/folder/{}".format(self.host, path.lstrip('/'))
+        params = {'dcPath': datacenter_name, 'dsName': dsname}
+
+        return url, params
+
+    def download_file(self, datacenter_name, dsname, path, local_path, **kwargs):
+        """Downloads a datastore file. See transfer.download() for the
+        streaming, resume and segmented download options.
+        """
+        url, params = self.datastore_url(datacenter_name, dsname, path)
+        return transfer.download(self.http_session, url, local_path, params=params, **kwargs)
+
+    def upload_files(self, datacenter_name, dsname, files, connections=4, chunk_size=util.unit_m, progress=None):
+        """Uploads (local_path, path) pairs of files to a datastore, up to
+        connections files at a time. Returns number of bytes uploaded.
+        """
+        entries = []
+        for local_path, path in files:
+            url, params = self.datastore_url(datacenter_name, dsname, path)
+            entries.append((local_path, url, params))
+
+        return transfer.upload_many(self.http_session, entries, connections, chunk_size, progress)
+
+    @property
+    def perf_counters(self):
+        """CounterTable of the performance counters of the server. """
+        with self._lock:
+            if self._perf_counters is None:
+                self._perf_counters = perf.CounterTable(self.service_instance.content.perfManager)
+
+            return self._perf_counters
+
+    def get_host_perf_stats(self, hosts, counters, interval=perf.REALTIME_INTERVAL, window=300, instance=""):
+        """Returns samples of counters for many hosts (VmwareHost objects)
+        with one query, as a dictionary of host name to PerfSamples. See
+        perf.query_perf().
+        """
+        results = perf.query_perf(self, [host.hostobj for host in hosts], counters, interval, window, instance)
+
+        return collections.OrderedDict((host.name, results[host.moref]) for host in hosts)
 
-        conn_func = vim_connect.SmartConnect
-        if ignore_cert_warnings:
-            conn_func = vim_connect.SmartConnectNoSSL
+    @property
+    def task_watcher(self):
+        """TaskWatcher shared by all operations on this server. """
+        with self._lock:
+            if self._task_watcher is None:
+                self._task_watcher = tasks.TaskWatcher(self.service_instance)
 
-        logging.info("Connecting to vSphere server {}, user: {}".format(host, username))
-        self.service_instance = conn_func(host=host, user=username, pwd=password)
+            return self._task_watcher
+
+    def submit_task(self, task):
+        """Returns a concurrent.futures.Future for the TaskInfo of task. """
+        return self.task_watcher.submit(task)
+
+    def wait_for_tasks(self, tasks, timeout=None):
+        """Waits for tasks and returns their TaskInfo objects. """
+        tracing.set_attribute("vmware.task.keys", [task._moId for task in tasks])
+        task_infos = self.task_watcher.wait(tasks, timeout)
+        tracing.record_tasks(task_infos)
+
+        return task_infos
+
+    def start_mirror(self, max_staleness=30):
+        """Starts an InventoryMirror that serves VM listing and lookups as
+        well as host datastores without going to vCenter. Results are at
+        most max_staleness seconds old.
+        """
+        if self.mirror is None:
+            self.mirror = inventory.InventoryMirror(self.service_instance, max_staleness=max_staleness)
+            self.mirror.start()
+
+        return self.mirror
+
+    def stop_mirror(self):
+        if self.mirror is not None:
+            self.mirror.stop()
+            self.mirror = None
+
+    def fresh_mirror(self):
+        """Returns the mirror if it is running and current, None otherwise. """
+        if self.mirror is not None and self.mirror.is_fresh():
+            return self.mirror
+
+        return None
+
+    @property
+    def inventory(self):
+        """Shared InventoryIndex of all folders and datacenters. """
+        mirror = self.fresh_mirror()
+        if mirror is not None:
+            return mirror
+
+        if self._inventory is None:
+            self._inventory = inventory.InventoryIndex(self.service_instance)
+
+        self._inventory.sync_if_older(self.inventory_max_age)
+
+        return self._inventory
+
+    def _resume_session(self):
+        try:
+            with open(self.session_file) as f:
+                session = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if session.get("host") != self.host or session.get("username") != self.username:
+            return None
+
+        ssl_context = ssl._create_unverified_context() if self.ignore_cert_warnings else None
+        stub = SoapStubAdapter(host=self.host, port=443, path='/sdk', version=session["version"],
+                               sslContext=ssl_context)
+        stub.cookie = session["cookie"]
+
+        service_instance = vim.ServiceInstance('ServiceInstance', stub)
+        if get_current_session(service_instance) is None:
+            logging.info("Saved session for {} on {} has expired".format(self.username, self.host))
+            return None
+
+        logging.info("Reusing session of {} on vSphere server {}".format(self.username, self.host))
+        return service_instance
+
+    def _save_session(self):
+        stub = self.service_instance._stub
+        session = {"host": self.host, "username": self.username, "version": stub.version, "cookie": stub.cookie}
+
+        os.makedirs(os.path.dirname(self.session_file), mode=0o700, exist_ok=True)
+        fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(session, f)
 
     def cleanup(self):
         logging.debug("Cleaning up connection to vSphere server {}...".format(self.host))
-        vim_connect.Disconnect(self.service_instance)
+        self.stop_mirror()
+        if self._task_watcher is not None:
+            self._task_watcher.stop()
 
-    def list_vms(self, pat):
-        content = self.service_instance.RetrieveContent()
+        # Saved sessions are left logged in for reuse.
+        if self._logout:
+            vim_connect.Disconnect(self.service_instance)
 
-        container = content.rootFolder
-        viewType = [vim.VirtualMachine]
-        recursive = True
-        containerView = content.viewManager.CreateContainerView(container, viewType, recursive)
+    def get_vm_properties(self, path_set, pat=None, page_size=1000):
+        """Yields (vmobj, properties) for all VMs whose name contains pat.
 
-        children = containerView.view
-        for vm in children:
-            vm_name = vm.summary.config.name
+        Only the requested property paths are fetched, for all VMs at once
+        and in pages of page_size.
+        """
+        path_set = list(path_set)
+        if 'name' not in path_set:
+            path_set.append('name')
+
+        for vmobj, props in util.collect_properties(self.service_instance, vim.VirtualMachine, path_set,
+                                                    page_size=page_size):
+            vm_name = props.get('name') or ''
             if not pat or vm_name.lower().find(pat.lower()) != -1:
-                yield VirtualMachine(self, vmobj=vm)
+                yield vmobj, props
+
+    def get_devices(self, vmobj):
+        """Returns config.hardware.device of vmobj.
+
+        The list is cached per VM along with config.changeVersion, which
+        changes with every reconfiguration. A cached list is revalidated by
+        retrieving only the change version, the devices are retrieved again
+        only if it differs.
+        """
+        cached = self._devices.get(vmobj._moId)
+        if cached:
+            _, props = util.fetch_properties(self.service_instance, [vmobj], vim.VirtualMachine,
+                                             ['config.changeVersion'])[0]
+            if props.get('config.changeVersion') == cached[0]:
+                return cached[1]
+
+        _, props = util.fetch_properties(self.service_instance, [vmobj], vim.VirtualMachine,
+                                         ['config.changeVersion', 'config.hardware.device'])[0]
+        devices = props.get('config.hardware.device') or []
+        self._devices[vmobj._moId] = (props.get('config.changeVersion'), devices)
+
+        return devices
+
+    def forget_devices(self, vmobj):
+        self._devices.pop(vmobj._moId, None)
+
+    def get_vm(self, moref):
+        """Returns VirtualMachine for a known moref without a lookup. """
+        return VirtualMachine(self, vmobj=vim.VirtualMachine(moref, self.service_instance._stub))
+
+    def list_vms(self, pat, properties=()):
+        """Yields VirtualMachine objects for VMs whose name contains pat.
+
+        The given property paths (and the name) are retrieved for all VMs
+        in bulk and handed to the objects, so reading them later costs no
+        round trips.
+        """
+        mirror = self.fresh_mirror()
+        vm_paths = inventory.InventoryMirror.TYPE_PATHS[vim.VirtualMachine]
+        if mirror is not None and all(path in vm_paths for path in properties):
+            for vmobj in mirror.get_objects(vim.VirtualMachine):
+                props = mirror.get_properties(vmobj)
+                if props is None:
+                    continue
+
+                vm_name = props.get('name') or ''
+                if not pat or vm_name.lower().find(pat.lower()) != -1:
+                    yield VirtualMachine(self, vmobj=vmobj, properties=props)
+
+            return
+
+        for vmobj, props in self.get_vm_properties(properties, pat):
+            yield VirtualMachine(self, vmobj=vmobj, properties=props)
+
+    def prefetch_vms(self, vms, path_set):
+        """Loads the given property paths of all vms in one call. """
+        vms = [vm for vm in vms if not all(vm._lookup_cached(path)[0] for path in path_set)]
+        result = util.fetch_properties(self.service_instance, [vm.vmobj for vm in vms], vim.VirtualMachine,
+                                       path_set)
+        props_by_moref = {obj._moId: props for obj, props in result}
+        for vm in vms:
+            props = props_by_moref.get(vm.vmobj._moId, {})
+            for path in path_set:
+                vm._props[path] = props.get(path, None)
+
+    def _run_power_operation(self, vms, func, target_state, max_workers, per_host, per_datastore, retries):
+        vms = list(vms)
+        self.prefetch_vms(vms, ['runtime.powerState', 'runtime.host', 'datastore'])
+
+        limits = []
+        if per_host:
+            limits.append((lambda vm: [vm._get_property('runtime.host')._moId]
+                           if vm._get_property('runtime.host') else [], per_host))
+        if per_datastore:
+            limits.append((lambda vm: [ds._moId for ds in vm._get_property('datastore') or []], per_datastore))
+
+        todo = []
+        for vm in vms:
+            if vm._get_property('runtime.powerState') == target_state:
+                yield vm, None
+            else:
+                todo.append(vm)
+
+        for vm, _, error in parallel.run_parallel(todo, func, max_workers=max_workers, limits=limits,
+                                                  retries=retries):
+            yield vm, error
+
+    def power_on_many(self, vms, answer=util.answer_default, timeout=None, max_workers=16, per_host=4,
+                      per_datastore=8, retries=2):
+        """Powers on vms in parallel and yields (vm, error) as each one
+        finishes (error is None on success). At most max_workers power
+        operations run at once, and at most per_host on one host and
+        per_datastore on one datastore. VMs that are already powered on are
+        reported right away.
+        """
+        func = lambda vm: vm.poweron(answer, timeout)
+        return self._run_power_operation(vms, func, vim.VirtualMachinePowerState.poweredOn, max_workers,
+                                         per_host, per_datastore, retries)
+
+    def power_off_many(self, vms, max_workers=16, per_host=4, per_datastore=8, retries=2):
+        """Powers off vms in parallel. See power_on_many(). """
+        func = lambda vm: vm.poweroff()
+        return self._run_power_operation(vms, func, vim.VirtualMachinePowerState.poweredOff, max_workers,
+                                         per_host, per_datastore, retries)
+
+    def snapshot_group(self, vms, name, description="", memory=False, quiesce=True, parallelism=16):
+        """Snapshots all vms with up to parallelism snapshot tasks running
+        at once and returns the VirtualMachineSnapshot objects.
+
+        If any snapshot fails, no more are started, the snapshots already
+        taken are removed and an exception is raised, so either all VMs have
+        the snapshot or none.
+        """
+        pending = collections.deque(vms)
+        running = {}
+        snapshots = []
+        errors = []
+
+        while pending or running:
+            while pending and len(running) < parallelism and not errors:
+                vm = pending.popleft()
+                try:
+                    task = vm.vmobj.CreateSnapshot_Task(name=name, description=description, memory=memory,
+                                                        quiesce=quiesce)
+                except Exception as e:
+                    errors.append((vm, e))
+                    break
+
+                running[self.submit_task(task)] = vm
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                vm = running.pop(future)
+                try:
+                    task_info = future.result()
+                except Exception as e:
+                    errors.append((vm, e))
+                    continue
+
+                vm.invalidate()
+                snapshots.append(VirtualMachineSnapshot(self, vm.vmobj, name, snapobj=task_info.result))
+
+        if errors:
+            logging.info("Snapshot group ({}) failed, removing {} snapshot(s)...".format(name, len(snapshots)))
+            try:
+                self.wait_for_tasks([snap.snapobj.RemoveSnapshot_Task(removeChildren=False) for snap in snapshots])
+            except Exception:
+                logging.exception("Could not remove all snapshots of group ({})".format(name))
+
+            raise Exception("Could not create snapshot ({}) of: {}".format(
+                name, ", ".join("{} ({})".format(vm.name, e) for vm, e in errors)))
+
+        return snapshots
+
+    def browse_datastores(self, datastores, pattern=None, recursive=True, parallelism=8, cache_ttl=None):
+        """Searches many datastores at once and yields (datastore, files)
+        for every folder as its search finishes (so there can be many for
+        one datastore). See Datastore.browse().
+        """
+        if not cache_ttl:
+            for ds, files in self.search_folders([(ds, "") for ds in datastores], pattern, recursive, parallelism):
+                yield ds, files
+
+            return
+
+        func = lambda ds: list(ds.browse("", pattern, recursive, cache_ttl))
+        for ds, files, error in parallel.run_parallel(datastores, func, max_workers=parallelism):
+            if error:
+                raise error
+
+            yield ds, files
+
+    def search_folders(self, roots, pattern=None, recursive=True, parallelism=4):
+        """Lists the (datastore, path) folders of roots and, if recursive,
+        all folders below them, breadth first. Every folder is one
+        SearchDatastore_Task, at most parallelism of them at a time through
+        the task watcher. Yields (datastore, files) for a folder as soon as
+        its search finishes, so only folders being searched are held in
+        memory.
+        """
+        pending = collections.deque((ds, path, True) for ds, path in roots)
+        running = {}
+
+        while pending or running:
+            while pending and len(running) < parallelism:
+                ds, path, is_root = pending.popleft()
+                # Subfolders have to be seen to be searched, so a pattern is
+                # applied here when recursing.
+                task = ds.start_search(path, None if recursive else pattern)
+                running[self.submit_task(task)] = (ds, path, is_root)
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                ds, path, is_root = running.pop(future)
+                try:
+                    task_info = future.result()
+                except vim.fault.FileNotFound:
+                    if is_root:
+                        raise
+
+                    # Removed since its parent was searched.
+                    logging.info("Folder ({}) of datastore ({}) is gone".format(path, ds.name))
+                    continue
+
+                files = []
+                for f in ds.to_files([task_info.result]):
+                    if recursive and f.type == 'FolderFileInfo':
+                        pending.append((ds, f.path, False))
+
+                    if not recursive or not pattern or fnmatch.fnmatchcase(f.name, pattern):
+                        files.append(f)
+
+                yield ds, files
 
     def create_dummy_vm(self, vmname, datastore, datacentername, hostname, memory, cpus):
         content = self.service_instance.RetrieveContent()
@@ -81,12 +519,11 @@ class Server:
 
         task = vmfolder.CreateVM_Task(config=config, pool=resource_pool)
 
-        result = util.wait_for_tasks(self.service_instance, [task])
+        task_info, = self.wait_for_tasks([task])
 
-        vmresult = result[task.info.key].info.result
-        uuid = result[task.info.key].info.result.config.uuid
+        vmresult = task_info.result
 
-        util.add_scsi_controller(self.service_instance, vmresult)
+        util.add_scsi_controller(self.service_instance, vmresult, wait=self.wait_for_tasks)
 
         vm_obj = VirtualMachine(self, vmobj=vmresult)
         vm_obj.add_disk(size_gb=2)
@@ -97,7 +534,7 @@ class Server:
 
         vm = util.find_vmobj(service_instance=self.service_instance, identity=identity)
         task = vm.Destroy_Task()
-        util.wait_for_tasks(self.service_instance, [task])
+        self.wait_for_tasks([task])
 
     def get_obj(self, content, vimtype, name):
         """
@@ -172,10 +609,10 @@ class Server:
 
             print("cloning VM...")
             task = template.Clone(folder=vmfolder, name=vmname, spec=clonespec)
-            result = util.wait_for_tasks(self.service_instance, [task])
+            task_info, = self.wait_for_tasks([task])
 
-            vmresult = result[task.info.key].info.result
-            uuid = result[task.info.key].info.result.config.uuid
+            vmresult = task_info.result
+            uuid = vmresult.config.uuid
             print(uuid)
 
             # wait for OS to come up and get guestOS IP.
@@ -208,6 +645,7 @@ def get_root_backing(backing):
 
         backing = backing.parent
 
+@tracing.trace_methods
 class VirtualDisk:
     def __init__(self, server, deviceobj, vmobj, snapobj=None):
         self.server = server
@@ -221,10 +659,17 @@ class VirtualDisk:
         self.backing_type = type(deviceobj.backing).__name__
         self.uuid = self.deviceobj.backing.uuid
         self.backing = deviceobj.backing
-        self.root_backing = get_root_backing(self.backing)
+        self._root_backing = None
         self.changeId = self.backing.changeId
         self.capacityInBytes = self.deviceobj.capacityInBytes
 
+    @property
+    def root_backing(self):
+        if self._root_backing is None:
+            self._root_backing = get_root_backing(self.backing)
+
+        return self._root_backing
+
     def info(self):
         data = collections.OrderedDict()
 
@@ -252,76 +697,317 @@ class VirtualDisk:
 
             yield [(x.start, x.length) for x in disk_change_info.changedArea]
 
+    def get_changed_extents(self, changeid="*", start=0, end=None):
+        """Returns changed areas since changeid as an ExtentMap. Only the
+        byte range from start to end (capacity by default) is queried.
+        """
+        if not self.snapobj:
+            raise Exception("Disk needs to be from Snapshot. ")
+
+        if end is None or end > self.capacityInBytes:
+            end = self.capacityInBytes
+
+        result = extents.ExtentMap()
+
+        offset = start
+        while offset < end:
+            disk_change_info = self.vmobj.QueryChangedDiskAreas(self.snapobj, self.key, offset, changeid)
+            offset = disk_change_info.startOffset + disk_change_info.length
+
+            for area in disk_change_info.changedArea or []:
+                area_start = max(area.start, start)
+                area_end = min(area.start + area.length, end)
+                if area_start < area_end:
+                    result.append(area_start, area_end - area_start)
+
+        return result
+
     def delete(self):
-        util.delete_disk(self.server.service_instance, self.vmobj, self.deviceobj)
+        util.delete_disk(self.server.service_instance, self.vmobj, self.deviceobj, wait=self.server.wait_for_tasks)
 
     def resize(self, size_gb):
-        util.resize_disk(self.server.service_instance, self.vmobj, self.deviceobj, size_gb)
+        util.resize_disk(self.server.service_instance, self.vmobj, self.deviceobj, size_gb,
+                         wait=self.server.wait_for_tasks)
+
+class SnapshotNode:
+    """One snapshot of a SnapshotTree, with links to its parent and children. """
+
+    def __init__(self, tree, tree_info, parent):
+        self.snapobj = tree_info.snapshot
+        self.moref = tree_info.snapshot._moId
+        self.name = tree_info.name
+        self.description = tree_info.description
+        self.id = tree_info.id
+        self.create_time = tree_info.createTime
+        self.state = tree_info.state
+        self.quiesced = tree_info.quiesced
+        self.parent = parent
+        self.children = []
+        self.is_current = tree.current_moref == self.moref
+
+    def __repr__(self):
+        return "SnapshotNode({}, {})".format(self.name, self.moref)
+
+class SnapshotTree:
+    """Index of the snapshots of a VM built from its 'snapshot' property
+    (vim.vm.SnapshotInfo) in one pass, so that snapshots can be looked up
+    by name, moref or id without walking the tree every time.
+
+    Snapshot names need not be unique. Looking up a name that more than one
+    snapshot has raises an exception; use get() with a moref or get_by_id()
+    in that case.
+    """
+
+    def __init__(self, snap_info):
+        self.current_moref = snap_info.currentSnapshot._moId if snap_info and snap_info.currentSnapshot else None
+        self.roots = []
+        self.nodes = []
+        self.by_moref = {}
+        self.by_id = {}
+        self.by_name = collections.defaultdict(list)
+
+        # Iterative pre-order walk, same order as the recursive one.
+        stack = [(tree_info, None) for tree_info in reversed(snap_info.rootSnapshotList)] if snap_info else []
+        while stack:
+            tree_info, parent = stack.pop()
+            node = SnapshotNode(self, tree_info, parent)
+            if parent:
+                parent.children.append(node)
+            else:
+                self.roots.append(node)
 
-def _get_snapshot_with_name(snap, name):
-    if snap.name == name:
-        return snap.snapshot
+            self.nodes.append(node)
+            self.by_moref[node.moref] = node
+            self.by_id[node.id] = node
+            self.by_name[node.name].append(node)
 
-    if snap.childSnapshotList:
-        for child in snap.childSnapshotList:
-            result = _get_snapshot_with_name(child, name)
-            if result: return result
+            for child in reversed(tree_info.childSnapshotList or []):
+                stack.append((child, node))
 
-    return None
+    def __len__(self):
+        return len(self.nodes)
 
-# Note that snapshot names need not be unique so it is possible to have
-# more than one snapshot with same name. Until a better way is found to
-# identify a snapshot, we will look up with name. So to use this method,
-# there should not be multiple snapshots with same name.
-def get_snapshot_with_name(name, vmobj):
-    if not vmobj.snapshot:
-        raise Exception("No snapshot was found with name ({})".format(name))
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def get(self, moref):
+        if moref not in self.by_moref:
+            raise Exception("No snapshot was found with moref ({})".format(moref))
+
+        return self.by_moref[moref]
+
+    def get_by_id(self, snapshot_id):
+        if snapshot_id not in self.by_id:
+            raise Exception("No snapshot was found with id ({})".format(snapshot_id))
 
-    for snap in vmobj.snapshot.rootSnapshotList:
-        result = _get_snapshot_with_name(snap, name)
-        if result:
-            return result
+        return self.by_id[snapshot_id]
 
-    raise Exception("No snapshot was found with name ({})".format(name))
+    def get_by_name(self, name):
+        nodes = self.by_name.get(name, [])
+        if not nodes:
+            raise Exception("No snapshot was found with name ({})".format(name))
 
+        if len(nodes) > 1:
+            raise Exception("There are {} snapshots with name ({}): {}".format(
+                len(nodes), name, ", ".join(node.moref for node in nodes)))
+
+        return nodes[0]
+
+    def get_current(self):
+        return self.by_moref.get(self.current_moref)
+
+    def by_create_time(self):
+        """Returns all snapshots, oldest first. """
+        return sorted(self.nodes, key=lambda node: node.create_time)
+
+    def get_ancestors(self, node):
+        """Returns the parents of node, closest first. """
+        ancestors = []
+        while node.parent:
+            node = node.parent
+            ancestors.append(node)
+
+        return ancestors
+
+# Snapshot names need not be unique, so this fails if more than one
+# snapshot has the given name.
+def get_snapshot_with_name(name, vmobj):
+    return SnapshotTree(vmobj.snapshot).get_by_name(name).snapobj
+
+DatastoreFile = collections.namedtuple("DatastoreFile", ["path", "name", "size", "modified", "type"])
+
+@tracing.trace_methods
 class Datastore:
-    def __init__(self, server, hostobj, dsobj):
+    def __init__(self, server, hostobj, dsobj, properties=None):
         self.server = server
         self.hostobj = hostobj
         self.dsobj = dsobj
 
-        self.name = self.dsobj.name
-        self.dstype = self.dsobj.summary.type
+        if properties:
+            self.name = properties['name']
+            self.dstype = properties.get('summary.type')
+        else:
+            self.name = self.dsobj.name
+            self.dstype = self.dsobj.summary.type
+
+        self._datacenter_name = None
+
+    @property
+    def datacenter_name(self):
+        if self._datacenter_name is None:
+            datacenter = self.server.inventory.find_ancestor(self.dsobj.parent, vim.Datacenter)
+            if datacenter is None:
+                raise Exception("Could not find datacenter of datastore ({})".format(self.name))
+
+            self._datacenter_name = self.server.inventory.get_name(datacenter)
+
+        return self._datacenter_name
+
+    def download(self, path, local_path, **kwargs):
+        """Downloads file at path (relative to the datastore root). See
+        transfer.download() for the options.
+        """
+        return self.server.download_file(self.datacenter_name, self.name, path, local_path, **kwargs)
+
+    def upload(self, local_path, path, chunk_size=util.unit_m, progress=None):
+        """Uploads local_path to path (relative to the datastore root). """
+        return self.upload_many([(local_path, path)], 1, chunk_size, progress)
+
+    def upload_many(self, files, connections=4, chunk_size=util.unit_m, progress=None):
+        """Uploads (local_path, path) pairs in parallel. """
+        return self.server.upload_files(self.datacenter_name, self.name, files, connections, chunk_size, progress)
+
+    def start_search(self, path, pattern=None):
+        """Starts and returns a SearchDatastore_Task listing the folder at
+        path.
+        """
+        details = vim.host.DatastoreBrowser.FileInfo.Details(fileType=True, fileSize=True, modification=True)
+        spec = vim.host.DatastoreBrowser.SearchSpec(details=details, sortFoldersFirst=True)
+        if pattern:
+            spec.matchPattern = [pattern]
+
+        ds_path = "[{}] {}".format(self.name, path.lstrip('/'))
+
+        return self.dsobj.browser.SearchDatastore_Task(ds_path, spec)
+
+    def to_files(self, results):
+        for result in results:
+            _, folder = util.parse_datastore_path(result.folderPath)
+            for f in result.file or []:
+                yield DatastoreFile('/'.join([folder.rstrip('/'), f.path]) if folder else f.path, f.path,
+                                    f.fileSize, f.modification, type(f)._wsdlName)
+
+    def browse(self, path="", pattern=None, recursive=False, cache_ttl=None, parallelism=4):
+        """Yields a DatastoreFile for every file and folder under path
+        matching pattern (such as "*.vmdk"), folder by folder as the
+        searches finish (see Server.search_folders).
+
+        With cache_ttl, a listing of the same path and pattern made less
+        than cache_ttl seconds ago is reused (see Server.browse_cache).
+        """
+        key = (self.dsobj._moId, path, pattern, recursive)
+        if cache_ttl:
+            files = self.server.browse_cache.get(key, cache_ttl)
+            if files is not None:
+                for f in files:
+                    yield f
+
+                return
+
+        folders = self.server.search_folders([(self, path)], pattern, recursive, parallelism)
+        files = (f for _, folder_files in folders for f in folder_files)
+        if cache_ttl:
+            files = list(files)
+            self.server.browse_cache.put(key, files)
+
+        for f in files:
+            yield f
         
+@tracing.trace_methods
 class VirtualMachineSnapshot:
-    def __init__(self, server, vmobj, name, snapobj=None):
+    PROPERTIES = ['config.hardware.device', 'config.changeTrackingEnabled']
+
+    def __init__(self, server, vmobj, name, snapobj=None, node=None, properties=None):
+        """properties can carry the values of PROPERTIES already retrieved in
+        bulk (see VirtualMachine.get_snapshots), node is the SnapshotNode of
+        the snapshot if known.
+        """
         self.server = server
         self.vmobj = vmobj
         self.name = name
         self.snapobj = snapobj
+        self.node = node
         if not snapobj:
             self.snapobj = get_snapshot_with_name(name, self.vmobj)
             
         self.moref = self.snapobj._moId
+        self._props = dict(properties or {})
+
+    def _get_property(self, path):
+        if path not in self._props:
+            _, props = util.fetch_properties(self.server.service_instance, [self.snapobj], vim.vm.Snapshot,
+                                             self.PROPERTIES)[0]
+            for p in self.PROPERTIES:
+                self._props[p] = props.get(p, None)
+
+        return self._props[path]
 
     def delete(self, remove_children=False):
         task = self.snapobj.RemoveSnapshot_Task(removeChildren=remove_children)
-        result = util.wait_for_tasks(self.server.service_instance, [task])
+        self.server.wait_for_tasks([task])
 
     def get_disks(self):
         disks = []
-        for device in self.snapobj.config.hardware.device:
+        for device in self._get_property('config.hardware.device'):
             if isinstance(device, vim.vm.device.VirtualDisk):
                 disks.append(VirtualDisk(self.server, device, self.vmobj, self.snapobj))
 
         return disks
 
+    def get_all_changed_areas(self, changeid="*", max_workers=8, range_size=64 * util.unit_g):
+        """Returns changed areas of all disks of the snapshot as a dictionary
+        of disk key to ExtentMap.
+
+        changeid is either used for all disks or is a dictionary of disk key
+        to change ID. Disks are split into ranges of range_size bytes and
+        all ranges of all disks are queried in parallel.
+        """
+        disks = self.get_disks()
+
+        ranges = []
+        for disk in disks:
+            disk_changeid = changeid.get(disk.key, "*") if isinstance(changeid, dict) else changeid
+            for start in range(0, disk.capacityInBytes, range_size):
+                ranges.append((disk, disk_changeid, start, start + range_size))
+
+        results = collections.defaultdict(list)
+        for (disk, _, start, _), changed, error in parallel.run_parallel(
+                ranges, lambda r: r[0].get_changed_extents(r[1], r[2], r[3]), max_workers=max_workers):
+            if error:
+                raise error
+
+            results[disk.key].append((start, changed))
+
+        data = collections.OrderedDict()
+        for disk in disks:
+            merged = extents.ExtentMap()
+            for _, changed in sorted(results[disk.key], key=lambda x: x[0]):
+                for start, length in changed:
+                    merged.append(start, length)
+
+            data[disk.key] = merged
+
+        return data
+
     def info(self):
         data = collections.OrderedDict()
 
         data["name"] = self.name
         data["moref"] = self.moref
-        data["cbtEnabled"] = str(bool(self.snapobj.config.changeTrackingEnabled))
+        data["cbtEnabled"] = str(bool(self._get_property('config.changeTrackingEnabled')))
+        if self.node:
+            data["createTime"] = str(self.node.create_time)
+            data["parent"] = self.node.parent.name if self.node.parent else ""
 
         return data
 
@@ -335,6 +1021,7 @@ fsmap = {
     "cifs": vim.host.FileSystemVolume.FileSystemType.CIFS
 }
 
+@tracing.trace_methods
 class VmwareHost:
     def __init__(self, server, identity):
         self.server = server
@@ -345,7 +1032,10 @@ class VmwareHost:
 
         self.diagmgr = server.service_instance.content.diagnosticManager
 
-        self.name = self.hostobj.name
+        mirror = server.fresh_mirror()
+        self.name = mirror.get_name(self.hostobj) if mirror else None
+        if self.name is None:
+            self.name = self.hostobj.name
         self.moref = self.hostobj._moId
 
     def info(self):
@@ -356,13 +1046,39 @@ class VmwareHost:
 
         return data
 
+    def get_perf_stats(self, counters, interval=perf.REALTIME_INTERVAL, window=300, instance=""):
+        """Returns PerfSamples of the named counters (e.g.
+        cpu.usage.average, mem.usage.average) over the last window seconds.
+        """
+        return perf.query_perf(self.server, [self.hostobj], counters, interval, window, instance)[self.moref]
+
     def get_datastores(self):
+        mirror = self.server.fresh_mirror()
+        if mirror is not None and mirror.get_properties(self.hostobj) is not None:
+            dslist = mirror.get(self.hostobj, 'datastore')
+            if not dslist:
+                return []
+
+            datastores = []
+            for ds in dslist:
+                props = mirror.get_properties(ds)
+                datastores.append(Datastore(self.server, self.hostobj, ds, properties=props))
+
+            return sorted(datastores, key=lambda x: x.name)
+
         dslist = self.hostobj.datastore
         if not dslist:
             return []
 
         return sorted([Datastore(self.server, self.hostobj, ds) for ds in dslist], key=lambda x: x.name)
 
+    def get_datastore(self, dsname):
+        for ds in self.get_datastores():
+            if ds.name == dsname:
+                return ds
+
+        raise Exception("Could not find datastore ({})".format(dsname))
+
     def remove_datastore(self, dsname):
         dslist = self.hostobj.datastore
         for ds in dslist:
@@ -380,6 +1096,7 @@ class VmwareHost:
     def list_logs(self):
         return self.diagmgr.QueryDescriptions()
 
+@tracing.trace_methods
 class VirtualMachine:
     def _find_vmobj(self, server, identity):
         if not identity:
@@ -407,116 +1124,215 @@ class VirtualMachine:
 
         return vmobj
 
-    def __init__(self, server, identity=None, vmobj=None):
+    def __init__(self, server, identity=None, vmobj=None, properties=None):
+        """VM attributes are fetched lazily on first access. properties can
+        carry values already retrieved in bulk (see Server.get_vm_properties)
+        so that no round trip is needed for them.
+        """
         self.server = server
         self.vmobj = vmobj
 
-        if vmobj is None:
+        mirror = server.fresh_mirror()
+        if vmobj is None and mirror is not None:
+            self.vmobj = mirror.find_vm(identity or {})
+
+        if self.vmobj is None:
             self.vmobj = self._find_vmobj(server, identity)
 
-        self.config = self.vmobj.config
-        self.name = self.config.name
-        self.runtime = self.vmobj.runtime
-        self.summary = self.vmobj.summary
-        self.summary_config = self.summary.config
-        self.snap_info = self.vmobj.snapshot
+        if properties is None and mirror is not None:
+            properties = mirror.get_properties(self.vmobj)
 
-        self.vmx_path = self.summary_config.vmPathName
-        self.datacenter =self._get_datacenter(self.vmobj)
-        self.parent_folder = self._get_parent_folder(self.vmobj)
-        self.inventory_path = self._get_inventory_path(self.vmobj)
-        self.uuid = self.config.uuid
+        self._props = dict(properties or {})
+        self._datacenter = None
+        self._parent_folder = None
+        self._inventory_path = None
+        self._snapshot_tree = None
 
-        self.guest = self.vmobj.summary.guest
-        if self.guest:
-            self.ip = self.guest.ipAddress
-            self.hostname = self.guest.hostName
-            self.tools_status = self.guest.toolsVersionStatus2
+    def _lookup_cached(self, path):
+        """Returns (found, value) for path using the fetched properties,
+        including values reachable from an already fetched parent path.
+        """
+        if path in self._props:
+            return True, self._props[path]
+
+        comps = path.split('.')
+        for i in range(len(comps) - 1, 0, -1):
+            prefix = '.'.join(comps[:i])
+            if prefix in self._props:
+                value = self._props[prefix]
+                for comp in comps[i:]:
+                    if value is None:
+                        break
+                    value = getattr(value, comp)
 
-    def _get_datacenter(self, obj):
-        while obj:
-            if isinstance(obj, vim.Datacenter):
-                return obj
+                return True, value
 
-            obj = obj.parent
+        return False, None
 
-        raise Exception("Could not find datacenter for ({}), object ({})".format(obj.name, obj))
+    def _get_property(self, path):
+        found, value = self._lookup_cached(path)
+        if not found:
+            self.prefetch([path])
+            value = self._props[path]
 
-    def _get_inventory_path(self, obj):
-        comps = []
-        while obj:
-            comps.append(obj.name)
-            obj = obj.parent
+        return value
 
+    def prefetch(self, path_set):
+        """Loads all the given property paths that are not yet known in a
+        single PropertyCollector call.
+        """
+        missing = [path for path in path_set if not self._lookup_cached(path)[0]]
+        if not missing:
+            return
+
+        result = util.fetch_properties(self.server.service_instance, [self.vmobj], vim.VirtualMachine, missing)
+        props = result[0][1] if result else {}
+        for path in missing:
+            self._props[path] = props.get(path, None)
+
+    def invalidate(self):
+        """Drops all fetched attributes so that they are read again. """
+        self._props = {}
+        self._datacenter = None
+        self._parent_folder = None
+        self._inventory_path = None
+        self._snapshot_tree = None
+
+    name = property(lambda self: self._get_property('name'))
+    config = property(lambda self: self._get_property('config'))
+    runtime = property(lambda self: self._get_property('runtime'))
+    summary = property(lambda self: self._get_property('summary'))
+    summary_config = property(lambda self: self._get_property('summary.config'))
+    snap_info = property(lambda self: self._get_property('snapshot'))
+    vmx_path = property(lambda self: self._get_property('summary.config.vmPathName'))
+    uuid = property(lambda self: self._get_property('config.uuid'))
+    guest = property(lambda self: self._get_property('summary.guest'))
+    ip = property(lambda self: self._get_property('summary.guest.ipAddress'))
+    hostname = property(lambda self: self._get_property('summary.guest.hostName'))
+    tools_status = property(lambda self: self._get_property('summary.guest.toolsVersionStatus2'))
+
+    @property
+    def datacenter(self):
+        if self._datacenter is None:
+            self._datacenter = self._get_datacenter()
+
+        return self._datacenter
+
+    @property
+    def parent_folder(self):
+        if self._parent_folder is None:
+            self._parent_folder = self._get_parent_folder()
+
+        return self._parent_folder
+
+    @property
+    def inventory_path(self):
+        if self._inventory_path is None:
+            self._inventory_path = self._get_inventory_path()
+
+        return self._inventory_path
+
+    def _get_datacenter(self):
+        datacenter = self.server.inventory.find_ancestor(self._get_property('parent'), vim.Datacenter)
+        if datacenter is None:
+            raise Exception("Could not find datacenter for ({}), object ({})".format(self.name, self.vmobj))
+
+        return datacenter
+
+    def _get_inventory_path(self):
         # For a VM, I am getting inventory path like:
         #   Datacenters/Engineering/vm/Raghu/testvm (raghu)
         # It seems, I don't need to keep the very first component which
         # is root folder.
-        comps.pop()
+        return self.server.inventory.get_inventory_path(self.name, self._get_property('parent'))
 
-        return '/'.join(reversed(comps))
+    def _get_parent_folder(self):
+        folder = self.server.inventory.find_ancestor(self._get_property('parent'), vim.Folder)
+        if folder is None:
+            raise Exception("Could not find parent folder for ({}), object ({})".format(self.name, self.vmobj))
 
-    def _get_parent_folder(self, obj):
-        while obj:
-            if isinstance(obj, vim.Folder):
-                return obj
+        return folder
 
-            obj = obj.parent
+    @property
+    def snapshot_tree(self):
+        """SnapshotTree of the VM, built once from the 'snapshot' property. """
+        if self._snapshot_tree is None:
+            self._snapshot_tree = SnapshotTree(self.snap_info)
 
-        raise Exception("Could not find parent folder for ({}), object ({})".format(obj.name, obj))
+        return self._snapshot_tree
 
-    def _get_snapshots(self, sdk_snapshots, snapshots):
-        for snap in sdk_snapshots:
-            snapshots.append(VirtualMachineSnapshot(self.server, self.vmobj, snap.name, snapobj=snap.snapshot))
-            if snap.childSnapshotList:
-                self._get_snapshots(snap.childSnapshotList, snapshots)
+    def _to_snapshot(self, node, properties=None):
+        return VirtualMachineSnapshot(self.server, self.vmobj, node.name, snapobj=node.snapobj, node=node,
+                                      properties=properties)
 
-    def get_snapshots(self):
-        if not self.snap_info:
-            return []
+    def get_snapshots(self, prefetch=True):
+        """Returns all snapshots in tree order. With prefetch, the disk
+        configuration of all of them is retrieved in one call.
+        """
+        tree = self.snapshot_tree
+        if not prefetch or not tree.nodes:
+            return [self._to_snapshot(node) for node in tree]
 
-        snapshots = []
-        self._get_snapshots(self.snap_info.rootSnapshotList, snapshots)
+        props = dict((obj._moId, p) for obj, p in util.fetch_properties(
+            self.server.service_instance, [node.snapobj for node in tree], vim.vm.Snapshot,
+            VirtualMachineSnapshot.PROPERTIES))
 
-        return snapshots
+        return [self._to_snapshot(node, props.get(node.moref)) for node in tree]
 
     def create_snapshot(self, name, description="", memory=False, quiesce=True):
         task = self.vmobj.CreateSnapshot_Task(name=name, description=description, memory=memory, quiesce=quiesce)
-        result = util.wait_for_tasks(self.server.service_instance, [task])
+        task_info, = self.server.wait_for_tasks([task])
+        self.invalidate()
 
-        return VirtualMachineSnapshot(self.server, self.vmobj, name)
+        return VirtualMachineSnapshot(self.server, self.vmobj, name, snapobj=task_info.result)
 
     def get_snapshot_with_name(self, name):
-        return VirtualMachineSnapshot(self.server, self.vmobj, name)
+        return self._to_snapshot(self.snapshot_tree.get_by_name(name))
+
+    def get_snapshot(self, moref):
+        return self._to_snapshot(self.snapshot_tree.get(moref))
 
     def delete_all_snapshots(self):
         task = self.vmobj.RemoveAllSnapshots_Task()
-        result = util.wait_for_tasks(self.server.service_instance, [task])
+        self.server.wait_for_tasks([task])
+        self.invalidate()
+
+    def get_devices(self):
+        """Returns the devices of the VM, cached by the server until the VM
+        is reconfigured (see Server.get_devices).
+        """
+        return self.server.get_devices(self.vmobj)
 
     def get_disks(self):
         disks = []
-        for device in self.config.hardware.device:
+        for device in self.get_devices():
             if isinstance(device, vim.vm.device.VirtualDisk):
                 disks.append(VirtualDisk(self.server, device, self.vmobj))
 
         return disks
 
+    INFO_PROPERTIES = ['name', 'parent', 'config.guestFullName', 'config.instanceUuid', 'config.changeTrackingEnabled',
+                       'config.uuid', 'runtime.powerState', 'runtime.host', 'summary.config', 'summary.guest',
+                       'resourcePool']
+
     def info(self):
+        self.prefetch(self.INFO_PROPERTIES)
+
         data = collections.OrderedDict()
 
-        data["name"] = self.config.name
+        data["name"] = self.name
         data["moref"] = self.vmobj._moId
-        data["guestFullName"] = self.config.guestFullName
+        data["guestFullName"] = self._get_property('config.guestFullName')
         data["pathToVm"] = self.vmx_path
-        data["datacenter"] = self.datacenter.name
-        data["parentFolder"] = self.parent_folder.name
+        data["datacenter"] = self.server.inventory.get_name(self.datacenter)
+        data["parentFolder"] = self.server.inventory.get_name(self.parent_folder)
         data["inventoryPath"] = self.inventory_path
-        data["instanceUuid"] = self.config.instanceUuid
-        data["cbtEnabled"] = str(bool(self.config.changeTrackingEnabled))
-        data["uuid"] = self.config.uuid
-        data["powerState"] = self.runtime.powerState
-        if self.runtime.powerState == 'poweredOn':
-            data["host"] = self.runtime.host.name
+        data["instanceUuid"] = self._get_property('config.instanceUuid')
+        data["cbtEnabled"] = str(bool(self._get_property('config.changeTrackingEnabled')))
+        data["uuid"] = self.uuid
+        data["powerState"] = self._get_property('runtime.powerState')
+        if data["powerState"] == 'poweredOn':
+            data["host"] = self._get_property('runtime.host').name
 
         data["memoryMB"] = self.summary_config.memorySizeMB
         data["numDisks"] = self.summary_config.numVirtualDisks
@@ -527,7 +1343,7 @@ class VirtualMachine:
         if self.tools_status:
             data["toolsStatus"] = self.tools_status
 
-        resource_pool = self.vmobj.resourcePool
+        resource_pool = self._get_property('resourcePool')
         if resource_pool:
             data["resourcePool"] = resource_pool.name
 
@@ -537,40 +1353,34 @@ class VirtualMachine:
         config_spec = vim.vm.ConfigSpec()
         config_spec.changeTrackingEnabled = True
 
-        util.wait_for_tasks(self.server.service_instance, [self.vmobj.Reconfigure(config_spec)])
+        self.server.wait_for_tasks([self.vmobj.Reconfigure(config_spec)])
+        self.invalidate()
 
     def disable_cbt(self):
         config_spec = vim.vm.ConfigSpec()
         config_spec.changeTrackingEnabled = False
 
-        util.wait_for_tasks(self.server.service_instance, [self.vmobj.Reconfigure(config_spec)])
+        self.server.wait_for_tasks([self.vmobj.Reconfigure(config_spec)])
+        self.invalidate()
 
     def download_vmx(self, output_file):
-        m = re.match('\[(.*)\]\s*(.*)', self.vmx_path)
-        if not m:
-            raise Exception("Could not parse VMX path ({})".format(self.vmx_path))
-
-        dsname = m.group(1).strip()
-        filepath = m.group(2).strip()
-        url = "https://{}/folder/{}".format(self.server.host, filepath)
-
-        auth = requests.auth.HTTPBasicAuth(self.server.username, self.server.password)
-        params = {'dcPath': self.datacenter.name, 'dsName': dsname}
-        resp = requests.get(url, params=params, auth=auth, verify=False)
-
-        with open(output_file, "wb") as f:
-            f.write(resp.content)
+        dsname, filepath = util.parse_datastore_path(self.vmx_path)
+        self.server.download_file(self.server.inventory.get_name(self.datacenter), dsname, filepath, output_file,
+                                  resume=False)
 
     def register(self, vmxpath, name=None):
         task = self.parent_folder.RegisterVM_Task(path=vmxpath, name=name, asTemplate=False,
-                                                  pool=self.vmobj.resourcePool)
-        util.wait_for_tasks(self.server.service_instance, [task])
+                                                  pool=self._get_property('resourcePool'))
+        self.server.wait_for_tasks([task])
 
 
     def unregister(self):
         self.vmobj.UnregisterVM()
 
-    def poweron(self):
+    def poweron(self, answer=util.answer_interactive, timeout=None, show_progress=False):
+        """Powers on the VM. Questions asked by the VM while powering on
+        are answered by answer (see util.answer_policies).
+        """
         # PowerOnMultiVM_Task API is not working. I only see the message:
         #   "Initializing Power on..." 
         # in vSphere client but power on never happens.
@@ -578,18 +1388,23 @@ class VirtualMachine:
 
         # task = self.vmobj.PowerOnVM_Task()
         # util.wait_for_tasks(self.server.service_instance, [task])
-        util.powerOnVM(self.vmobj)
+        util.power_on_vm(self.server.service_instance, self.vmobj, answer, timeout, show_progress)
+        self.invalidate()
         
     def poweroff(self):
         task = self.vmobj.PowerOffVM_Task()
-        util.wait_for_tasks(self.server.service_instance, [task])
+        self.server.wait_for_tasks([task])
+        self.invalidate()
 
     def add_disk(self, size_gb, format="thin"):
-        util.add_disk(self.server.service_instance, self.vmobj, size_gb, format)
+        util.add_disk(self.server.service_instance, self.vmobj, size_gb, format, devices=self.get_devices(),
+                      wait=self.server.wait_for_tasks)
+        self.invalidate()
 
     def change_name(self, newname):
         spec = vim.vm.ConfigSpec()
         spec.name = newname
         task = self.vmobj.ReconfigVM_Task(spec=spec)
-        util.wait_for_tasks(self.server.service_instance, [task])
+        self.server.wait_for_tasks([task])
+        self.invalidate()
 
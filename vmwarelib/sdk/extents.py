@@ -0,0 +1,158 @@
+import array
+import struct
+import sys
+
+MAGIC = b"VMWLEXT1"
+HEADER = struct.Struct("<8sQ")
+
+class ExtentMap:
+    """Sorted list of non overlapping (start, length) byte extents, such as
+    the changed areas of a disk.
+
+    Starts and lengths are kept in two array('Q') columns (16 bytes per
+    extent) instead of a Python tuple per extent. Extents that touch or
+    overlap are merged when added, so the map is always coalesced. All the
+    operations below are single passes over the columns.
+    """
+
+    def __init__(self, starts=None, lengths=None):
+        self.starts = starts if starts is not None else array.array('Q')
+        self.lengths = lengths if lengths is not None else array.array('Q')
+
+    @classmethod
+    def from_extents(cls, extents):
+        """Creates a map from (start, length) pairs in any order. """
+        result = cls()
+        for start, length in sorted(extents):
+            result.append(start, length)
+
+        return result
+
+    def append(self, start, length):
+        """Adds an extent that does not start before the last one. """
+        if length == 0:
+            return
+
+        if self.starts:
+            last_start = self.starts[-1]
+            last_end = last_start + self.lengths[-1]
+            if start < last_start:
+                raise Exception("Extent ({}, {}) is out of order. ".format(start, length))
+
+            if start <= last_end:
+                self.lengths[-1] = max(last_end, start + length) - last_start
+                return
+
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.lengths)
+
+    def __eq__(self, other):
+        return isinstance(other, ExtentMap) and self.starts == other.starts and self.lengths == other.lengths
+
+    def __repr__(self):
+        return "ExtentMap({} extents, {} bytes)".format(len(self), self.total_bytes())
+
+    def total_bytes(self):
+        return sum(self.lengths)
+
+    def coalesced(self, max_gap):
+        """Returns a map where extents less than max_gap bytes apart are
+        merged (together with the gap between them).
+        """
+        result = ExtentMap()
+        for start, length in self:
+            if result.starts and start - (result.starts[-1] + result.lengths[-1]) < max_gap:
+                result.lengths[-1] = start + length - result.starts[-1]
+            else:
+                result.append(start, length)
+
+        return result
+
+    def aligned(self, block_size, limit=None):
+        """Returns a map with every extent widened to block_size boundaries
+        and, if limit is given, clipped to it (e.g. disk capacity).
+        """
+        result = ExtentMap()
+        for start, length in self:
+            aligned_start = start - start % block_size
+            aligned_end = -(-(start + length) // block_size) * block_size
+            if limit is not None:
+                # Changed areas reported past the end of a disk that has
+                # been shrunk; the rest are further out still.
+                if aligned_start >= limit:
+                    break
+
+                aligned_end = min(aligned_end, limit)
+
+            result.append(aligned_start, aligned_end - aligned_start)
+
+        return result
+
+    def union(self, other):
+        result = ExtentMap()
+
+        i, j = 0, 0
+        while i < len(self.starts) or j < len(other.starts):
+            if j == len(other.starts) or (i < len(self.starts) and self.starts[i] <= other.starts[j]):
+                result.append(self.starts[i], self.lengths[i])
+                i += 1
+            else:
+                result.append(other.starts[j], other.lengths[j])
+                j += 1
+
+        return result
+
+    def intersection(self, other):
+        result = ExtentMap()
+
+        i, j = 0, 0
+        while i < len(self.starts) and j < len(other.starts):
+            end = self.starts[i] + self.lengths[i]
+            other_end = other.starts[j] + other.lengths[j]
+
+            start = max(self.starts[i], other.starts[j])
+            if start < min(end, other_end):
+                result.append(start, min(end, other_end) - start)
+
+            if end < other_end:
+                i += 1
+            else:
+                j += 1
+
+        return result
+
+    def save(self, path):
+        """Writes the map to path in a compact binary format. """
+        starts, lengths = self.starts, self.lengths
+        if sys.byteorder != "little":
+            starts, lengths = array.array('Q', starts), array.array('Q', lengths)
+            starts.byteswap()
+            lengths.byteswap()
+
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(starts)))
+            starts.tofile(f)
+            lengths.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            magic, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception("Not an extent map file: ({})".format(path))
+
+            starts, lengths = array.array('Q'), array.array('Q')
+            starts.fromfile(f, count)
+            lengths.fromfile(f, count)
+
+        if sys.byteorder != "little":
+            starts.byteswap()
+            lengths.byteswap()
+
+        return cls(starts, lengths)
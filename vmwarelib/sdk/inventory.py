@@ -0,0 +1,313 @@
+import logging
+import threading
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+class ViewCollector:
+    """Keeps selected properties of all objects of the given types in memory.
+
+    type_paths maps a managed object type to the property paths to collect
+    for it. A private PropertyCollector with one filter over a container
+    view of the root folder is used. The first sync() delivers the current
+    state of all objects and every later sync() only the changes since the
+    previous one, so keeping the data current is cheap.
+    """
+
+    def __init__(self, service_instance, type_paths, page_size=1000):
+        self.service_instance = service_instance
+        self.type_paths = type_paths
+        self.page_size = page_size
+
+        self.objs = {}
+        self.props = {}
+        self.version = None
+        self.synced_at = None
+
+        self.lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._collector = None
+        self._view = None
+
+    def _create_filter(self):
+        content = self.service_instance.content
+
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._view = content.viewManager.CreateContainerView(content.rootFolder, list(self.type_paths), True)
+
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view',
+                                                                     skip=False, type=vim.view.ContainerView)
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=self._view, skip=True, selectSet=[traversal_spec])]
+
+        # Container view does not include the container itself.
+        if vim.Folder in self.type_paths:
+            obj_specs.append(vmodl.query.PropertyCollector.ObjectSpec(obj=content.rootFolder, skip=False))
+
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=list(paths), all=False)
+                      for obj_type, paths in self.type_paths.items()]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=prop_specs)
+
+        self._collector.CreateFilter(filter_spec, False)
+
+    def sync(self, max_wait=0):
+        """Applies the changes made on the server since the last sync.
+
+        Waits up to max_wait seconds for a change to happen (None waits
+        until there is one). Returns True if anything changed.
+        """
+        with self._sync_lock:
+            if self._collector is None:
+                self._create_filter()
+
+            changed = False
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait,
+                                                                maxObjectUpdates=self.page_size)
+            while True:
+                update = self._collector.WaitForUpdatesEx(self.version, options)
+                if update is None:
+                    break
+
+                with self.lock:
+                    self._apply(update)
+                    self.version = update.version
+
+                changed = True
+                if not update.truncated:
+                    break
+
+                # Rest of the pending changes are available right away.
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0,
+                                                                    maxObjectUpdates=self.page_size)
+
+            self.synced_at = time.time()
+
+            return changed
+
+    def sync_if_older(self, max_age):
+        if self.synced_at is None or time.time() - self.synced_at >= max_age:
+            self.sync()
+
+    def _apply(self, update):
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                obj = obj_set.obj
+                moref = obj._moId
+
+                if obj_set.kind == 'leave':
+                    self.objs.pop(moref, None)
+                    self.props.pop(moref, None)
+                    self.changed(obj_set.kind, obj, [])
+                    continue
+
+                props = self.props.get(moref)
+                if props is None or obj_set.kind == 'enter':
+                    props = self.props[moref] = {}
+                    self.objs[moref] = obj
+
+                for change in obj_set.changeSet or []:
+                    if change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = change.val
+
+                self.changed(obj_set.kind, obj, [change.name for change in obj_set.changeSet or []])
+
+    def changed(self, kind, obj, names):
+        """Called for every object update. kind is one of 'enter', 'modify'
+        or 'leave' and names lists the changed property paths.
+        """
+        pass
+
+    def get(self, obj, path, default=None):
+        with self.lock:
+            props = self.props.get(obj._moId)
+            if props is None:
+                return default
+
+            return props.get(path, default)
+
+    def destroy(self):
+        logging.debug("Destroying property collector {}...".format(self._collector))
+
+        if self._collector is not None:
+            self._collector.Destroy()
+            self._collector = None
+
+        if self._view is not None:
+            self._view.Destroy()
+            self._view = None
+
+class InventoryIndex(ViewCollector):
+    """Name and parent of every folder and datacenter, so that inventory
+    paths, datacenters and parent folders are resolved in memory instead of
+    walking obj.parent with one round trip per hop. Renamed, moved, added
+    and removed folders are picked up by sync().
+    """
+
+    TYPE_PATHS = {
+        vim.Folder: ['name', 'parent'],
+        vim.Datacenter: ['name', 'parent'],
+    }
+
+    def __init__(self, service_instance, type_paths=None, page_size=1000):
+        super().__init__(service_instance, type_paths or self.TYPE_PATHS, page_size)
+
+        self._paths = {}
+
+    def changed(self, kind, obj, names):
+        if kind != 'modify' or 'name' in names or 'parent' in names:
+            self._paths.clear()
+
+    def get_name(self, obj):
+        return self.get(obj, 'name')
+
+    def get_parent(self, obj):
+        return self.get(obj, 'parent')
+
+    def _get_folder_path(self, obj):
+        moref = obj._moId
+        path = self._paths.get(moref)
+        if path is None:
+            parent = self.get_parent(obj)
+            if parent is None:
+                # Root folder is not part of the inventory path.
+                path = ''
+            else:
+                parent_path = self._get_folder_path(parent)
+                name = self.get_name(obj)
+                path = '/'.join([parent_path, name]) if parent_path else name
+
+            self._paths[moref] = path
+
+        return path
+
+    def get_inventory_path(self, name, parent):
+        """Returns inventory path of an object with given name and parent. """
+        if parent is None:
+            return name
+
+        with self.lock:
+            parent_path = self._get_folder_path(parent)
+
+        return '/'.join([parent_path, name]) if parent_path else name
+
+    def find_ancestor(self, obj, obj_type):
+        """Returns obj or the closest of its ancestors that is of obj_type. """
+        with self.lock:
+            while obj is not None:
+                if isinstance(obj, obj_type):
+                    return obj
+
+                obj = self.get_parent(obj)
+
+        return None
+
+class InventoryMirror(InventoryIndex):
+    """In-memory copy of VMs, hosts, datastores and folders that a
+    background thread keeps current with incremental WaitForUpdatesEx
+    changes. Readers check is_fresh() and fall back to the server when the
+    mirror has not heard from vCenter for more than max_staleness seconds.
+    """
+
+    TYPE_PATHS = {
+        vim.Folder: ['name', 'parent'],
+        vim.Datacenter: ['name', 'parent'],
+        vim.VirtualMachine: ['name', 'parent', 'config.uuid', 'config.instanceUuid', 'summary.config.vmPathName',
+                             'summary.guest.ipAddress', 'runtime.powerState', 'runtime.host'],
+        vim.HostSystem: ['name', 'parent', 'datastore'],
+        vim.Datastore: ['name', 'parent', 'summary.type'],
+    }
+
+    def __init__(self, service_instance, max_staleness=30, page_size=1000):
+        super().__init__(service_instance, self.TYPE_PATHS, page_size)
+
+        self.max_staleness = max_staleness
+        self._lookups = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Loads the inventory and starts the background update thread. """
+        self.sync()
+
+        self._thread = threading.Thread(target=self._run, name='vmwarelib-mirror', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._collector is not None:
+            try:
+                self._collector.CancelWaitForUpdates()
+            except Exception:
+                logging.debug("Could not cancel pending WaitForUpdatesEx", exc_info=True)
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.destroy()
+
+    def _run(self):
+        # Return from the wait regularly so that synced_at proves that the
+        # mirror is still current even when nothing changes.
+        max_wait = max(1, int(self.max_staleness / 2))
+
+        while not self._stopped.is_set():
+            try:
+                self.sync(max_wait=max_wait)
+            except Exception:
+                if self._stopped.is_set():
+                    break
+
+                logging.exception("Inventory mirror update failed, retrying...")
+                self._stopped.wait(max_wait)
+
+    def is_fresh(self):
+        return self.synced_at is not None and time.time() - self.synced_at <= self.max_staleness
+
+    def changed(self, kind, obj, names):
+        super().changed(kind, obj, names)
+
+        self._lookups = None
+
+    def get_properties(self, obj):
+        """Returns a copy of collected properties of obj or None. """
+        with self.lock:
+            props = self.props.get(obj._moId)
+            return dict(props) if props is not None else None
+
+    def get_objects(self, obj_type):
+        with self.lock:
+            return [obj for obj in self.objs.values() if isinstance(obj, obj_type)]
+
+    def _get_lookups(self):
+        with self.lock:
+            if self._lookups is None:
+                lookups = {"ip": {}, "uuid": {}, "ipath": {}}
+                for moref, obj in self.objs.items():
+                    if not isinstance(obj, vim.VirtualMachine):
+                        continue
+
+                    props = self.props[moref]
+                    if props.get('summary.guest.ipAddress'):
+                        lookups["ip"][props['summary.guest.ipAddress']] = obj
+                    if props.get('config.uuid'):
+                        lookups["uuid"][props['config.uuid']] = obj
+                    lookups["ipath"][self.get_inventory_path(props.get('name'), props.get('parent'))] = obj
+
+                self._lookups = lookups
+
+            return self._lookups
+
+    def find_vm(self, identity):
+        """Returns the VM matching identity (same keys as VirtualMachine
+        takes) or None.
+        """
+        lookups = self._get_lookups()
+        for key in ("ip", "ipath", "uuid"):
+            if identity.get(key, None):
+                return lookups[key].get(identity[key])
+
+        return None
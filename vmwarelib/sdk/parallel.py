@@ -0,0 +1,80 @@
+import collections
+import concurrent.futures
+import http.client
+import logging
+import time
+
+from pyVmomi import vim
+
+def is_transient_error(e):
+    """True for errors that are likely to go away when retried. """
+    return isinstance(e, (vim.fault.TaskInProgress, vim.fault.HostCommunication, ConnectionError,
+                          http.client.HTTPException, TimeoutError))
+
+def run_parallel(items, func, max_workers=8, limits=(), retries=0, retry_delay=2, is_transient=is_transient_error):
+    """Calls func(item) for all items on a pool of max_workers threads and
+    yields (item, result, error) tuples as the calls finish.
+
+    limits is a list of (key_func, max_concurrent) pairs. key_func(item)
+    returns the keys (e.g. host or datastores) of an item, and at most
+    max_concurrent calls run at the same time for any one key. Calls failing
+    with a transient error are retried up to retries times, waiting
+    retry_delay seconds before the first retry and doubling it every time.
+    """
+    for _, max_concurrent in limits:
+        if max_concurrent < 1:
+            raise Exception("Concurrency limit must be at least 1 ({})".format(max_concurrent))
+
+    def get_keys(item):
+        return [(i, key) for i, (key_func, _) in enumerate(limits) for key in key_func(item)]
+
+    # Entries are (item, attempt, not_before).
+    pending = collections.deque((item, 0, 0) for item in items)
+    running = {}
+    counts = collections.Counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            now = time.time()
+            for _ in range(len(pending)):
+                if len(running) >= max_workers:
+                    break
+
+                item, attempt, not_before = pending.popleft()
+                keys = get_keys(item)
+                if not_before > now or any(counts[key] >= limits[key[0]][1] for key in keys):
+                    pending.append((item, attempt, not_before))
+                    continue
+
+                for key in keys:
+                    counts[key] += 1
+
+                running[executor.submit(func, item)] = (item, attempt, keys)
+
+            # Wake up for retries that become due, otherwise wait for a call
+            # to finish.
+            delays = [not_before - now for _, _, not_before in pending if not_before > now]
+            timeout = min(delays) if delays else None
+
+            if not running:
+                time.sleep(timeout or 0)
+                continue
+
+            done, _ = concurrent.futures.wait(running, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item, attempt, keys = running.pop(future)
+                for key in keys:
+                    counts[key] -= 1
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if attempt < retries and is_transient(e):
+                        logging.info("Retrying ({}) after transient error: {}".format(item, e))
+                        pending.append((item, attempt + 1, time.time() + retry_delay * (2 ** attempt)))
+                        continue
+
+                    yield item, None, e
+                else:
+                    yield item, result, None
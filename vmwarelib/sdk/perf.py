@@ -0,0 +1,353 @@
+import array
+import calendar
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from pyVmomi import vim
+
+from vmwarelib.sdk import parallel
+
+# Interval of real-time statistics of hosts and VMs, in seconds.
+REALTIME_INTERVAL = 20
+
+def counter_name(counter_info):
+    """Returns "group.name.rollup" name of a PerfCounterInfo, e.g.
+    cpu.usage.average.
+    """
+    return "{}.{}.{}".format(counter_info.groupInfo.key, counter_info.nameInfo.key, counter_info.rollupType)
+
+class CounterTable:
+    """Names and IDs of all performance counters of a server. The table is
+    read with a single property fetch when first needed and does not change
+    for the lifetime of a session.
+    """
+
+    def __init__(self, perf_manager):
+        self.perf_manager = perf_manager
+        self._by_name = None
+        self._by_id = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._by_id is None:
+                by_name, by_id = {}, {}
+                for counter_info in self.perf_manager.perfCounter:
+                    by_name[counter_name(counter_info)] = counter_info.key
+                    by_id[counter_info.key] = counter_info
+
+                self._by_name, self._by_id = by_name, by_id
+
+    def get_id(self, name):
+        self._load()
+        if name not in self._by_name:
+            raise Exception("Unknown performance counter ({})".format(name))
+
+        return self._by_name[name]
+
+    def get_ids(self, names):
+        return [self.get_id(name) for name in names]
+
+    def get_name(self, counter_id):
+        self._load()
+        return counter_name(self._by_id[counter_id]) if counter_id in self._by_id else str(counter_id)
+
+    def get_unit(self, name):
+        """Returns unit of a counter, e.g. "percent" (in hundredths of a
+        percent), "kiloBytes" or "kiloBytesPerSecond".
+        """
+        self._load()
+        return self._by_id[self.get_id(name)].unitInfo.key
+
+    def names(self):
+        self._load()
+        return sorted(self._by_name)
+
+def _parse_time(text):
+    # Timestamps in sampleInfoCSV are like 2024-01-01T10:20:40Z.
+    text = text.rstrip("Z").split(".")[0].split("+")[0]
+    return calendar.timegm(time.strptime(text, "%Y-%m-%dT%H:%M:%S"))
+
+def _parse_values(text):
+    # Missing samples are reported as -1 (or left empty).
+    return array.array('q', (int(v) if v else -1 for v in text.split(","))) if text else array.array('q')
+
+class PerfSamples:
+    """Samples of one entity in columns: timestamps (seconds since the
+    epoch) and a column of values per (counter name, instance), all
+    array('q'). Missing samples are -1.
+    """
+
+    def __init__(self, entity, interval, timestamps=None):
+        self.entity = entity
+        self.interval = interval
+        self.timestamps = timestamps if timestamps is not None else array.array('q')
+        self.values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def get(self, counter, instance=""):
+        return self.values.get((counter, instance), array.array('q'))
+
+    def latest(self, counter, instance=""):
+        values = self.get(counter, instance)
+        return values[-1] if values else None
+
+    def rows(self):
+        """Yields (timestamp, [value of every column]) tuples. """
+        columns = list(self.values.values())
+        for i, timestamp in enumerate(self.timestamps):
+            yield timestamp, [column[i] if i < len(column) else -1 for column in columns]
+
+    def to_numpy(self):
+        """Returns timestamps and the values dictionary as numpy arrays
+        (sharing memory with the columns). Needs numpy.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("numpy is required for to_numpy(). ")
+
+        return (numpy.frombuffer(self.timestamps, dtype=numpy.int64),
+                {key: numpy.frombuffer(column, dtype=numpy.int64) for key, column in self.values.items()})
+
+def parse_entity_csv(entity_metric, counters, interval):
+    """Returns PerfSamples of a PerfEntityMetricCSV. """
+    sample_info = entity_metric.sampleInfoCSV.split(",") if entity_metric.sampleInfoCSV else []
+
+    # sampleInfoCSV alternates interval and timestamp.
+    timestamps = array.array('q', (_parse_time(t) for t in sample_info[1::2]))
+    samples = PerfSamples(entity_metric.entity, int(sample_info[0]) if sample_info else interval, timestamps)
+
+    for series in entity_metric.value or []:
+        samples.values[(counters.get_name(series.id.counterId), series.id.instance)] = _parse_values(series.value)
+
+    return samples
+
+def build_query_spec(entity, counter_ids, interval, instance="", start_time=None, end_time=None,
+                     max_sample=None):
+    metric_ids = [vim.PerformanceManager.MetricId(counterId=counter_id, instance=instance)
+                  for counter_id in counter_ids]
+
+    return vim.PerformanceManager.QuerySpec(entity=entity, metricId=metric_ids, intervalId=interval,
+                                            startTime=start_time, endTime=end_time, maxSample=max_sample,
+                                            format=vim.PerformanceManager.Format.csv)
+
+def query_perf(server, entities, counters, interval=REALTIME_INTERVAL, window=300, instance=""):
+    """Returns samples of the last window seconds of the named counters of
+    all entities (hosts or VMs), as an OrderedDict of moref to PerfSamples.
+
+    All entities are queried with a single QueryPerf call in CSV format,
+    which is parsed directly into columns. instance "" selects the
+    aggregate of a counter, "*" every instance (e.g. every CPU or NIC).
+    """
+    if not entities:
+        return collections.OrderedDict()
+
+    counter_ids = server.perf_counters.get_ids(counters)
+
+    # Start time is taken from the server clock.
+    start_time = server.service_instance.CurrentTime() - datetime.timedelta(seconds=window)
+    specs = [build_query_spec(entity, counter_ids, interval, instance, start_time=start_time)
+             for entity in entities]
+
+    results = collections.OrderedDict((entity._moId, PerfSamples(entity, interval)) for entity in entities)
+    for entity_metric in server.service_instance.content.perfManager.QueryPerf(querySpec=specs) or []:
+        results[entity_metric.entity._moId] = parse_entity_csv(entity_metric, server.perf_counters, interval)
+
+    return results
+
+class RingBuffer:
+    """Last capacity samples of num_metrics metrics of num_entities
+    entities, in arrays allocated up front so memory use does not grow with
+    the number of samples collected.
+
+    Values of one (entity, metric) are contiguous, as are the timestamps
+    of one entity. Missing values are -1.
+    """
+
+    def __init__(self, num_entities, num_metrics, capacity):
+        self.num_entities = num_entities
+        self.num_metrics = num_metrics
+        self.capacity = capacity
+
+        self.timestamps = array.array('q', [0]) * (num_entities * capacity)
+        self.values = array.array('q', [-1]) * (num_entities * num_metrics * capacity)
+        # Total number of samples ever written per entity.
+        self.counts = array.array('q', [0]) * num_entities
+
+    def extend(self, entity, timestamps, columns):
+        """Appends samples of entity. columns maps metric index to a
+        sequence of values, one per timestamp.
+        """
+        capacity = self.capacity
+        count = self.counts[entity]
+
+        # Only the last capacity samples would survive anyway.
+        skip = max(0, len(timestamps) - capacity)
+        for i in range(skip, len(timestamps)):
+            slot = (count + i) % capacity
+            self.timestamps[entity * capacity + slot] = timestamps[i]
+            for metric in range(self.num_metrics):
+                column = columns.get(metric)
+                value = column[i] if column is not None and i < len(column) else -1
+                self.values[(entity * self.num_metrics + metric) * capacity + slot] = value
+
+        self.counts[entity] = count + len(timestamps)
+
+    def last_timestamp(self, entity):
+        count = self.counts[entity]
+        if not count:
+            return None
+
+        return self.timestamps[entity * self.capacity + (count - 1) % self.capacity]
+
+    def _slots(self, entity, last):
+        count = self.counts[entity]
+        n = min(count, self.capacity, last if last is not None else self.capacity)
+        return [(count - n + i) % self.capacity for i in range(n)]
+
+    def get_timestamps(self, entity, last=None):
+        """Returns timestamps of the samples kept (or the last ones), oldest
+        first.
+        """
+        base = entity * self.capacity
+        return array.array('q', (self.timestamps[base + slot] for slot in self._slots(entity, last)))
+
+    def get_values(self, entity, metric, last=None):
+        base = (entity * self.num_metrics + metric) * self.capacity
+        return array.array('q', (self.values[base + slot] for slot in self._slots(entity, last)))
+
+class RealtimeCollector:
+    """Collects real-time (20 second) statistics of many VMs.
+
+    VMs are split into batches so that a QueryPerf call asks for at most
+    max_query_metrics metrics (vCenter's config.vpxd.stats.maxQueryMetrics)
+    and at most max_entities VMs. Batches are queried concurrently by up to
+    max_workers threads. Every query asks only for samples newer than the
+    last one received for a VM (startTime continuation), and samples go
+    into a RingBuffer holding the last capacity samples per VM (an hour by
+    default).
+
+        collector = perf.RealtimeCollector(server, vms, ['cpu.usage.average'])
+        for moref, timestamps, columns in collector.stream():
+            ...
+    """
+
+    def __init__(self, server, vms, counters, capacity=180, instance="", max_query_metrics=256, max_entities=64,
+                 max_workers=8, initial_samples=15):
+        self.server = server
+        self.entities = [getattr(vm, 'vmobj', vm) for vm in vms]
+        self.counters = list(counters)
+        self.instance = instance
+        self.max_workers = max_workers
+        self.initial_samples = initial_samples
+
+        self.index = {entity._moId: i for i, entity in enumerate(self.entities)}
+        self.counter_ids = server.perf_counters.get_ids(self.counters)
+        self.metric_index = {counter_id: i for i, counter_id in enumerate(self.counter_ids)}
+        self.ring = RingBuffer(len(self.entities), len(self.counters), capacity)
+
+        batch_size = max(1, min(max_entities, max_query_metrics // max(1, len(self.counters))))
+        self.batches = [self.entities[i:i + batch_size] for i in range(0, len(self.entities), batch_size)]
+
+        self._stopped = threading.Event()
+
+    def _build_spec(self, entity):
+        last = self.ring.last_timestamp(self.index[entity._moId])
+        if last is None:
+            return build_query_spec(entity, self.counter_ids, REALTIME_INTERVAL, self.instance,
+                                    max_sample=self.initial_samples)
+
+        # Samples after start time are returned.
+        start_time = datetime.datetime.fromtimestamp(last, datetime.timezone.utc)
+        return build_query_spec(entity, self.counter_ids, REALTIME_INTERVAL, self.instance, start_time=start_time,
+                                max_sample=self.ring.capacity)
+
+    def _query_batch(self, batch):
+        """Queries a batch and stores the new samples. Returns list of
+        (entity index, number of new samples).
+        """
+        specs = [self._build_spec(entity) for entity in batch]
+        result = self.server.service_instance.content.perfManager.QueryPerf(querySpec=specs) or []
+
+        added = []
+        for entity_metric in result:
+            entity = self.index.get(entity_metric.entity._moId)
+            if entity is None or not entity_metric.sampleInfoCSV:
+                continue
+
+            timestamps = [_parse_time(t) for t in entity_metric.sampleInfoCSV.split(",")[1::2]]
+
+            # Drop anything not newer than what is stored already.
+            last = self.ring.last_timestamp(entity)
+            first = 0
+            if last is not None:
+                while first < len(timestamps) and timestamps[first] <= last:
+                    first += 1
+
+            if first == len(timestamps):
+                continue
+
+            # With instance "*" there is a series per instance; only the
+            # aggregate ("") or the first series of a counter is kept.
+            columns = {}
+            for series in entity_metric.value or []:
+                metric = self.metric_index.get(series.id.counterId)
+                if metric is None or (metric in columns and series.id.instance != ""):
+                    continue
+
+                columns[metric] = _parse_values(series.value)[first:]
+
+            self.ring.extend(entity, timestamps[first:], columns)
+            added.append((entity, len(timestamps) - first))
+
+        return added
+
+    def poll(self):
+        """Runs one round of queries over all batches. Returns a list of
+        (entity index, number of new samples). Failed batches are logged
+        and picked up again by the next poll.
+        """
+        added = []
+        for batch, result, error in parallel.run_parallel(self.batches, self._query_batch,
+                                                          max_workers=self.max_workers, retries=1):
+            if error:
+                logging.error("Query of {} VMs failed: {}".format(len(batch), error))
+                continue
+
+            added.extend(result)
+
+        return added
+
+    def stream(self, period=REALTIME_INTERVAL, max_polls=None):
+        """Polls every period seconds until stop() is called (or max_polls
+        times) and yields (moref, timestamps, {counter: values}) for every
+        VM with new samples, the columns being array('q').
+        """
+        polls = 0
+        while not self._stopped.is_set() and (max_polls is None or polls < max_polls):
+            start = time.time()
+            for entity, num_samples in self.poll():
+                yield (self.entities[entity]._moId, self.ring.get_timestamps(entity, num_samples),
+                       {counter: self.ring.get_values(entity, metric, num_samples)
+                        for metric, counter in enumerate(self.counters)})
+
+            polls += 1
+            if max_polls is None or polls < max_polls:
+                self._stopped.wait(max(0, period - (time.time() - start)))
+
+    def stop(self):
+        self._stopped.set()
+
+    def get(self, vm, counter, last=None):
+        """Returns (timestamps, values) kept for a VM (VirtualMachine,
+        vim.VirtualMachine or moref) and counter, oldest first.
+        """
+        moref = vm if isinstance(vm, str) else getattr(vm, 'vmobj', vm)._moId
+        entity = self.index[moref]
+        return self.ring.get_timestamps(entity, last), self.ring.get_values(entity, self.counters.index(counter), last)
@@ -0,0 +1,311 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+from vmwarelib.sdk import util
+
+_local = threading.local()
+_install_lock = threading.Lock()
+
+class RpcCall:
+    """One call through a pyVmomi stub, as seen by listeners.
+
+    kind is "method" for a SOAP request (InvokeMethod) and "accessor" for
+    reading a property of a managed object (InvokeAccessor), which itself
+    issues a method call (Fetch or RetrieveContents, depending on pyVmomi
+    version). Listeners can keep their own
+    state of the call in attributes.
+    """
+
+    def __init__(self, kind, mo, name):
+        self.kind = kind
+        self.mo_type = getattr(mo, '_wsdlName', None) or type(mo).__name__
+        self.moref = getattr(mo, '_moId', None)
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+        self.attributes = {}
+
+    def __repr__(self):
+        return "RpcCall({}.{}, {})".format(self.mo_type, self.name, self.kind)
+
+def _current_call():
+    calls = getattr(_local, 'calls', None)
+    return calls[-1] if calls else None
+
+def _count_received(data):
+    call = _current_call()
+    if call is not None and data:
+        call.bytes_received += len(data)
+
+class _StubHook:
+    """Wraps InvokeMethod and InvokeAccessor of a stub (on the instance, so
+    that other stubs are not affected) and reports every call to the
+    registered listeners. A listener has before(call) and after(call)
+    methods.
+    """
+
+    def __init__(self, stub):
+        self.listeners = []
+
+        self._invoke_method = stub.InvokeMethod
+        self._invoke_accessor = stub.InvokeAccessor
+        stub.InvokeMethod = self.invoke_method
+        stub.InvokeAccessor = self.invoke_accessor
+
+        # Request size is taken from the serialized request, response size
+        # from what the deserializer reads off the connection.
+        if hasattr(stub, 'SerializeRequest'):
+            self._serialize_request = stub.SerializeRequest
+            stub.SerializeRequest = self.serialize_request
+
+        if hasattr(stub, 'GetConnection'):
+            self._get_connection = stub.GetConnection
+            stub.GetConnection = self.get_connection
+
+    def _notify(self, event, call):
+        for listener in list(self.listeners):
+            try:
+                getattr(listener, event)(call)
+            except Exception:
+                logging.exception("Stub listener ({}) failed".format(listener))
+
+    def _invoke(self, call, func, *args):
+        if not self.listeners:
+            return func(*args)
+
+        calls = getattr(_local, 'calls', None)
+        if calls is None:
+            calls = _local.calls = []
+
+        self._notify('before', call)
+        calls.append(call)
+        try:
+            return func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            calls.pop()
+            call.duration = time.time() - call.start
+            self._notify('after', call)
+
+    def invoke_method(self, mo, info, args, *rest):
+        name = getattr(info, 'wsdlName', None) or info.name
+        return self._invoke(RpcCall("method", mo, name), self._invoke_method, mo, info, args, *rest)
+
+    def invoke_accessor(self, mo, info):
+        return self._invoke(RpcCall("accessor", mo, info.name), self._invoke_accessor, mo, info)
+
+    def serialize_request(self, *args):
+        request = self._serialize_request(*args)
+        call = _current_call()
+        if call is not None:
+            call.bytes_sent += len(request)
+
+        return request
+
+    def get_connection(self, *args):
+        conn = self._get_connection(*args)
+        if getattr(conn, '_vmwarelib_hooked', False):
+            return conn
+
+        getresponse = conn.getresponse
+
+        def hooked_getresponse(*args, **kwargs):
+            resp = getresponse(*args, **kwargs)
+            read = resp.read
+
+            def hooked_read(*args, **kwargs):
+                data = read(*args, **kwargs)
+                _count_received(data)
+                return data
+
+            resp.read = hooked_read
+            return resp
+
+        conn.getresponse = hooked_getresponse
+        conn._vmwarelib_hooked = True
+
+        return conn
+
+def _get_hook(stub):
+    with _install_lock:
+        hook = getattr(stub, '_vmwarelib_hook', None)
+        if hook is None:
+            hook = _StubHook(stub)
+            stub._vmwarelib_hook = hook
+
+        return hook
+
+def add_listener(stub, listener):
+    """Calls listener.before(call) and listener.after(call) around every
+    call made through stub (e.g. server.service_instance._stub).
+    """
+    _get_hook(stub).listeners.append(listener)
+
+def remove_listener(stub, listener):
+    hook = getattr(stub, '_vmwarelib_hook', None)
+    if hook is not None and listener in hook.listeners:
+        hook.listeners.remove(listener)
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last
+# bucket takes everything slower.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class CallStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, call):
+        self.count += 1
+        if call.error is not None:
+            self.errors += 1
+
+        self.total += call.duration
+        self.max = max(self.max, call.duration)
+        self.bytes_sent += call.bytes_sent
+        self.bytes_received += call.bytes_received
+        self.histogram[bisect.bisect_left(BUCKETS, call.duration)] += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (max for
+        the last bucket).
+        """
+        if not self.count:
+            return 0.0
+
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+
+        return self.max
+
+class Profiler:
+    """Counts calls per managed object type and method, with latency
+    histograms and bytes transferred.
+
+    Method calls are round trips to the server. Property reads of managed
+    objects (e.g. vmobj.config) are listed as accessors; the round trip each
+    of them makes is listed separately as a method call.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.started = time.time()
+        self._stubs = []
+        self._lock = threading.Lock()
+
+    def attach(self, stub):
+        if stub not in self._stubs:
+            add_listener(stub, self)
+            self._stubs.append(stub)
+
+    def detach(self):
+        for stub in self._stubs:
+            remove_listener(stub, self)
+
+        self._stubs = []
+
+    def before(self, call):
+        pass
+
+    def after(self, call):
+        key = (call.kind, call.mo_type, call.name)
+        with self._lock:
+            if key not in self.stats:
+                self.stats[key] = CallStats()
+
+            self.stats[key].add(call)
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self.started = time.time()
+
+    def _methods(self):
+        return [stats for (kind, _, _), stats in self.stats.items() if kind == "method"]
+
+    @property
+    def round_trips(self):
+        return sum(stats.count for stats in self._methods())
+
+    def summary(self):
+        """Returns the totals over all round trips. """
+        methods = self._methods()
+
+        histogram = [0] * (len(BUCKETS) + 1)
+        for stats in methods:
+            histogram = [a + b for a, b in zip(histogram, stats.histogram)]
+
+        return {
+            "round_trips": sum(stats.count for stats in methods),
+            "errors": sum(stats.errors for stats in methods),
+            "time": sum(stats.total for stats in methods),
+            "bytes_sent": sum(stats.bytes_sent for stats in methods),
+            "bytes_received": sum(stats.bytes_received for stats in methods),
+            "histogram": histogram,
+            "elapsed": time.time() - self.started,
+        }
+
+    def report(self):
+        with self._lock:
+            summary = self.summary()
+            rows = sorted(self.stats.items(), key=lambda x: x[1].total, reverse=True)
+
+        lines = ["SOAP calls: {} round trips ({} failed) in {:.3f}s of {:.3f}s, {} sent, {} received".format(
+            summary["round_trips"], summary["errors"], summary["time"], summary["elapsed"],
+            util.bytes_to_readable_units(summary["bytes_sent"]),
+            util.bytes_to_readable_units(summary["bytes_received"]))]
+
+        lines.append("")
+        lines.append("{:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>14} {:>14}  {}".format(
+            "Calls", "Errors", "Total(s)", "Mean(ms)", "p95(ms)", "Max(ms)", "Sent", "Received", "Call"))
+        for (kind, mo_type, name), stats in rows:
+            call_name = "{}.{}".format(mo_type, name)
+            if kind == "accessor":
+                call_name += " (property)"
+
+            lines.append("{:>6} {:>6} {:>9.3f} {:>9.1f} {:>9.1f} {:>9.1f} {:>14} {:>14}  {}".format(
+                stats.count, stats.errors, stats.total, stats.total / stats.count * 1000,
+                stats.percentile(95) * 1000, stats.max * 1000, util.bytes_to_readable_units(stats.bytes_sent),
+                util.bytes_to_readable_units(stats.bytes_received), call_name))
+
+        lines.append("")
+        lines.append("Round trip latency:")
+        bounds = ["<= {}ms".format(int(b * 1000)) for b in BUCKETS] + ["> {}ms".format(int(BUCKETS[-1] * 1000))]
+        for bound, n in zip(bounds, summary["histogram"]):
+            if n:
+                lines.append("  {:>10} {:>6}".format(bound, n))
+
+        return "\n".join(lines)
+
+@contextlib.contextmanager
+def profile(server):
+    """Profiles the calls made through server's connection within the
+    with block:
+
+        with profiling.profile(server) as profiler:
+            vm.info()
+        print(profiler.report())
+    """
+    profiler = Profiler()
+    profiler.attach(server.service_instance._stub)
+    try:
+        yield profiler
+    finally:
+        profiler.detach()
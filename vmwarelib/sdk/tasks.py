@@ -0,0 +1,246 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+class TaskWatcher:
+    """Waits for any number of vCenter tasks with a single WaitForUpdatesEx
+    loop running on a background thread.
+
+    Tasks are added to and removed from a ListView that one filter of a
+    private PropertyCollector traverses, so watching a task costs no extra
+    filter. submit() returns a concurrent.futures.Future that resolves to
+    the final TaskInfo (or raises the task's error).
+    """
+
+    # Finished tasks are removed from the view in batches of this many (or
+    # when no task is left to wait for); they also go out with the next
+    # addition.
+    remove_batch = 100
+
+    def __init__(self, service_instance, max_wait=30):
+        self.service_instance = service_instance
+        self.max_wait = max_wait
+
+        self.lock = threading.Lock()
+        self._futures = {}
+        # Final TaskInfo of finished tasks that are still in the view.
+        self._finished = {}
+        self._to_add = []
+        self._to_remove = []
+        self._collector = None
+        self._view = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+        # Serializes changes to the view so that tasks queued while a
+        # ModifyListView is in flight go out together in the next one.
+        self._view_lock = threading.Lock()
+
+    def _start(self, tasks):
+        content = self.service_instance.content
+
+        collector = content.propertyCollector.CreatePropertyCollector()
+        view = content.viewManager.CreateListView(obj=tasks)
+
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view',
+                                                                     skip=False, type=vim.view.ListView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info'], all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+        collector.CreateFilter(filter_spec, False)
+
+        self._collector = collector
+        self._view = view
+        self._thread = threading.Thread(target=self._run, args=(collector, view), name='vmwarelib-tasks',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, task):
+        return self.submit_many([task])[0]
+
+    def submit_many(self, tasks):
+        """Same as submit() for a list of tasks, adding all of them to the
+        view in one call.
+        """
+        futures = []
+        new_tasks = []
+        with self.lock:
+            if self._stopped.is_set():
+                raise Exception("Task watcher is stopped. ")
+
+            for task in tasks:
+                future = self._futures.get(task._moId)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    info = self._finished.get(task._moId)
+                    if info is not None:
+                        self._resolve(future, info)
+                    else:
+                        self._futures[task._moId] = future
+                        new_tasks.append(task)
+
+                futures.append(future)
+
+            if not new_tasks:
+                return futures
+
+            if self._collector is None:
+                try:
+                    self._start(new_tasks)
+                except Exception as e:
+                    for task in new_tasks:
+                        self._futures.pop(task._moId).set_exception(e)
+                    raise
+
+                return futures
+
+            self._to_add.extend(new_tasks)
+
+        self._flush()
+
+        return futures
+
+    def submit_async(self, task):
+        """Same as submit() but returns an asyncio future. Must be called
+        from a running event loop.
+        """
+        return asyncio.wrap_future(self.submit(task))
+
+    def wait(self, tasks, timeout=None):
+        """Waits for all tasks and returns their TaskInfo objects in the same
+        order. Raises the error of the first failed task.
+        """
+        futures = self.submit_many(tasks)
+
+        return [future.result(timeout) for future in futures]
+
+    def _flush(self):
+        """Sends the queued additions to and removals from the view. """
+        with self._view_lock:
+            with self.lock:
+                view = self._view
+                add, self._to_add = self._to_add, []
+                # A task that is watched again must stay in the view.
+                remove = [task for task in self._to_remove if task._moId not in self._futures]
+                self._to_remove = []
+
+            if view is None or not (add or remove):
+                return
+
+            try:
+                view.ModifyListView(add=add or None, remove=remove or None)
+            except Exception as e:
+                logging.exception("Could not update task watcher view")
+                with self.lock:
+                    futures = [self._futures.pop(task._moId, None) for task in add]
+                for future in futures:
+                    if future is not None:
+                        future.set_exception(e)
+                return
+
+            with self.lock:
+                for task in remove:
+                    self._finished.pop(task._moId, None)
+
+    def _run(self, collector, view):
+        version = None
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+
+        while not self._stopped.is_set():
+            try:
+                update = collector.WaitForUpdatesEx(version, options)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    logging.exception("Task watcher failed")
+                    self._reset(e)
+
+                break
+
+            if update is None:
+                continue
+
+            version = update.version
+
+            done = False
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    for change in obj_set.changeSet or []:
+                        if change.name != 'info' or change.val is None:
+                            continue
+
+                        if self._complete(obj_set.obj, change.val):
+                            done = True
+
+            if done:
+                with self.lock:
+                    flush = len(self._to_remove) >= self.remove_batch or not self._futures
+
+                if flush:
+                    self._flush()
+
+    def _resolve(self, future, info):
+        if info.state == vim.TaskInfo.State.success:
+            future.set_result(info)
+        else:
+            future.set_exception(info.error)
+
+    def _complete(self, task, info):
+        if info.state not in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+            return False
+
+        with self.lock:
+            future = self._futures.pop(task._moId, None)
+            if task._moId not in self._finished:
+                self._finished[task._moId] = info
+                self._to_remove.append(task)
+
+        if future is not None:
+            self._resolve(future, info)
+
+        return True
+
+    def _reset(self, error):
+        """Fails all pending tasks and drops the collector and view so that
+        the next submit() starts over.
+        """
+        with self.lock:
+            futures = list(self._futures.values())
+            self._futures = {}
+            self._finished = {}
+            self._to_add = []
+            self._to_remove = []
+            collector, view = self._collector, self._view
+            self._collector = None
+            self._view = None
+            self._thread = None
+
+        for future in futures:
+            future.set_exception(error)
+
+        for obj in (collector, view):
+            if obj is not None:
+                try:
+                    obj.Destroy()
+                except Exception:
+                    logging.debug("Could not destroy {}".format(obj), exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+
+        with self.lock:
+            collector, thread = self._collector, self._thread
+
+        if collector is not None:
+            try:
+                collector.CancelWaitForUpdates()
+            except Exception:
+                logging.debug("Could not cancel pending WaitForUpdatesEx", exc_info=True)
+
+        if thread is not None:
+            thread.join()
+
+        self._reset(Exception("Task watcher is stopped. "))
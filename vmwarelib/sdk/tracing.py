@@ -0,0 +1,366 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+# Tracer in use, None when tracing is off (the default).
+_tracer = None
+_atexit_registered = False
+
+_current_span = contextvars.ContextVar("vmwarelib_span", default=None)
+
+class Span:
+    """Span of JsonLinesTracer. """
+
+    def __init__(self, tracer, name, parent, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = "{}: {}".format(type(error).__name__, getattr(error, 'msg', None) or error)
+
+    def end(self):
+        if self._token is not None:
+            _current_span.reset(self._token)
+            self._token = None
+
+        end = time.time()
+        self.tracer.export({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": end,
+            "duration": end - self.start,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+            "error": self.error,
+        })
+
+class JsonLinesTracer:
+    """Writes every finished span as a line of JSON to path. Spans started
+    while another span is active on the same thread (or asyncio task)
+    become its children.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def start_span(self, name, attributes=None, activate=True):
+        span = Span(self, name, _current_span.get(), attributes)
+        if activate:
+            span._token = _current_span.set(span)
+
+        return span
+
+    def current_span(self):
+        return _current_span.get()
+
+    def export(self, data):
+        line = json.dumps(data, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def shutdown(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class _OpenTelemetrySpan:
+    def __init__(self, span, token):
+        self.span = span
+        self._token = token
+
+    def set_attribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def record_error(self, error):
+        from opentelemetry import trace
+
+        self.span.record_exception(error)
+        self.span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+
+    def end(self):
+        from opentelemetry import context
+
+        if self._token is not None:
+            context.detach(self._token)
+            self._token = None
+
+        self.span.end()
+
+class OpenTelemetryTracer:
+    """Sends spans to the OpenTelemetry tracer provider of the process. """
+
+    def __init__(self, provider=None):
+        from opentelemetry import trace
+
+        self._provider = provider
+        self._tracer = trace.get_tracer("vmwarelib", tracer_provider=provider)
+
+    def start_span(self, name, attributes=None, activate=True):
+        from opentelemetry import context
+        from opentelemetry import trace
+
+        span = self._tracer.start_span(name, attributes=_otel_attributes(attributes))
+        token = context.attach(trace.set_span_in_context(span)) if activate else None
+
+        return _OpenTelemetrySpan(span, token)
+
+    def current_span(self):
+        from opentelemetry import trace
+
+        span = trace.get_current_span()
+        return _OpenTelemetrySpan(span, None) if span.get_span_context().is_valid else None
+
+    def shutdown(self):
+        # Only a provider set up by create_opentelemetry_tracer() is ours
+        # to shut down.
+        if self._provider is not None:
+            self._provider.shutdown()
+
+def _otel_attributes(attributes):
+    # OpenTelemetry takes only primitive values and lists of them.
+    result = {}
+    for key, value in (attributes or {}).items():
+        if isinstance(value, (list, tuple)):
+            result[key] = [v if isinstance(v, (str, bool, int, float)) else str(v) for v in value]
+        elif value is not None:
+            result[key] = value if isinstance(value, (str, bool, int, float)) else str(value)
+
+    return result
+
+def create_opentelemetry_tracer():
+    """Returns an OpenTelemetryTracer if opentelemetry is installed and
+    spans have somewhere to go: either the application has set a tracer
+    provider, or an OTLP endpoint is configured in the environment (and the
+    SDK and OTLP exporter are installed). Returns None otherwise.
+    """
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+
+    provider = trace.get_tracer_provider()
+    if type(provider).__name__ not in ("ProxyTracerProvider", "NoOpTracerProvider"):
+        return OpenTelemetryTracer()
+
+    if not (os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") or os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")):
+        return None
+
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logging.warning("OTLP endpoint is set but opentelemetry-sdk or the OTLP exporter is not installed")
+        return None
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "vmwarelib"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+
+    return OpenTelemetryTracer(provider)
+
+def configure(path=None, tracer=None):
+    """Turns on tracing.
+
+    tracer is any object with start_span(name, attributes, activate),
+    current_span() and shutdown() methods. By default spans go to
+    OpenTelemetry if a collector is configured (see
+    create_opentelemetry_tracer) and to a JSON lines file at path
+    otherwise. Must be called before creating a Server for its calls to
+    vCenter to be traced.
+    """
+    global _tracer, _atexit_registered
+
+    if tracer is None:
+        tracer = create_opentelemetry_tracer()
+
+    if tracer is None:
+        if not path:
+            raise Exception("A file is needed for traces when no OpenTelemetry collector is configured. ")
+
+        tracer = JsonLinesTracer(path)
+
+    shutdown()
+    _tracer = tracer
+    if not _atexit_registered:
+        atexit.register(shutdown)
+        _atexit_registered = True
+
+    return tracer
+
+def shutdown():
+    """Turns off tracing and flushes the spans. """
+    global _tracer
+
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.shutdown()
+
+def is_enabled():
+    return _tracer is not None
+
+def set_attribute(key, value):
+    """Sets an attribute of the current span, if any. """
+    tracer = _tracer
+    if tracer is None:
+        return
+
+    span = tracer.current_span()
+    if span is not None:
+        span.set_attribute(key, value)
+
+def record_tasks(task_infos):
+    """Records keys, states and durations of finished tasks in the current
+    span.
+    """
+    if _tracer is None:
+        return
+
+    durations = []
+    for info in task_infos:
+        if info.startTime and info.completeTime:
+            durations.append((info.completeTime - info.startTime).total_seconds())
+        else:
+            durations.append(None)
+
+    set_attribute("vmware.task.keys", [info.key for info in task_infos])
+    set_attribute("vmware.task.states", [str(info.state) for info in task_infos])
+    set_attribute("vmware.task.durations", [d if d is not None else -1.0 for d in durations])
+
+def _object_attributes(obj):
+    attributes = {}
+    for attr in ("vmobj", "snapobj", "hostobj", "dsobj"):
+        mo = getattr(obj, attr, None)
+        if mo is not None and hasattr(mo, "_moId"):
+            attributes["vmware.{}".format(attr[:-3])] = mo._moId
+
+    return attributes
+
+def traced(name=None):
+    """Decorator running a function in a span (named after the function by
+    default). For a generator function, the span lasts until the generator
+    is exhausted or closed and records the number of items.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+        takes_self = "self" in inspect.signature(func).parameters
+
+        def start_span(tracer, args, activate):
+            attributes = _object_attributes(args[0]) if takes_self and args else None
+            return tracer.start_span(span_name, attributes, activate)
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                tracer = _tracer
+                if tracer is None:
+                    yield from func(*args, **kwargs)
+                    return
+
+                # Not made current, the caller runs between items.
+                span = start_span(tracer, args, False)
+                count = 0
+                try:
+                    for item in func(*args, **kwargs):
+                        count += 1
+                        yield item
+                except Exception as e:
+                    span.record_error(e)
+                    raise
+                finally:
+                    span.set_attribute("items", count)
+                    span.end()
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+
+            span = start_span(tracer, args, True)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                span.record_error(e)
+                raise
+            finally:
+                span.end()
+
+        return wrapper
+
+    return decorator
+
+def trace_methods(cls):
+    """Class decorator tracing all public methods of cls. """
+    for attr, value in list(vars(cls).items()):
+        if not attr.startswith("_") and inspect.isfunction(value):
+            setattr(cls, attr, traced("{}.{}".format(cls.__name__, attr))(value))
+
+    return cls
+
+class RpcTracer:
+    """Stub listener (see profiling.add_listener) giving every call to
+    vCenter a span.
+    """
+
+    def before(self, call):
+        tracer = _tracer
+        if tracer is None:
+            return
+
+        attributes = {"rpc.system": "vmware-vim", "rpc.method": call.name, "vmware.type": call.mo_type,
+                      "vmware.moref": call.moref, "vmware.call": call.kind}
+        call.attributes["span"] = tracer.start_span("vim.{}.{}".format(call.mo_type, call.name), attributes)
+
+    def after(self, call):
+        span = call.attributes.pop("span", None)
+        if span is None:
+            return
+
+        if call.error is not None:
+            span.record_error(call.error)
+        if call.bytes_sent or call.bytes_received:
+            span.set_attribute("vmware.bytes_sent", call.bytes_sent)
+            span.set_attribute("vmware.bytes_received", call.bytes_received)
+
+        span.end()
+
+def instrument(stub):
+    """Traces the calls made through stub if tracing is on. Can be called
+    again for the same stub (e.g. for a Server created before tracing was
+    turned on); the listener is added only once and does nothing while
+    tracing is off.
+    """
+    if _tracer is None or getattr(stub, '_vmwarelib_traced', False):
+        return
+
+    from vmwarelib.sdk import profiling
+
+    profiling.add_listener(stub, RpcTracer())
+    stub._vmwarelib_traced = True
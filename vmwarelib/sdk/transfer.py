@@ -0,0 +1,246 @@
+import concurrent.futures
+import json
+import logging
+import mmap
+import os
+
+import requests
+import requests.adapters
+
+from vmwarelib.sdk import util
+
+def create_session(cookie=None, pool_size=8, verify=False):
+    """Returns a requests.Session with a connection pool of pool_size,
+    authenticated with the vSphere session cookie if given (the value of
+    the stub's cookie attribute).
+    """
+    session = requests.Session()
+    session.verify = verify
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    if cookie:
+        # Only name=value part of the Set-Cookie value is sent back.
+        session.headers["Cookie"] = cookie.split(";", 1)[0].strip()
+
+    return session
+
+def _check_status(resp, url):
+    if resp.status_code >= 400:
+        raise Exception("Request for ({}) failed with status {}".format(url, resp.status_code))
+
+def get_size(session, url, params=None):
+    """Returns (size, ranges supported) of the file at url. """
+    # Asking for the first byte works with servers that don't support HEAD.
+    with session.get(url, params=params, headers={"Range": "bytes=0-0"}, stream=True) as resp:
+        _check_status(resp, url)
+
+        if resp.status_code == 206 and "/" in resp.headers.get("Content-Range", ""):
+            return int(resp.headers["Content-Range"].rsplit("/", 1)[1]), True
+
+        return int(resp.headers.get("Content-Length", -1)), False
+
+def _total_size(resp):
+    """Size of the whole file according to a response, None if unknown. """
+    if resp.status_code in (206, 416):
+        total = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+
+    # Content-Length of an encoded body is not the size of the file.
+    if "Content-Encoding" in resp.headers or "Content-Length" not in resp.headers:
+        return None
+
+    return int(resp.headers["Content-Length"])
+
+def _validator(resp):
+    # If-Range only takes a strong ETag.
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return resp.headers.get("Last-Modified")
+
+def _load_part_info(info_path):
+    try:
+        with open(info_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _save_part_info(info_path, resp):
+    with open(info_path, "w") as f:
+        json.dump({"validator": _validator(resp), "size": _total_size(resp)}, f)
+
+def _download_stream(session, url, params, part_path, chunk_size, resume, progress):
+    # Validator and size of the file the part file is a prefix of. A part
+    # file without them is not resumed.
+    info_path = part_path + ".json"
+    info = _load_part_info(info_path) if resume and os.path.exists(part_path) else None
+    offset = os.path.getsize(part_path) if info else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+        if info["validator"]:
+            # Server sends the whole file instead if it has changed.
+            headers["If-Range"] = info["validator"]
+
+    with session.get(url, params=params, headers=headers, stream=True) as resp:
+        size = _total_size(resp)
+
+        if resp.status_code == 416:
+            if offset and size == offset == info["size"]:
+                # Nothing left to download.
+                return offset
+
+            restart = True
+        else:
+            _check_status(resp, url)
+            # Without a validator, the size is all there is to compare.
+            restart = resp.status_code == 206 and (size is None or size != info["size"])
+
+        if not restart:
+            if resp.status_code != 206:
+                offset = 0
+                _save_part_info(info_path, resp)
+
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in resp.iter_content(chunk_size):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    if progress:
+                        progress(len(chunk))
+
+    if restart:
+        logging.info("Remote file ({}) has changed, downloading it again".format(url))
+        return _download_stream(session, url, params, part_path, chunk_size, False, progress)
+
+    if size is not None and offset != size:
+        raise Exception("Download of ({}) stopped at {} of {} bytes".format(url, offset, size))
+
+    return offset
+
+def _download_segment(session, url, params, part_path, start, end, chunk_size, progress):
+    headers = {"Range": "bytes={}-{}".format(start, end - 1)}
+    with session.get(url, params=params, headers=headers, stream=True) as resp:
+        _check_status(resp, url)
+        if resp.status_code != 206:
+            raise Exception("Server ignored range request for ({})".format(url))
+
+        received = 0
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            for chunk in resp.iter_content(chunk_size):
+                f.write(chunk)
+                received += len(chunk)
+                if progress:
+                    progress(len(chunk))
+
+    if received != end - start:
+        raise Exception("Expected {} bytes at offset {} of ({}), got {}".format(end - start, start, url, received))
+
+    return end - start
+
+def download(session, url, local_path, params=None, chunk_size=util.unit_m, resume=True, segments=1,
+             segment_size=64 * util.unit_m, progress=None):
+    """Downloads url to local_path, streaming chunk_size bytes at a time.
+
+    Data goes to local_path.part first. With resume, an existing part file
+    is continued with a Range request, unless the file has changed since
+    (If-Range with the ETag or Last-Modified of the first response, which
+    are kept in local_path.part.json). With segments > 1, files larger than
+    segment_size are fetched as that many parallel Range requests (a
+    segmented download starts over if interrupted). progress(num_bytes) is
+    called as data arrives. Returns the size of the file.
+    """
+    part_path = local_path + ".part"
+
+    size, ranges = (-1, False)
+    if segments > 1:
+        size, ranges = get_size(session, url, params)
+
+    if segments > 1 and ranges and size > segment_size:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+
+        segment_length = -(-size // segments)
+        bounds = [(start, min(start + segment_length, size)) for start in range(0, size, segment_length)]
+        logging.debug("Downloading ({}) in {} segments".format(url, len(bounds)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            futures = [executor.submit(_download_segment, session, url, params, part_path, start, end, chunk_size,
+                                       progress)
+                       for start, end in bounds]
+            for future in futures:
+                future.result()
+    else:
+        size = _download_stream(session, url, params, part_path, chunk_size, resume, progress)
+
+    os.replace(part_path, local_path)
+    if os.path.exists(part_path + ".json"):
+        os.unlink(part_path + ".json")
+
+    return size
+
+class _MappedFile:
+    """Read-only, memory mapped file that requests sends as a request body
+    in chunks of chunk_size bytes, so memory use does not depend on the
+    size of the file.
+
+    There is no read() method on purpose: http.client reads file-like
+    bodies in fixed 8 KB blocks, while an iterable body is sent one item at
+    a time. __len__ lets requests set Content-Length instead of using
+    chunked encoding.
+    """
+
+    def __init__(self, path, chunk_size, progress=None):
+        self.f = open(path, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for offset in range(0, self.size, self.chunk_size):
+            data = self.mm[offset:offset + self.chunk_size]
+            if self.progress:
+                self.progress(len(data))
+
+            yield data
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+        self.f.close()
+
+def upload(session, url, local_path, params=None, chunk_size=util.unit_m, progress=None):
+    """Uploads local_path to url with a streaming PUT. progress(num_bytes)
+    is called as data is sent. Returns the size of the file.
+    """
+    body = _MappedFile(local_path, chunk_size, progress)
+    try:
+        resp = session.put(url, params=params, data=body, headers={"Content-Type": "application/octet-stream"})
+        _check_status(resp, url)
+    finally:
+        body.close()
+
+    return body.size
+
+def upload_many(session, files, connections=4, chunk_size=util.unit_m, progress=None):
+    """Uploads (local_path, url, params) entries of files, up to connections
+    at a time. Returns total number of bytes uploaded.
+
+    The datastore endpoint takes a file in a single PUT (no ranged writes),
+    so parallelism is across files.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(upload, session, url, local_path, params, chunk_size, progress)
+                   for local_path, url, params in files]
+
+        return sum(future.result() for future in futures)
@@ -1,10 +1,17 @@
 
+import collections
+import math
+import threading
+import re
 import sys
 import textwrap
+import time
 
 from pyVmomi import vim
 from pyVmomi import vmodl
 
+from vmwarelib.sdk import tracing
+
 unit_k = 1024
 unit_m = unit_k * 1024
 unit_g = unit_m * 1024
@@ -50,12 +57,130 @@ def bytes_to_readable_units(num_bytes):
 
     return "{:03.2f} Bytes".format(num_bytes)
 
+class TTLCache:
+    """Thread safe cache whose entries expire after ttl seconds. At most
+    max_entries are kept; the least recently stored ones are dropped first.
+    """
+
+    def __init__(self, ttl=60, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > ttl:
+                return None
+
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+def parse_datastore_path(path):
+    """Splits a datastore path like "[ds1] vm/vm.vmx" into datastore name
+    and file path.
+    """
+    m = re.match(r'\[(.*)\]\s*(.*)', path)
+    if not m:
+        raise Exception("Could not parse datastore path ({})".format(path))
+
+    return m.group(1).strip(), m.group(2).strip()
+
+def _retrieve_pages(property_collector, filter_specs, options):
+    token = None
+    try:
+        result = property_collector.RetrievePropertiesEx(filter_specs, options)
+        while result:
+            token = result.token
+            for obj_content in result.objects:
+                yield obj_content.obj, {p.name: p.val for p in obj_content.propSet or []}
+
+            if not token:
+                break
+
+            result = property_collector.ContinuePropertiesEx(token)
+            token = None
+    finally:
+        # Caller stopped reading before the last page. Release the server
+        # side result set.
+        if token:
+            property_collector.CancelRetrievePropertiesEx(token)
+
+def collect_properties(service_instance, obj_type, path_set, container=None, page_size=1000):
+    """Retrieves the given property paths of all objects of obj_type found
+    under container (root folder by default).
+
+    A single PropertyCollector filter over a container view is used and
+    results are fetched in pages of page_size objects, so the cost is a
+    handful of round trips instead of one per object and property. Yields
+    (obj, {path: value}) tuples. Paths that are not set on an object are
+    missing from its dictionary.
+    """
+    content = service_instance.content
+    if container is None:
+        container = content.rootFolder
+
+    view = content.viewManager.CreateContainerView(container, [obj_type], True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view',
+                                                                     skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=list(path_set),
+                                                                   all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+
+        for obj, props in _retrieve_pages(content.propertyCollector, [filter_spec], options):
+            yield obj, props
+    finally:
+        view.Destroy()
+
+def fetch_properties(service_instance, objs, obj_type, path_set):
+    """Retrieves the given property paths of all objs in a single
+    PropertyCollector call. Returns a list of (obj, {path: value}) tuples.
+    """
+    if not objs:
+        return []
+
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=list(path_set), all=False)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[property_spec])
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+
+    return list(_retrieve_pages(service_instance.content.propertyCollector, [filter_spec], options))
+
+def _wait(service_instance, wait, tasks):
+    # wait is a callable taking a list of tasks, such as
+    # Server.wait_for_tasks (which shares one TaskWatcher).
+    if wait is None:
+        wait_for_tasks(service_instance, tasks)
+    else:
+        wait(tasks)
+
 # Copied from pyvmomi-community-samples project (and slightly modified).
+@tracing.traced("util.wait_for_tasks")
 def wait_for_tasks(service_instance, tasks):
     """Given the service instance si and tasks, it returns after all the
     tasks are complete
     """
     result = {}
+    task_infos = []
+    tracing.set_attribute("vmware.task.keys", [task._moId for task in tasks])
 
     property_collector = service_instance.content.propertyCollector
     task_list = [str(task) for task in tasks]
@@ -82,6 +207,8 @@ def wait_for_tasks(service_instance, tasks):
                     for change in obj_set.changeSet:
                         if change.name == 'info':
                             state = change.val.state
+                            if state == vim.TaskInfo.State.success:
+                                task_infos.append(change.val)
                         elif change.name == 'info.state':
                             state = change.val
                         else:
@@ -100,6 +227,8 @@ def wait_for_tasks(service_instance, tasks):
             # Move to next version
             version = update.version
 
+        tracing.record_tasks(task_infos)
+
         return result
     finally:
         if pcfilter:
@@ -124,19 +253,19 @@ def spinner(label=''):
     sys.stdout.flush()
 
 
-def answer_vm_question(virtual_machine):
+def answer_interactive(question):
     print()
-    choices = virtual_machine.runtime.question.choice.choiceInfo
+    choices = question.choice.choiceInfo
     default_option = None
 
-    if virtual_machine.runtime.question.choice.defaultIndex is not None:
-        ii = virtual_machine.runtime.question.choice.defaultIndex
+    if question.choice.defaultIndex is not None:
+        ii = question.choice.defaultIndex
         default_option = choices[ii]
 
     choice = None
     while choice not in [o.key for o in choices]:
         print("VM power on is paused by this question:\n\n")
-        print("\n".join(textwrap.wrap(virtual_machine.runtime.question.text, 60)))
+        print("\n".join(textwrap.wrap(question.text, 60)))
         for option in choices:
             print("\t %s: %s " % (option.key, option.label))
         if default_option is not None:
@@ -146,30 +275,114 @@ def answer_vm_question(virtual_machine):
 
     return choice
 
-def powerOnVM(vmobj):
+def answer_vm_question(virtual_machine):
+    return answer_interactive(virtual_machine.runtime.question)
+
+def answer_default(question):
+    """Answer policy choosing the default answer of the question. """
+    if question.choice.defaultIndex is None:
+        raise Exception("Question has no default answer: ({})".format(question.text))
+
+    return question.choice.choiceInfo[question.choice.defaultIndex].key
+
+def answer_with_label(label):
+    """Returns an answer policy choosing the answer whose label contains
+    label (case insensitive), such as "I Copied It". Falls back to the
+    default answer.
+    """
+    def policy(question):
+        for option in question.choice.choiceInfo:
+            if label.lower() in option.label.lower():
+                return option.key
+
+        return answer_default(question)
+
+    return policy
+
+answer_policies = {
+    "interactive": answer_interactive,
+    "default": answer_default,
+    "copied": answer_with_label("copied"),
+    "moved": answer_with_label("moved"),
+}
+
+def power_on_vm(service_instance, vmobj, answer=answer_interactive, timeout=None, show_progress=False):
+    """Powers on the VM and waits for it.
+
+    Instead of polling, the task state and the VM's pending question are
+    watched with WaitForUpdatesEx on a private PropertyCollector. Questions
+    are answered by calling answer with the question, which returns the key
+    of the choice. Raises an exception if the VM is not powered on within
+    timeout seconds (the power on task itself is not cancelled).
+    """
     task = vmobj.PowerOn()
 
-    # We track the question ID & answer so we don't end up answering the same
-    # questions repeatedly.
-    answers = {}
-    while task.info.state not in [vim.TaskInfo.State.success, vim.TaskInfo.State.error]:
-        if vmobj.runtime.question is not None:
-            question_id = vmobj.runtime.question.id
-            if question_id not in answers.keys():
-                answers[question_id] = answer_vm_question(vmobj)
-                vmobj.AnswerVM(question_id, answers[question_id])
+    property_collector = service_instance.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task),
+                     vmodl.query.PropertyCollector.ObjectSpec(obj=vmobj)]
+        property_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
+                                                                     pathSet=['info.state', 'info.error']),
+                          vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                                     pathSet=['runtime.question'])]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=property_specs)
+        property_collector.CreateFilter(filter_spec, True)
+
+        deadline = time.time() + timeout if timeout else None
+
+        # We track the question ID & answer so we don't end up answering the same
+        # questions repeatedly.
+        answers = {}
+        version, state, error = None, None, None
+        while state not in [vim.TaskInfo.State.success, vim.TaskInfo.State.error]:
+            max_wait = None
+            if deadline is not None:
+                max_wait = int(math.ceil(deadline - time.time()))
+                if max_wait <= 0:
+                    raise Exception("Timed out waiting for VM ({}) to power on".format(vmobj._moId))
+
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+            update = property_collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
 
-        spinner(task.info.state)
+            version = update.version
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    for change in obj_set.changeSet:
+                        if change.name == 'info.state':
+                            state = change.val
+                        elif change.name == 'info.error':
+                            error = change.val
+                        elif change.name == 'runtime.question' and change.val is not None:
+                            question = change.val
+                            if question.id not in answers:
+                                answers[question.id] = answer(question)
+                                vmobj.AnswerVM(question.id, answers[question.id])
+
+            if show_progress:
+                spinner(state)
+
+        if state == vim.TaskInfo.State.error:
+            raise error
+    finally:
+        property_collector.Destroy()
 
-    if task.info.state == vim.TaskInfo.State.error:
-        raise task.info.error
+def powerOnVM(vmobj):
+    service_instance = vim.ServiceInstance('ServiceInstance', vmobj._stub)
+    power_on_vm(service_instance, vmobj, show_progress=True)
 
-def add_disk(service_instance, vmobj, size_gb, format="thin"):
+def add_disk(service_instance, vmobj, size_gb, format="thin", devices=None, wait=None):
     spec = vim.vm.ConfigSpec()
 
+    # devices can be passed in if the caller has them already (e.g. from
+    # Server.get_devices).
+    if devices is None:
+        devices = vmobj.config.hardware.device
+
     # get all disks on a VM, set unit_number to the next available
     unit_number = 0
-    for dev in vmobj.config.hardware.device:
+    for dev in devices:
         if hasattr(dev.backing, 'fileName'):
             unit_number = int(dev.unitNumber) + 1
             # unit_number 7 reserved for scsi controller
@@ -199,9 +412,9 @@ def add_disk(service_instance, vmobj, size_gb, format="thin"):
     spec.deviceChange = dev_changes
 
     task = vmobj.ReconfigVM_Task(spec=spec)
-    wait_for_tasks(service_instance, [task])
+    _wait(service_instance, wait, [task])
 
-def delete_disk(service_instance, vmobj, diskobj):
+def delete_disk(service_instance, vmobj, diskobj, wait=None):
     disk_spec = vim.vm.device.VirtualDeviceSpec()
     disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
     disk_spec.device = diskobj
@@ -209,9 +422,9 @@ def delete_disk(service_instance, vmobj, diskobj):
     spec = vim.vm.ConfigSpec()
     spec.deviceChange = [disk_spec]
     task = vmobj.ReconfigVM_Task(spec=spec)
-    wait_for_tasks(service_instance, [task])
+    _wait(service_instance, wait, [task])
 
-def resize_disk(service_instance, vmobj, diskobj, size_gb):
+def resize_disk(service_instance, vmobj, diskobj, size_gb, wait=None):
     disk_spec = vim.vm.device.VirtualDeviceSpec()
     disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
     disk_spec.device = diskobj
@@ -220,10 +433,10 @@ def resize_disk(service_instance, vmobj, diskobj, size_gb):
     spec = vim.vm.ConfigSpec()
     spec.deviceChange = [disk_spec]
     task = vmobj.ReconfigVM_Task(spec=spec)
-    wait_for_tasks(service_instance, [task])
+    _wait(service_instance, wait, [task])
 
 
-def add_scsi_controller(service_instance, vm):
+def add_scsi_controller(service_instance, vm, wait=None):
     task = vm.ReconfigVM_Task(
         spec=vim.vm.ConfigSpec(
             deviceChange=[
@@ -236,7 +449,7 @@ def add_scsi_controller(service_instance, vm):
             ]
         )
     )
-    wait_for_tasks(service_instance, [task])
+    _wait(service_instance, wait, [task])
 
 # The identity is a dictonary with keys IP, UUID and Inventory Path any one of them is enough.s
 def find_vmobj(service_instance, identity):